@@ -1,6 +1,10 @@
+import logging
+
 from search_engine.engine import SearchEngine
 
 def launch():
+    # progress of index loading and building
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
     search_engine = SearchEngine()
     search_engine.do_indexing('data.nosync/reuters21578/')
     
@@ -0,0 +1,53 @@
+from collections import OrderedDict
+
+
+class ResultCache(object):
+    """
+    Bounded query result cache with least recently used eviction.
+    Entries belong to one index version, the cache is emptied when
+    it is accessed with another version
+    """
+
+    def __init__(self, max_size=256):
+        """
+        :param max_size: maximum number of cached results, 0 disables caching
+        """
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+
+    def _check_version(self, version):
+        if version != self.version:
+            self.entries.clear()
+            self.version = version
+
+    def get(self, key, version):
+        """
+        :return: cached result for key, None if there is none
+        """
+        self._check_version(version)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, result, version):
+        if self.max_size <= 0:
+            return
+        self._check_version(version)
+        self.entries[key] = result
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
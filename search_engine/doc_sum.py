@@ -1,7 +1,5 @@
 import nltk
 import re
-from collections import Counter
-from search_engine.utils import preprocess
 
 
 def clean_text(text):
@@ -30,49 +28,3 @@ def get_text_sentences(text):
     sentences = nltk.sent_tokenize(new_text)
     return sentences
 
-
-def naive_sum(doc, query, sentence_cnt, is_raw=False):
-    '''Implementaion of naive text summarization
-    
-    Idea is to take document data, preprocess it, divide into
-    sentences, calculate score for each sentence based of tf
-    of each word in it and multiply for tf of each word in 
-    the query, and return top k sentences, for which
-    sum of lengths is less or equal to `summary_len`
-
-    Args:
-        doc: text of the document
-        query: input query
-        sentence_cnt: max amount of terms for output
-    
-    Returns:
-        resulting summary (title + summary text)
-    '''
-    sentences = get_text_sentences(doc)
-    # calculating number of term occurences in query and text
-    if is_raw:
-        q_tf = Counter(preprocess(query))
-    else:
-        q_tf = query
-    tf = Counter(preprocess(doc))
-
-    # normalizing tf on maximum tf
-    max_freq = max(tf.values())
-    for term in tf:
-        tf[term] /= max_freq
-    
-    # calculating score for each sentence
-    score_results = {}
-    for sentence in sentences:
-        for term in preprocess(sentence):
-            if term in tf and term in q_tf:
-                if sentence in score_results:
-                    score_results[sentence] += tf[term] * q_tf[term]
-                else:
-                    score_results[sentence] = tf[term] * q_tf[term]
-    
-    score_results = sorted(score_results.items(), key=lambda kv: kv[1], reverse=True)
-    result = []
-    for i in range(min(len(score_results), sentence_cnt)):
-        result.append(score_results[i][0] + ' ')
-    return ''.join(result)
\ No newline at end of file
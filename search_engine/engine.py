@@ -1,177 +1,839 @@
+import logging
 import os
 import pickle
 import math
 import heapq
 import re
 import time
-from functools import partial
-from collections import Counter
+from functools import cached_property
+from collections import Counter, namedtuple
 
+import numpy as np
+
+from search_engine import facets
+from search_engine import impact
 from search_engine import indexing
 from search_engine import spell_checking
 from search_engine import inexact
 from search_engine import language_model
 from search_engine import query_exp
 from search_engine import phrases
-from search_engine.doc_sum import naive_sum
+from search_engine import positions
+from search_engine import segments
+from search_engine import snippets
+from search_engine import wand
+from search_engine import vectorized
+from search_engine.cache import ResultCache
+from search_engine.stats import CollectionStats
 from search_engine.utils import *
 
+logger = logging.getLogger(__name__)
+
 path_prefix = 'search_engine/data.nosync/'
 
+QueryResult = namedtuple('QueryResult', ['query', 'doc_ids', 'scores'])
+
+BatchResult = namedtuple('BatchResult', ['results', 'elapsed', 'qps'])
+
+# query words with '*'
+wildcard_pattern = re.compile(r'\S*\*\S*')
+
 
 class SearchEngine(object):
 
     index_paths = {
-        'inv_index': f'{path_prefix}inv_index.p',
-        'documents': f'{path_prefix}documents.p',
-        'doc_lengths': f'{path_prefix}doc_lengths.p'
+        'doc_ids': f'{path_prefix}doc_ids.npy',
+        'inv_index': f'{path_prefix}inv_terms.npy',
+        'postings': f'{path_prefix}postings.bin',
+        'blocks': f'{path_prefix}blocks.npy',
+        'documents': f'{path_prefix}documents.bin',
+        'doc_offsets': f'{path_prefix}doc_offsets.npy',
+        'doc_blocks': f'{path_prefix}doc_blocks.npy',
+        'doc_lengths': f'{path_prefix}doc_lengths.npy',
+        'categories': f'{path_prefix}categories.p',
+        'forward_vocab': f'{path_prefix}forward_vocab.npy',
+        'forward_docs': f'{path_prefix}forward_docs.npy',
+        'forward_sentences': f'{path_prefix}forward_sentences.npy',
+        'forward_terms': f'{path_prefix}forward_terms.npy',
+        'forward_spans': f'{path_prefix}forward_spans.npy',
+        'positions_terms': f'{path_prefix}positions_terms.npy',
+        'positions': f'{path_prefix}positions.bin'
     }
 
     sc_paths = {
-        'k_gram_index': f'{path_prefix}k_gram_index.p',
+        'wildcard_index': f'{path_prefix}wildcard_index.p',
         'dictionary': f'{path_prefix}dictionary.p',
-        'soundex': f'{path_prefix}soundex.p'
+        'spelling_index': f'{path_prefix}spelling_index.p'
     }
 
     inexact_paths = {
-        'high_low_index': f'{path_prefix}high_low_index.p'
+        'tiered_index': f'{path_prefix}tiered_index.p'
+    }
+
+    stats_paths = {
+        'collection_stats': f'{path_prefix}collection_stats.p'
+    }
+
+    lm_paths = {
+        'category_models': f'{path_prefix}category_models.p'
+    }
+
+    facet_paths = {
+        'facet_index': f'{path_prefix}facet_index.p'
     }
 
-    phrase_paths = {
-        'n_gram_index': f'{path_prefix}n_gram_index.p'
+    segment_paths = {
+        'segments_dir': f'{path_prefix}segments/',
+        'manifest': f'{path_prefix}segments.p',
+        'derived_versions': f'{path_prefix}derived_versions.p'
     }
 
-    def __init__(self, paths=None):
+    impact_paths = {
+        'impact_terms': f'{path_prefix}impact_terms.npy',
+        'impact_segments': f'{path_prefix}impact_segments.npy',
+        'impact_docs': f'{path_prefix}impact_docs.bin'
+    }
+
+    # scorings computed with numpy arrays instead of per-posting loops, same results
+    vectorized_scorings = ('okapi_np', 'cosine_np', 'lm_np')
+
+    def __init__(self, paths=None, compression=None, use_mmap=True, workers=1, max_segments=8,
+                 use_wand=False, cache_size=256, tokenizer=None, tier_thresholds=(5,),
+                 postings_budget=None, time_budget=None, max_wildcard_terms=50,
+                 auto_correct=False, max_edit_distance=2, lm_smoothing='additive', lm_param=0.1,
+                 flush_updates=32):
+        if tokenizer is not None and tokenizer not in Analyzer.tokenizers:
+            raise ValueError(f'Unknown tokenizer: {tokenizer}')
+        # tokenizer of the index, an index built with another one is built again. None takes
+        # the one an existing index was built with. Every engine has its own analyzer,
+        # set by do_indexing, so engines of one process do not change each other
+        self.tokenizer = tokenizer
+        self.analyzer = None
         self.index_built = self._is_built(self.index_paths)
+        self.compression = compression
+        self.use_mmap = use_mmap
+        self.workers = workers
+        self.max_segments = max_segments
+        # exact okapi top-k with Block-Max WAND instead of the vectorized scoring, it is exact
+        # too, but visits documents one at a time and is slower on the Reuters collection
+        self.use_wand = use_wand
+        self.tier_thresholds = tuple(sorted(tier_thresholds, reverse=True))
+        # limits of 'impact' scoring per query - number of postings and seconds
+        self.postings_budget = postings_budget
+        self.time_budget = time_budget
+        self.max_wildcard_terms = max_wildcard_terms
+        # misspelled words are replaced with their best corrections instead of only suggesting them
+        self.auto_correct = auto_correct
+        self.max_edit_distance = max_edit_distance
+        # smoothing of 'lm' scoring, see vectorized.lm_scores
+        vectorized.check_lm_smoothing(lm_smoothing, lm_param)
+        self.lm_smoothing = lm_smoothing
+        self.lm_param = lm_param
+        self.result_cache = ResultCache(cache_size)
+        # structures changed by add_documents and delete_documents are written to disk
+        # after flush_updates updates, see flush
+        self.flush_updates = flush_updates
+        self._unsaved = {}
+        self._n_updates = 0
         
     
     def do_indexing(self, path):
+        if self.index_built:
+            # indexes which did not record their tokenizer were built with the default one
+            built_with = self.derived_versions.get('tokenizer', 'nltk')
+            if self.tokenizer not in (None, built_with):
+                logger.info('Index was built with %s tokenizer, building it with %s',
+                            built_with, self.tokenizer)
+                self.index_built = False
+            else:
+                self.analyzer = Analyzer(built_with)
         if not self.index_built:
-            indexing.build_inverted_index(path, self.index_paths)
-        self.inv_index, self.doc_lengths, self.documents = indexing.load_index(self.index_paths)
+            self.analyzer = Analyzer(self.tokenizer or 'nltk')
+            indexing.build_inverted_index(path, self.index_paths, self.compression, self.workers,
+                                          self.analyzer)
+            self.result_cache.clear()
+            # segments and all structures derived from the previous index are obsolete now,
+            # the index version starts from 0 again, so their recorded versions are dropped too
+            for stale_path in ((self.segment_paths['manifest'], self.segment_paths['derived_versions']) +
+                               tuple(self.stats_paths.values()) + tuple(self.sc_paths.values()) +
+                               tuple(self.inexact_paths.values()) + tuple(self.lm_paths.values()) +
+                               tuple(self.facet_paths.values()) + tuple(self.impact_paths.values())):
+                if os.path.isfile(stale_path):
+                    os.remove(stale_path)
+            for attr in ('derived_versions', 'stats', 'dictionary', 'wildcard_index', 'spelling_index',
+                         'tiered_index', 'impact_index', 'cat2docs', 'category_models', 'facet_index'):
+                self.__dict__.pop(attr, None)
+            self._unsaved = {}
+            self._n_updates = 0
+            self.derived_versions['tokenizer'] = self.analyzer.tokenizer
+            self._save_versions()
+        self.segments = segments.SegmentManager(self.index_paths, 
+                                                self.segment_paths['segments_dir'],
+                                                self.segment_paths['manifest'],
+                                                self.compression, self.use_mmap, self.max_segments)
         
-        self.dictionary = self._load_dictionary(self.sc_paths['dictionary'])
-        self.k_gram_index = self._load_k_gram_index(self.sc_paths['k_gram_index'])
-        self.soundex_index = self._load_soundex(self.sc_paths['soundex'])
+        # derived structures are loaded on first use, only the missing ones are built here
+        derived = {
+            'stats': self.stats_paths['collection_stats'],
+            'dictionary': self.sc_paths['dictionary'],
+            'wildcard_index': self.sc_paths['wildcard_index'],
+            'spelling_index': self.sc_paths['spelling_index'],
+            'tiered_index': self.inexact_paths['tiered_index']
+        }
+        for attr, attr_path in derived.items():
+            if not self._is_saved(attr_path):
+                getattr(self, attr)
+        self.index_built = True
 
-        self.high_low_index = self._load_high_low_index(self.inexact_paths['high_low_index'])
+    @cached_property
+    def stats(self):
+        return self._load_stats(self.stats_paths['collection_stats'])
 
-        self.n_gram_index = self._load_n_gram_index(self.phrase_paths['n_gram_index'])
-        self.index_built = True
+    @cached_property
+    def dictionary(self):
+        return self._load_dictionary(self.sc_paths['dictionary'])
+
+    @cached_property
+    def wildcard_index(self):
+        return self._load_wildcard_index(self.sc_paths['wildcard_index'])
+
+    @cached_property
+    def spelling_index(self):
+        return self._load_spelling_index(self.sc_paths['spelling_index'])
+
+    @cached_property
+    def tiered_index(self):
+        return self._load_tiered_index(self.inexact_paths['tiered_index'])
+
+    @cached_property
+    def impact_index(self):
+        return self._load_impact_index(self.impact_paths)
+
+    @cached_property
+    def cat2docs(self):
+        return language_model.group_categories(self.segments.categories)
+
+    @cached_property
+    def category_models(self):
+        return self._load_category_models(self.lm_paths['category_models'])
+
+    @cached_property
+    def facet_index(self):
+        return self._load_facet_index(self.facet_paths['facet_index'])
+
+    @cached_property
+    def derived_versions(self):
+        """
+        path:index version of every saved derived structure, see _load, and
+        'tokenizer':tokenizer the index was built with
+        """
+        path = self.segment_paths['derived_versions']
+        if not os.path.isfile(path):
+            return {}
+        with open(path, 'rb') as fd:
+            return pickle.load(fd)
+
+    @property
+    def inv_index(self):
+        return self.segments.inv_index
+
+    @property
+    def doc_lengths(self):
+        return self.segments.doc_lengths
+
+    @property
+    def documents(self):
+        return self.segments.documents
+
+    @property
+    def forward_index(self):
+        return self.segments.forward
+
+    @property
+    def positions(self):
+        return self.segments.positions
+
+    @property
+    def phrase_index(self):
+        return self.segments.phrases
+
+    @property
+    def index_version(self):
+        return self.segments.version
+
+    @property
+    def id_map(self):
+        return self.segments.id_map
+
+    def add_documents(self, documents, categories=None):
+        """
+        Indexes documents as a new segment, so they are searchable without rebuilding the index.
+        Documents with ids which are already in the index are replaced.
+        Spelling, tiered and facet indexes and category models are updated in place
+        and written to disk by flush. Documents are indexed by their dense numbers in id_map
+        :param documents: dict doc_id:doc_content
+        :param categories: dict doc_id:{category_tag: [value1, ...]}, optional
+        """
+        if categories is None:
+            categories = {}
+        numbers = self.segments.number_documents(documents)
+        doc_categories = dict((number, categories.get(doc_id, segments.empty_categories()))
+                              for number, doc_id in zip(numbers, documents))
+        documents = dict(zip(numbers, documents.values()))
+        replaced = [number for number in numbers if number in self.doc_lengths]
+        if len(replaced) > 0:
+            self._delete(replaced)
+
+        index, doc_lengths, analyzed = indexing.index_documents(documents, analyzer=self.analyzer)
+        self.segments.add_segment(index, doc_lengths, documents, doc_categories, analyzed)
+        self._update_derived(documents, index, doc_lengths, doc_categories, {}, {}, {})
+
+    def delete_documents(self, doc_ids):
+        """
+        Marks documents as deleted, they are dropped from index files when segments are merged.
+        Spelling, tiered and facet indexes and category models are updated in place
+        and written to disk by flush
+        :param doc_ids: iterable of doc ids
+        :return: set of doc ids that were deleted
+        """
+        numbers = [number for number in map(self.id_map.number, doc_ids) if number >= 0]
+        return set(self.id_map.doc_ids(sorted(self._delete(numbers))))
+
+    def _delete(self, doc_ids):
+        """
+        Same as delete_documents for doc numbers
+        :return: set of numbers of deleted documents
+        """
+        removed = dict((doc_id, self.documents[doc_id]) for doc_id in doc_ids 
+                       if doc_id in self.documents)
+        if len(removed) == 0:
+            return set()
+        removed_analyzed = dict((doc_id, self.forward_index[doc_id]) for doc_id in removed)
+        removed_categories = dict((doc_id, self.segments.categories.get(doc_id, segments.empty_categories()))
+                                  for doc_id in removed)
+        index, _, _ = indexing.index_documents(removed, removed_analyzed)
+        self.segments.delete(removed.keys())
+        self._update_derived({}, {}, {}, {}, removed, index, removed_categories)
+        return set(removed)
+
+    def merge_segments(self, include_base=False):
+        """
+        Merges segments added by add_documents (and the base index, if include_base),
+        dropping deleted documents from the files
+        """
+        self.flush()
+        self.segments.merge(include_base)
+        if include_base:
+            # the base segment is written again, impacts are quantized for it anew on next use
+            for impact_path in self.impact_paths.values():
+                if os.path.isfile(impact_path):
+                    os.remove(impact_path)
+            self.__dict__.pop('impact_index', None)
+
+    def flush(self):
+        """
+        Writes structures changed by add_documents and delete_documents since the last flush.
+        Structures which were not written are stale after a restart and built again
+        """
+        for attr, path in self._unsaved.items():
+            self._save(getattr(self, attr), path)
+        self._unsaved = {}
+        self._n_updates = 0
+
+    def _update_derived(self, added, added_index, added_lengths, added_categories, 
+                        removed, removed_index, removed_categories):
+        """
+        Updates derived structures in place after segments were changed. Only loaded structures
+        are updated, others were saved at an older index version and are built on next use
+        :param added: dict doc_id:doc_content of added documents
+        :param added_index: postings of added documents, term:([doc_id_1, ...], [doc_freq_1, ...])
+        :param added_lengths: dict doc_id:length of added documents
+        :param added_categories: dict doc_id:{category_tag: [value1, ...]} of added documents
+        :param removed: dict doc_id:doc_content of removed documents
+        :param removed_index: postings of removed documents, same format as added_index
+        :param removed_categories: same as added_categories for removed documents
+        """
+        if 'stats' in self.__dict__:
+            self.stats.update(added_index, added_lengths, removed_index, removed.keys())
+            self._unsaved['stats'] = self.stats_paths['collection_stats']
+
+        if 'impact_index' in self.__dict__:
+            self.impact_index.update(self.segments.segments, self.stats)
+
+        if 'dictionary' in self.__dict__:
+            new_words, dropped_words = spell_checking.update_dictionary(self.dictionary, added, removed, 
+                                                                        self.analyzer)
+            self._unsaved['dictionary'] = self.sc_paths['dictionary']
+            for attr in ('wildcard_index', 'spelling_index'):
+                if attr in self.__dict__:
+                    getattr(self, attr).update(new_words, dropped_words)
+                    self._unsaved[attr] = self.sc_paths[attr]
+        else:
+            # these are built from the dictionary, which is stale on disk
+            for attr in ('wildcard_index', 'spelling_index'):
+                self.__dict__.pop(attr, None)
+                self._unsaved.pop(attr, None)
+
+        if 'tiered_index' in self.__dict__:
+            self.tiered_index.update(added_index, removed_index)
+            self._unsaved['tiered_index'] = self.inexact_paths['tiered_index']
+
+        self.__dict__.pop('cat2docs', None)
+        if 'category_models' in self.__dict__:
+            self.category_models.update(added_index, added_categories, removed_index, removed_categories)
+            self._unsaved['category_models'] = self.lm_paths['category_models']
+        if 'facet_index' in self.__dict__:
+            self.facet_index.update(added_categories, removed_categories)
+            self._unsaved['facet_index'] = self.facet_paths['facet_index']
+
+        self._n_updates += 1
+        if self._n_updates >= self.flush_updates:
+            self.flush()
 
     def _handle_wildcards(self, raw_query):
-        for word in tokenize(raw_query.lower()):
-            if word.find('*') != -1:
-                return spell_checking.generate_wildcard_options(word, self.k_gram_index)
-        return []
+        """
+        Finds wildcard words of a query and dictionary words matching them, at most
+        max_wildcard_terms most frequent ones for each wildcard
+        :return: tuple (query text without wildcard words, dict wildcard:[word1, word2, ...])
+        """
+        options = {}
+        for word in wildcard_pattern.findall(raw_query):
+            wildcard = ''.join(c for c in word.lower() if c.isalpha() or c == '*')
+            words = spell_checking.generate_wildcard_options(wildcard, self.wildcard_index)
+            words.sort(key=lambda w: -self.dictionary.get(w, 0))
+            options[wildcard] = words[:self.max_wildcard_terms]
+        return wildcard_pattern.sub(' ', raw_query), options
     
-    def _handle_soundex(self, query):
+    def _handle_spelling(self, text):
+        """
+        Finds corrections of query words which are not in the index
+        :return: dict word:[correction1, correction2, ...], best corrections first
+        """
         errors = {}
-        for word in query:
-            if word not in self.inv_index:
-                word_code = spell_checking.produce_soundex_code(word)
-                if word_code in self.soundex_index:
-                    for corr in self.soundex_index[word_code]:
-                        if word in errors:
-                            errors[word].append(corr)
-                        else:
-                            errors[word] = [corr]
+        for word in self.analyzer.preprocess(text, use_stem=False):
+            if word not in errors and self.analyzer.stem(word) not in self.inv_index:
+                corrections = self.spelling_index.lookup(word, self.dictionary, self.max_edit_distance)
+                if len(corrections) != 0:
+                    errors[word] = corrections
         
         return errors
 
     def _answer_inexact(self, query, top_k, scoring='okapi'):
-        doc_ids = inexact.filter_docs(query, self.high_low_index, top_k)
+        doc_ids = inexact.filter_docs(query, self.tiered_index, top_k)
         if scoring == 'lm':
-            score_fun = partial(language_model.lm_rank_documents, 
-                                smoothing='additive', param=0.1)
+            return language_model.lm_rank_documents(query, doc_ids, self.stats, self.tiered_index,
+                                                    self.lm_smoothing, self.lm_param)
         elif scoring == 'cosine':
             score_fun = inexact.cosine_scoring_docs
         else:
             score_fun = inexact.okapi_scoring_docs
-        return score_fun(query, doc_ids, self.doc_lengths, self.high_low_index)
+        return score_fun(query, doc_ids, self.stats, self.tiered_index, top_k)
+
+    def _answer_vectorized(self, query, top_k, scoring, do_inexact=False, phrase_query=None, 
+                           cache=None, allowed=None):
+        """
+        Same as scoring with okapi, cosine or lm (smoothing given by lm_smoothing), but all
+        postings of a term are scored at once with array operations and top_k is selected
+        with np.argpartition. Without do_inexact lm scores all documents with any of query terms
+        :param scoring: 'okapi', 'cosine' or 'lm', with or without '_np' suffix
+        :param phrase_query: phrases query, if set, phrases are searched with okapi or cosine
+                             as terms, their postings are found in the positional index
+        :param cache: dictionary to keep postings of terms between calls for a batch of queries
+        :param allowed: facets.Bitmap of documents passing a filter, only they are scored
+        :return: list of (-score, doc_id) of top_k documents, best first
+        """
+        doc_ids, scores = self._score_vectorized(query, top_k, scoring, do_inexact, phrase_query, 
+                                                 cache, allowed)
+        return vectorized.top_k(doc_ids, scores, top_k)
+
+    def _score_vectorized(self, query, top_k, scoring, do_inexact=False, phrase_query=None, 
+                          cache=None, allowed=None, matches=None):
+        """
+        Scores of _answer_vectorized before top_k is selected, inexact okapi and cosine
+        score only the top_k documents they find in the tiers
+        :param matches: dictionary to keep lm matches of terms in the scored documents,
+                        see vectorized.lm_scores
+        :return: tuple of numpy arrays (doc_ids, scores)
+        """
+        if scoring.endswith('_np'):
+            scoring = scoring[:-len('_np')]
+        if phrase_query is not None:
+            query, index = phrase_query, self.phrase_index
+        else:
+            index = self.inv_index
+
+        # okapi and cosine inexact scoring reads the tiers, lm reads full postings of candidates
+        if do_inexact and scoring != 'lm':
+            doc_ids = inexact.filter_docs(query, self.tiered_index, top_k, allowed)
+            return inexact.top_k_docs(query, doc_ids, self.stats, self.tiered_index, top_k, scoring)
+
+        cache_key = 'index' if phrase_query is None else 'phrases'
+        index_cache = cache.setdefault(cache_key, {}) if cache is not None else None
+        postings = vectorized.query_postings(query, index, self._term_stats(index), index_cache)
+        if allowed is not None:
+            postings = vectorized.restrict_postings(postings, allowed)
+
+        if scoring == 'lm' and phrase_query is None:
+            if do_inexact:
+                doc_ids = inexact.filter_docs(query, self.tiered_index, top_k, allowed)
+            else:
+                doc_ids = vectorized.posting_docs(postings)
+            doc_ids, scores = vectorized.lm_scores(query, doc_ids, postings, self.stats, 
+                                                   self.stats.vocab_size, self.lm_smoothing, 
+                                                   self.lm_param, matches)
+        else:
+            if scoring == 'cosine':
+                doc_ids, scores = vectorized.cosine_scores(query, postings, self.stats)
+            else:
+                doc_ids, scores = vectorized.okapi_scores(postings, self.stats)
+        return doc_ids, scores
+
+    def _answer_expanded(self, query, top_k, scoring, cache=None, allowed=None):
+        """
+        Answers a query expanded with pseudo relevance feedback (see _expand_query) with
+        exhaustive vectorized okapi, cosine or lm. Scores of the expanded query are the scores
+        of the query plus scores of the change of term weights, see _rescore_expanded
+        :return: list of (-score, doc_id) of top_k documents for the expanded query, best first
+        """
+        matches = {}
+        doc_ids, scores = self._score_vectorized(query, top_k, scoring, cache=cache, allowed=allowed, 
+                                                 matches=matches)
+        expanded = self._expand_query(query, vectorized.top_k(doc_ids, scores, top_k))
+        doc_ids, scores = self._rescore_expanded(query, expanded, doc_ids, scores, scoring, cache, 
+                                                 allowed, matches)
+        return vectorized.top_k(doc_ids, scores, top_k)
+
+    def _rescore_expanded(self, query, expanded, doc_ids, scores, scoring, cache=None, allowed=None,
+                          matches=None):
+        """
+        Vectorized okapi, cosine and lm scores are sums of per term contributions linear in
+        term weights, so only terms whose weight changed are scored for the expanded query,
+        okapi does not weight terms, for it only the added terms are scored
+        :param doc_ids: numpy array of all documents scored for query, see _score_vectorized
+        :param scores: numpy array of their scores
+        :param matches: lm matches of query terms in doc_ids, see vectorized.lm_scores
+        :return: tuple of numpy arrays (doc_ids, scores) for the expanded query, doc ids are
+                 not sorted
+        """
+        if scoring.endswith('_np'):
+            scoring = scoring[:-len('_np')]
+        if scoring == 'okapi':
+            delta = dict((term, weight) for term, weight in expanded.items() if term not in query)
+        else:
+            delta = dict((term, weight - query.get(term, 0)) for term, weight in expanded.items()
+                         if weight != query.get(term, 0))
+        if len(delta) == 0:
+            return doc_ids, scores
+        index_cache = cache.setdefault('index', {}) if cache is not None else None
+        postings = vectorized.query_postings(delta, self.inv_index, self.stats, index_cache)
+        if allowed is not None:
+            postings = vectorized.restrict_postings(postings, allowed)
 
-    def _select_scoring_fun(self, scoring):
         if scoring == 'lm':
-            return language_model.lm_rank_documents
-        elif scoring == 'cosine':
-            return inexact.cosine_scoring_docs
+            # lm scores all documents with any of the terms, documents with only added terms
+            # have none of the query terms, they are scored for the expanded query at once
+            _, delta_scores = vectorized.lm_scores(delta, doc_ids, postings, self.stats, 
+                                                   self.stats.vocab_size, self.lm_smoothing, 
+                                                   self.lm_param, matches)
+            added_ids = vectorized.posting_docs([term_postings for term_postings in postings 
+                                                 if term_postings[0] not in query])
+            added_ids = added_ids[~inexact.lookup_sorted(doc_ids, added_ids)[1]]
+            added_ids, added_scores = vectorized.lm_scores(expanded, added_ids, postings, self.stats, 
+                                                           self.stats.vocab_size, self.lm_smoothing, 
+                                                           self.lm_param)
+            return (np.concatenate([doc_ids, added_ids]), 
+                    np.concatenate([scores + delta_scores, added_scores]))
+        if scoring == 'cosine':
+            delta_ids, delta_scores = vectorized.cosine_scores(delta, postings, self.stats)
         else:
-            return inexact.okapi_scoring_docs
+            delta_ids, delta_scores = vectorized.okapi_scores(postings, self.stats)
+        return vectorized.add_scores(doc_ids, scores, delta_ids, delta_scores)
+
+    def _answer_impact(self, query, top_k, allowed=None):
+        """
+        Approximate Okapi BM25 ranking with the impact-ordered index, evaluated score-at-a-time
+        within postings_budget and time_budget, see ImpactIndex.score_at_a_time
+        :param allowed: facets.Bitmap of documents passing a filter, others are dropped
+        :return: list of (-score, doc_id) of top_k documents, best first
+        """
+        deadline = time.monotonic() + self.time_budget if self.time_budget is not None else None
+        # segments may have been merged in the background
+        self.impact_index.update(self.segments.segments, self.stats)
+        doc_ids, scores = self.impact_index.score_at_a_time(query, self.postings_budget, deadline)
+        if allowed is not None:
+            kept = allowed.contains(doc_ids)
+            doc_ids, scores = doc_ids[kept], scores[kept]
+        return vectorized.top_k(doc_ids, scores, top_k)
+
+    def _answer_proximity(self, query, top_k, allowed=None):
+        """
+        Okapi BM25 with term proximity boosts (BM25TP): documents where query terms
+        occur close to each other get extra score, see positions.proximity_scores
+        :param allowed: facets.Bitmap of documents passing a filter, only they are scored
+        :return: list of (-score, doc_id) of top_k documents, best first
+        """
+        postings = vectorized.query_postings(query, self.inv_index, self.stats)
+        if allowed is not None:
+            postings = vectorized.restrict_postings(postings, allowed)
+        doc_ids, scores = vectorized.okapi_scores(postings, self.stats)
+        boost_ids, boosts = positions.proximity_scores(list(query), self.positions, self.stats)
+        # boosted documents contain query terms, they are scored unless filtered out
+        at, found = inexact.lookup_sorted(doc_ids, boost_ids)
+        np.add.at(scores, at[found], boosts[found])
+        return vectorized.top_k(doc_ids, scores, top_k)
 
     def answer_query(self, raw_query, top_k, scoring='okapi', do_inexact=False, summary_len=5, 
-                     use_expansion=False, is_raw=True, do_phrase=False, print_res=True):
+                     use_expansion=False, is_raw=True, do_phrase=False, print_res=True, 
+                     expand_wildcards=True, filters=None):
         start_time = time.time()
-        score_fun =  self._cosine_scoring if scoring == 'cosine' else self._okapi_scoring
+        cache_key = None
         if is_raw:
-            query = preprocess(raw_query)
-            query = Counter(query)
+            text, wcs = self._handle_wildcards(raw_query)
+            terms = self.analyzer.preprocess(text)
+            query = Counter(terms)
             
-            wcs = self._handle_wildcards(raw_query)
-            if len(wcs) != 0:
+            if len(wcs) != 0 and not expand_wildcards:
                 print('\033[92mDid you mean:\033[0m')
-                print(*wcs, sep=', ', end='?')
+                print(*[w for words in wcs.values() for w in words], sep=', ', end='?')
                 return []
+            # a wildcard is searched as OR of the words it matches
+            for wildcard, words in wcs.items():
+                print(f'\033[92m{wildcard}:\033[0m', *words, sep=' ')
+                query.update(set(self.analyzer.stem(w) for w in words))
             
-            sx = self._handle_soundex(query)
-            if len(sx) != 0:
-                print('\033[92mPossible soundex fixes:\033[0m')
+            sx = self._handle_spelling(text)
+            if len(sx) != 0 and not self.auto_correct:
+                print('\033[92mPossible spelling fixes:\033[0m')
                 for w, corr in sx.items():
                     print(f'{w} -> ', end='')
                     print(*corr, sep=', ')
                 return []
-        else:
-            query = raw_query
+            for w, corr in sx.items():
+                print(f'\033[92mSearching for {corr[0]} instead of {w}\033[0m')
+                query[self.analyzer.stem(corr[0])] += query.pop(self.analyzer.stem(w), 1)
 
-        if do_inexact:
-            scores = self._answer_inexact(query, top_k, scoring)#int(top_k / 5), scoring)
-        elif do_phrase and is_raw:
-            _query = preprocess(raw_query)
-            ngrams_query = phrases.find_ngrams_PMI(_query, 0, 1, 2)
-            ngrams_query |= phrases.find_ngrams_PMI(_query, 0, 1, 3)
-            ngrams_query = dict((k, 1) for k in ngrams_query)
-            scores = score_fun(ngrams_query, self.n_gram_index)
+            # expansions of wildcards depend on the dictionary, such queries are never cached.
+            # The key holds the query after spelling correction, phrases are made of the raw terms
+            if not use_expansion and len(wcs) == 0:
+                cache_key = (tuple(terms), tuple(query.items()), scoring, top_k, do_inexact, do_phrase, 
+                             summary_len, filters)
+                cached = self.result_cache.get(cache_key, self.index_version)
+                if cached is not None:
+                    top_k_ids, articles = cached
+                    self._print_answer(raw_query, is_raw, scoring, top_k_ids, articles, 
+                                       print_res, start_time)
+                    return list(top_k_ids)
         else:
-            scores = score_fun(query, self.inv_index)
+            query = raw_query
 
-        
-        h = []
-        for doc_id in scores.keys():
-            neg_score = -scores[doc_id]
-            heapq.heappush(h, (neg_score, doc_id))
+        # documents passing the filter, postings of other documents are never scored
+        allowed = self._filter_docs(filters) if filters is not None else None
+        # postings of query terms are read once for both passes of the expansion
+        cache = {} if use_expansion else None
+        h = self._rank(query, raw_query, top_k, scoring, do_inexact, do_phrase and is_raw, allowed, cache)
+        if use_expansion:
+            # the query is expanded with terms of the best documents and answered again
+            query = self._expand_query(query, heapq.nsmallest(top_k, h))
+            h = self._rank(query, raw_query, top_k, scoring, do_inexact, False, allowed, cache)
         
         # retrieve best matches
         top_k = min(top_k, len(h))  # handling the case when less than top k results are returned
-        if is_raw:
-            print('\033[1m\033[94mANSWERING TO:', raw_query, 'METHOD:', scoring, '\033[0m')
-        else:
-            print('\033[1m\033[94mANSWERING TO:', ' '.join(raw_query.keys()), 'METHOD:', scoring, '\033[0m')
-        print(top_k, "results retrieved")
+        self._print_header(raw_query, is_raw, scoring, top_k)
         top_k_ids = []
         articles = []
         for k in range(top_k):
-            best_so_far = heapq.heappop(h)
-            top_k_ids.append(best_so_far)
-            article = naive_sum(self.documents[best_so_far[1]], raw_query, summary_len, is_raw)
-            article_terms = tokenize(article)
-            intersection = [t for t in article_terms if is_apt_word(t) and stem(t, ps) in query.keys()]
-            for term in intersection:  # highlight terms for visual evaluation
-                article = re.sub(r'(' + term + ')', r'\033[1m\033[91m\1\033[0m', article, flags=re.I)
-            articles.append(article)
+            neg_score, doc_id = heapq.heappop(h)
+            top_k_ids.append((neg_score, self.id_map.doc_ids([doc_id])[0]))
+            snippet = snippets.make_snippet(self.documents[doc_id], self.forward_index[doc_id], 
+                                            query, summary_len)
+            articles.append(snippets.to_ansi(snippet))  # highlight terms for visual evaluation
 
-        if use_expansion:
-            id2doc = dict((k, v) for k, v in zip(top_k_ids, articles))
-            new_query = query_exp.pseudo_relevance_feedback(raw_query, id2doc, self, relevant_n=2)
-            return self.answer_query(new_query, top_k, do_inexact, scoring, summary_len, 
-                                     use_expansion=False, is_raw=False)
+        if cache_key is not None:
+            self.result_cache.put(cache_key, (tuple(top_k_ids), tuple(articles)), self.index_version)
+
+        self._print_articles(articles, print_res, start_time)
+        
+        return top_k_ids
+
+    def _rank(self, query, raw_query, top_k, scoring, do_inexact, do_phrase, allowed=None, cache=None):
+        """
+        Ranks documents for a preprocessed query with the given scoring
+        :param do_phrase: phrases of raw_query are searched instead of terms
+        :param allowed: facets.Bitmap of documents passing a filter, only they are scored
+        :param cache: dictionary to keep postings of terms between calls, see _answer_vectorized
+        :return: heap of (-score, doc_id)
+        """
+        score_fun =  self._cosine_scoring if scoring == 'cosine' else self._okapi_scoring
+        if scoring == 'impact':
+            h = self._answer_impact(query, top_k, allowed)
+        elif scoring == 'proximity':
+            h = self._answer_proximity(query, top_k, allowed)
+        elif (scoring in self.vectorized_scorings or allowed is not None or (scoring == 'lm' and not do_inexact) or
+              (scoring == 'okapi' and not do_inexact and not do_phrase and not self.use_wand)):
+            # exhaustive lm has no per-posting loop scorer, it is scored as in answer_queries,
+            # so is exhaustive okapi unless WAND is asked for
+            phrase_query = self._phrase_query(raw_query) if do_phrase and not do_inexact else None
+            # sorted list is a valid heap
+            h = self._answer_vectorized(query, top_k, scoring, do_inexact, phrase_query, cache, allowed)
+        else:
+            if do_inexact:
+                scores = self._answer_inexact(query, top_k, scoring)#int(top_k / 5), scoring)
+            elif do_phrase:
+                scores = score_fun(self._phrase_query(raw_query), self.phrase_index)
+            elif scoring != 'cosine' and self.use_wand:
+                scores = self._okapi_top_k(query, self.inv_index, top_k)
+            else:
+                scores = score_fun(query, self.inv_index)
+
+            h = []
+            for doc_id in scores.keys():
+                neg_score = -scores[doc_id]
+                heapq.heappush(h, (neg_score, doc_id))
+        return h
+
+    def _expand_query(self, query, ranked, relevant_n=2):
+        """
+        Pseudo relevance feedback, terms of the best documents are added to the query,
+        their vectors are read from the forward index, see query_exp.rocchio
+        :param ranked: list of (-score, doc_id), best first
+        :return: expanded query, dictionary term:weight
+        """
+        return query_exp.pseudo_relevance_feedback(query, [doc_id for _, doc_id in ranked], 
+                                                   self.forward_index, self.stats, relevant_n)
+
+    def _print_header(self, raw_query, is_raw, scoring, n_results):
+        if is_raw:
+            print('\033[1m\033[94mANSWERING TO:', raw_query, 'METHOD:', scoring, '\033[0m')
+        else:
+            print('\033[1m\033[94mANSWERING TO:', ' '.join(raw_query.keys()), 'METHOD:', scoring, '\033[0m')
+        print(n_results, "results retrieved")
 
+    def _print_articles(self, articles, print_res, start_time):
         if print_res:
             for article in articles:
                 print("-------------------------------------------------------")
                 print(article)
 
         print("\n--- Query executed in %.7s seconds ---\n" % (time.time() - start_time))
-        
-        return top_k_ids
+
+    def _print_answer(self, raw_query, is_raw, scoring, top_k_ids, articles, print_res, start_time):
+        self._print_header(raw_query, is_raw, scoring, len(top_k_ids))
+        self._print_articles(articles, print_res, start_time)
+
+    @property
+    def cache_stats(self):
+        """
+        :return: dictionary with hits, misses and size of the query result cache
+        """
+        return {'hits': self.result_cache.hits, 'misses': self.result_cache.misses,
+                'size': len(self.result_cache)}
+
+    def _phrase_query(self, raw_query):
+        """
+        :return: dictionary phrase:1 for all bigrams and trigrams of the query
+        """
+        return dict.fromkeys(phrases.count_ngrams(self.analyzer.preprocess(raw_query)), 1)
+
+    def _filter_docs(self, filters):
+        """
+        :param filters: facet filter, e.g. 'places=usa AND topics=earn', see facets.parse_filter
+        :return: facets.Bitmap of documents passing the filter
+        """
+        return self.facet_index.filter(filters)
+
+    def facet_counts(self, raw_query, filters=None, n=10):
+        """
+        Facet counts of the result set of a query - documents with any of query terms
+        which pass the filter
+        :param filters: facet filter, see facets.parse_filter
+        :param n: number of most frequent values to return for every category tag
+        :return: dict tag:[(value, count), ...], most frequent values first
+        """
+        query = Counter(self.analyzer.preprocess(raw_query))
+        postings = vectorized.query_postings(query, self.inv_index, self.stats)
+        if filters is not None:
+            postings = vectorized.restrict_postings(postings, self._filter_docs(filters))
+        return self.facet_index.counts(vectorized.posting_docs(postings), n)
+
+    def answer_queries(self, queries, top_k, scoring='okapi', do_inexact=False, do_phrase=False,
+                       filters=None, use_expansion=False):
+        """
+        Answers a batch of queries without printing. Queries are preprocessed once,
+        postings of each distinct term are read once for the whole batch and queries
+        are scored with the vectorized scorings (see _answer_vectorized).
+        Terms missing from the index are ignored, no wildcard or spelling suggestions are made
+        :param queries: list of raw query strings
+        :param top_k: number of documents to return for each query
+        :param scoring: 'okapi', 'cosine' or 'lm', '_np' suffix is allowed, 'impact' or 'proximity'
+        :param filters: facet filter applied to all queries, see facets.parse_filter
+        :param use_expansion: queries are expanded with pseudo relevance feedback and answered again,
+                              exhaustive scorings only score the change of the query, see _answer_expanded
+        :return: BatchResult - list of QueryResult(query, doc_ids, scores) in order of queries,
+                 elapsed seconds and throughput in queries per second
+        """
+        start_time = time.time()
+        preprocessed = {}
+        for raw_query in queries:
+            if raw_query not in preprocessed:
+                phrase_query = self._phrase_query(raw_query) if do_phrase and not do_inexact else None
+                preprocessed[raw_query] = (Counter(self.analyzer.preprocess(raw_query)), phrase_query)
+
+        allowed = self._filter_docs(filters) if filters is not None else None
+        cache = {}
+
+        def rank(query, phrase_query):
+            if scoring == 'impact':
+                return self._answer_impact(query, top_k, allowed)
+            elif scoring == 'proximity':
+                return self._answer_proximity(query, top_k, allowed)
+            return self._answer_vectorized(query, top_k, scoring, do_inexact, phrase_query, cache, allowed)
+
+        answers = {}
+        results = []
+        for raw_query in queries:
+            if raw_query not in answers:
+                query, phrase_query = preprocessed[raw_query]
+                if (use_expansion and phrase_query is None and not do_inexact 
+                        and scoring not in ('impact', 'proximity')):
+                    # exhaustive scores of the query are reused for the expanded query
+                    answers[raw_query] = self._answer_expanded(query, top_k, scoring, cache, allowed)
+                else:
+                    answers[raw_query] = rank(query, phrase_query)
+                    if use_expansion:
+                        answers[raw_query] = rank(self._expand_query(query, answers[raw_query]), None)
+            ranked = answers[raw_query]
+            results.append(QueryResult(raw_query, self.id_map.doc_ids([doc_id for _, doc_id in ranked]), 
+                                       [-neg_score for neg_score, _ in ranked]))
+
+        elapsed = time.time() - start_time
+        qps = len(queries) / elapsed if elapsed > 0 else float('inf')
+        return BatchResult(results, elapsed, qps)
+
+    def define_categories(self, raw_query, n=5):
+        """
+        Finds categories the query is probably about, by likelihood of the query in language
+        models of categories, see language_model.lm_define_categories. Cheap enough to route
+        or filter queries online
+        :param n: number of categories to return
+        :return: list of (category, score), best first
+        """
+        query = Counter(self.analyzer.preprocess(raw_query))
+        scores = language_model.lm_define_categories(query, self.category_models, self.stats, 
+                                                     self.lm_smoothing, self.lm_param)
+        return sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:n]
+
+    def get_snippets(self, raw_query, doc_ids, summary_len=5):
+        """
+        Structured summaries of documents for a query, e.g. for results of answer_queries
+        :param raw_query: query string
+        :param doc_ids: list of doc ids
+        :return: list of snippets.Snippet(text, highlights), highlights are (start, end)
+                 character offsets of query words in text
+        """
+        query = Counter(self.analyzer.preprocess(raw_query))
+        return [snippets.make_snippet(self.documents[number], self.forward_index[number], 
+                                      query, summary_len) 
+                for number in self.id_map.numbers(doc_ids).tolist()]
 
     def _okapi_scoring(self, query, index, k1=1.2, b=0.75):
         """
@@ -180,41 +842,65 @@ class SearchEngine(object):
         but calculate IDF as described in chapter 6, using 10 as a base of log
 
         :param query: dictionary - term:frequency
+        :param index: PostingsIndex
         :return: dictionary of scores - doc_id:score
         """
         scores = Counter()
-        avgdl = sum(self.doc_lengths.values()) / len(self.doc_lengths)
+        term_stats = self._term_stats(index)
         for term in query:
-            if term in index:
-                idf = math.log10(len(self.doc_lengths) / (len(index[term]) - 1))
-                for i in range(1, len(index[term])):
-                    doc_id, doc_freq = index[term][i]
+            if term_stats.df(term) > 0:
+                idf = math.log10(self.stats.n_docs / term_stats.df(term))
+                doc_ids, doc_freqs = index.postings(term)
+                norms = self.stats.length_norms(doc_ids, k1, b)
+                for doc_id, doc_freq, norm in zip(doc_ids.tolist(), doc_freqs.tolist(), norms.tolist()):
                     nominator = doc_freq * (k1 + 1)
-                    denominator = (doc_freq + k1 * (1 - b + b * self.doc_lengths[doc_id] / avgdl))
+                    denominator = (doc_freq + norm)
                     scores[doc_id] += idf * nominator / denominator
         
         return dict(scores)
     
+    def _okapi_top_k(self, query, index, top_k, k1=1.2, b=0.75):
+        """
+        Same ranking as _okapi_scoring, but only top_k documents are found and scored,
+        using Block-Max WAND over block maxima precomputed at index time (see wand.py)
+
+        :param query: dictionary - term:frequency
+        :param index: PostingsIndex
+        :return: dictionary of scores of top_k documents - doc_id:score
+        """
+        return wand.okapi_top_k(query, index, self.stats, top_k, k1, b)
+    
     def _cosine_scoring(self, query, index):
         """
         Computes scores for all documents containing any of query terms
         according to the COSINESCORE(q) algorithm from the book (chapter 6)
 
         :param query: dictionary - term:frequency
+        :param index: PostingsIndex
         :return: dictionary of scores - doc_id:score
         """
         scores = Counter()
+        term_stats = self._term_stats(index)
         for term in query:
-            idf = math.log10(len(self.doc_lengths) / (len(index[term]) - 1))
-            for i in range(1, len(index[term])):
-                doc_id, doc_freq = index[term][i]
+            if term_stats.df(term) == 0:
+                continue
+            idf = math.log10(self.stats.n_docs / term_stats.df(term))
+            doc_ids, doc_freqs = index.postings(term)
+            for doc_id, doc_freq in zip(doc_ids.tolist(), doc_freqs.tolist()):
                 scores[doc_id] += doc_freq * query[term] * idf * idf
 
         for doc_id in scores:
-            scores[doc_id] /= self.doc_lengths[doc_id]
+            scores[doc_id] /= self.stats[doc_id]
 
         return dict(scores)
 
+    def _term_stats(self, index):
+        """
+        :return: object with df(term) for index - collection statistics for the main index,
+                 the index itself for others (phrase index)
+        """
+        return self.stats if index is self.inv_index else index
+
     def _is_built(self, path: dict):
         if path is None:
             return False
@@ -228,56 +914,93 @@ class SearchEngine(object):
     def _load_dictionary(self, path):
         dictionary = self._load(path)
         if not dictionary:
-            dictionary = spell_checking.build_dictionary(self.documents)
+            dictionary = spell_checking.build_dictionary(self.documents, self.analyzer)
             self._save(dictionary, path)
         return dictionary
 
-    def _load_k_gram_index(self, path):
+    def _load_wildcard_index(self, path):
         index = self._load(path)
         if not index:
-            index = spell_checking.build_k_gram_index(self.dictionary, 2)
+            index = spell_checking.WildcardIndex(self.dictionary, 2)
             self._save(index, path)
         return index
 
-    def _load_soundex(self, path):
-        soundex = self._load(path)
-        if not soundex:
-            soundex = spell_checking.build_soundex_index(self.dictionary)
-            self._save(soundex, path)
-        return soundex
-    
-    def _load_high_low_index(self, path):
-        high_low = self._load(path)
-        if not high_low:
-            high_low = inexact.build_high_low_index(self.inv_index, 5)
-            self._save(high_low, path)
-        return high_low
-    
-    def _load_n_gram_index(self, path):
+    def _load_spelling_index(self, path):
         index = self._load(path)
         if not index:
-            ngrams = set()
-            docs = {}
-            for doc_id, doc in self.documents.items():
-                prep_doc = preprocess(doc)
-                docs[doc_id] = prep_doc
-                n2grams = phrases.find_ngrams_PMI(prep_doc, 2, 6, 2)
-                n3grams = phrases.find_ngrams_PMI(prep_doc, 2, 12, 3)
-                ngrams = ngrams | (n2grams | n3grams)
-            
-            index = phrases.build_ngram_index(docs, ngrams)
+            index = spell_checking.SpellingIndex(self.dictionary, self.max_edit_distance)
             self._save(index, path)
         return index
     
+    def _load_stats(self, path):
+        stats = self._load(path)
+        if not stats:
+            stats = CollectionStats.build(self.inv_index, self.doc_lengths)
+            self._save(stats, path)
+        return stats
+
+    def _load_category_models(self, path):
+        models = self._load(path)
+        if not models:
+            models = language_model.CategoryModels.build(self.cat2docs, self.inv_index, self.stats)
+            self._save(models, path)
+        return models
+
+    def _load_facet_index(self, path):
+        facet_index = self._load(path)
+        if not facet_index:
+            facet_index = facets.FacetIndex.build(self.segments.categories)
+            self._save(facet_index, path)
+        return facet_index
+
+    def _load_tiered_index(self, path):
+        tiered_index = self._load(path)
+        # the index is rebuilt when tier thresholds were changed
+        if not tiered_index or tiered_index.thresholds != self.tier_thresholds:
+            tiered_index = inexact.TieredIndex.build(self.inv_index, self.tier_thresholds)
+            self._save(tiered_index, path)
+        return tiered_index
+    
+    def _load_impact_index(self, paths):
+        """
+        Impacts of the base segment are kept in files, other segments are indexed on load,
+        see impact.SegmentedImpact
+        """
+        paths = (paths['impact_terms'], paths['impact_segments'], paths['impact_docs'])
+        base = self.segments.segments[0]
+        if not all(os.path.isfile(path) for path in paths):
+            logger.info('Building impact index...')
+            impact.ImpactIndex.build(base.inv_index, self.stats).save(*paths)
+        base_impacts = impact.ImpactIndex.load(*paths, use_mmap=self.use_mmap)
+        impact_index = impact.SegmentedImpact([base], [base_impacts])
+        impact_index.update(self.segments.segments, self.stats)
+        return impact_index
+
     def _save(self, data, path):
-        print(f'Saving {path}')
+        logger.info('Saving %s', path)
         with open(path, 'wb') as fd:
             pickle.dump(data, fd)
+        # the index version the structure was saved at is recorded next to the manifest
+        self.derived_versions[path] = self.index_version
+        self._save_versions()
+
+    def _save_versions(self):
+        versions_path = self.segment_paths['derived_versions']
+        with open(f'{versions_path}.tmp', 'wb') as fd:
+            pickle.dump(self.derived_versions, fd)
+        os.replace(f'{versions_path}.tmp', versions_path)
     
+    def _is_saved(self, path):
+        return os.path.isfile(path) and self.derived_versions.get(path) == self.index_version
+
     def _load(self, path):
+        """
+        :return: pickled structure, None if it is missing or was saved at another index version
+                 (updates were not flushed before exit), so it is built again
+        """
         result = None
-        if os.path.isfile(path):
-            print(f'Loading {path}')
+        if self._is_saved(path):
+            logger.info('Loading %s', path)
             with open(path, 'rb') as fd:
                 result = pickle.load(fd)
         return result
@@ -0,0 +1,378 @@
+import re
+from bisect import bisect_left
+
+import numpy as np
+
+from search_engine import reuters
+from search_engine.inexact import lookup_sorted
+
+_clause = re.compile(r'^(\w+)=(\S+)$')
+
+
+def _array_to_bits(values):
+    words = np.zeros(1 << 10, dtype=np.uint64)
+    np.bitwise_or.at(words, values >> 6, np.uint64(1) << (values & 63).astype(np.uint64))
+    return words
+
+
+def _bits_to_array(words):
+    return np.flatnonzero(np.unpackbits(words.view(np.uint8), bitorder='little')).astype(np.uint16)
+
+
+def _bits_contain(words, values):
+    return ((words[values >> 6] >> (values & 63).astype(np.uint64)) & np.uint64(1)).astype(bool)
+
+
+class Bitmap(object):
+    """
+    Compressed set of doc ids, roaring bitmap: ids are split by their high 16 bits into
+    containers, keys are the sorted high parts. A container with at most array_limit ids
+    is a sorted uint16 array of their low parts, a denser one is a bitset of 65536 bits
+    stored as 1024 uint64 words
+    """
+
+    array_limit = 4096
+
+    def __init__(self, keys=(), containers=()):
+        self.keys = list(keys)
+        self.containers = list(containers)
+
+    @classmethod
+    def from_sorted(cls, doc_ids):
+        """
+        :param doc_ids: sorted numpy array of distinct non-negative doc ids
+        :return: Bitmap
+        """
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        high = doc_ids >> 16
+        starts = np.flatnonzero(np.diff(high, prepend=-1))
+        ends = np.append(starts[1:], len(doc_ids))
+        keys, containers = [], []
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            keys.append(int(high[start]))
+            containers.append(cls._container((doc_ids[start: end] & 0xffff).astype(np.uint16)))
+        return cls(keys, containers)
+
+    @classmethod
+    def _container(cls, values):
+        """
+        :param values: sorted uint16 array
+        :return: container of the most compact kind for values
+        """
+        if len(values) <= cls.array_limit:
+            return values
+        return _array_to_bits(values.astype(np.int64))
+
+    @staticmethod
+    def _is_bits(container):
+        return container.dtype == np.uint64
+
+    @classmethod
+    def _is_empty(cls, container):
+        return not container.any() if cls._is_bits(container) else len(container) == 0
+
+    @classmethod
+    def _values(cls, container):
+        return _bits_to_array(container) if cls._is_bits(container) else container
+
+    @classmethod
+    def _and(cls, a, b):
+        if cls._is_bits(a) and cls._is_bits(b):
+            return cls._container(_bits_to_array(a & b))
+        if cls._is_bits(a):
+            a, b = b, a
+        if cls._is_bits(b):
+            return a[_bits_contain(b, a.astype(np.int64))]
+        return np.intersect1d(a, b, assume_unique=True)
+
+    @classmethod
+    def _or(cls, a, b):
+        if cls._is_bits(a) or cls._is_bits(b):
+            a_bits = a if cls._is_bits(a) else _array_to_bits(a.astype(np.int64))
+            b_bits = b if cls._is_bits(b) else _array_to_bits(b.astype(np.int64))
+            return a_bits | b_bits
+        return cls._container(np.union1d(a, b))
+
+    @classmethod
+    def _sub(cls, a, b):
+        if cls._is_bits(b):
+            values = cls._values(a)
+            return cls._container(values[~_bits_contain(b, values.astype(np.int64))])
+        if cls._is_bits(a):
+            return cls._container(_bits_to_array(a & ~_array_to_bits(b.astype(np.int64))))
+        return np.setdiff1d(a, b, assume_unique=True)
+
+    def _combine(self, other, operation, keep_self, keep_other):
+        keys, containers = [], []
+        mine = dict(zip(self.keys, self.containers))
+        theirs = dict(zip(other.keys, other.containers))
+        for key in sorted(set(mine) | set(theirs)):
+            if key in mine and key in theirs:
+                container = operation(mine[key], theirs[key])
+            elif key in mine and keep_self:
+                container = mine[key]
+            elif key in theirs and keep_other:
+                container = theirs[key]
+            else:
+                continue
+            if not self._is_empty(container):
+                keys.append(key)
+                containers.append(container)
+        return Bitmap(keys, containers)
+
+    def _update(self, doc_ids, operation, keep_other):
+        """
+        Applies operation in place to the containers holding doc_ids, others are not touched
+        """
+        other = Bitmap.from_sorted(doc_ids)
+        for key, container in zip(other.keys, other.containers):
+            i = bisect_left(self.keys, key)
+            if i < len(self.keys) and self.keys[i] == key:
+                container = operation(self.containers[i], container)
+                if self._is_empty(container):
+                    del self.keys[i]
+                    del self.containers[i]
+                else:
+                    self.containers[i] = container
+            elif keep_other:
+                self.keys.insert(i, key)
+                self.containers.insert(i, container)
+
+    def add(self, doc_ids):
+        """
+        :param doc_ids: sorted numpy array of distinct doc ids to add
+        """
+        self._update(doc_ids, self._or, True)
+
+    def discard(self, doc_ids):
+        """
+        :param doc_ids: sorted numpy array of distinct doc ids to remove, absent ones are ignored
+        """
+        self._update(doc_ids, self._sub, False)
+
+    def __and__(self, other):
+        return self._combine(other, self._and, False, False)
+
+    def __or__(self, other):
+        return self._combine(other, self._or, True, True)
+
+    def __sub__(self, other):
+        return self._combine(other, self._sub, True, False)
+
+    def to_array(self):
+        """
+        :return: sorted numpy array of doc ids
+        """
+        parts = [np.zeros(0, dtype=np.int64)]
+        for key, container in zip(self.keys, self.containers):
+            parts.append((key << 16) | self._values(container).astype(np.int64))
+        return np.concatenate(parts)
+
+    def contains(self, doc_ids):
+        """
+        :param doc_ids: sorted numpy array of doc ids
+        :return: boolean numpy array, which of doc_ids are in the bitmap
+        """
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        result = np.zeros(len(doc_ids), dtype=bool)
+        high = doc_ids >> 16
+        starts = np.searchsorted(high, self.keys, side='left').tolist()
+        ends = np.searchsorted(high, self.keys, side='right').tolist()
+        for container, start, end in zip(self.containers, starts, ends):
+            low = doc_ids[start: end] & 0xffff
+            if self._is_bits(container):
+                result[start: end] = _bits_contain(container, low)
+            else:
+                result[start: end] = lookup_sorted(container, low)[1]
+        return result
+
+    def __len__(self):
+        return sum(int(np.unpackbits(container.view(np.uint8)).sum()) if self._is_bits(container)
+                   else len(container) for container in self.containers)
+
+
+def parse_filter(text):
+    """
+    Parses a facet filter like 'places=usa AND topics=earn OR places=uk AND NOT topics=acq',
+    AND binds tighter than OR, NOT negates one clause
+    :param text: filter expression, values are case insensitive
+    :return: list of alternatives, every alternative is a list of (tag, value, negated)
+    """
+    alternatives = [[]]
+    negated = False
+    expect_clause = True
+    for token in text.split():
+        keyword = token.upper()
+        if not expect_clause and keyword in ('AND', 'OR'):
+            if keyword == 'OR':
+                alternatives.append([])
+            expect_clause = True
+        elif expect_clause and keyword == 'NOT' and not negated:
+            negated = True
+        elif expect_clause and _clause.match(token):
+            tag, value = _clause.match(token).groups()
+            if tag.lower() not in reuters.category_tags:
+                raise ValueError(f'Unknown facet: {tag}')
+            alternatives[-1].append((tag.lower(), value.lower(), negated))
+            negated = False
+            expect_clause = False
+        else:
+            raise ValueError(f'Bad filter: {text}')
+    if expect_clause:
+        raise ValueError(f'Bad filter: {text}')
+    return alternatives
+
+
+class FacetIndex(object):
+    """
+    Category values of documents as facets. bitmaps[(tag, value)] is a Bitmap of live
+    documents with the value, all_docs holds every live document. For facet counts
+    values are numbered in sorted order, doc_values[doc_starts[doc_id]: doc_ends[doc_id]]
+    are the value numbers of a document
+    """
+
+    def __init__(self, bitmaps, all_docs, values, doc_starts, doc_ends, doc_values):
+        self.bitmaps = bitmaps
+        self.all_docs = all_docs
+        self.values = values
+        self.doc_starts = doc_starts
+        self.doc_ends = doc_ends
+        self.doc_values = doc_values
+
+    @staticmethod
+    def _doc_facets(doc_categories):
+        """
+        :return: distinct (tag, value) facets of a document
+        """
+        facets = []
+        for tag in reuters.category_tags:
+            for value in doc_categories.get(tag, ()):
+                if (tag, value.lower()) not in facets:
+                    facets.append((tag, value.lower()))
+        return facets
+
+    @classmethod
+    def build(cls, categories):
+        """
+        :param categories: doc_id:{category_tag: [value1, value2, ...]} of live documents
+        :return: FacetIndex
+        """
+        doc_ids = sorted(categories)
+        value_docs = {}
+        doc_value_lists = {}
+        for doc_id in doc_ids:
+            doc_value_lists[doc_id] = cls._doc_facets(categories[doc_id])
+            for facet in doc_value_lists[doc_id]:
+                if facet not in value_docs:
+                    value_docs[facet] = []
+                value_docs[facet].append(doc_id)
+
+        values = sorted(value_docs)
+        numbers = dict((facet, number) for number, facet in enumerate(values))
+        size = doc_ids[-1] + 1 if doc_ids else 0
+        counts = np.zeros(size + 1, dtype=np.int64)
+        for doc_id, doc_values in doc_value_lists.items():
+            counts[doc_id + 1] = len(doc_values)
+        doc_starts = np.cumsum(counts)
+        doc_values = np.array([numbers[facet] for doc_id in doc_ids for facet in doc_value_lists[doc_id]],
+                              dtype=np.int32)
+        bitmaps = dict((facet, Bitmap.from_sorted(np.array(docs, dtype=np.int64)))
+                       for facet, docs in value_docs.items())
+        return cls(bitmaps, Bitmap.from_sorted(np.array(doc_ids, dtype=np.int64)), values,
+                   doc_starts[:-1].copy(), doc_starts[1:].copy(), doc_values)
+
+    def update(self, added, removed):
+        """
+        Updates the index in place when documents are added or removed: their bits are set
+        or cleared in the bitmaps of their values, value numbers of added documents are
+        appended to doc_values. New values are numbered again with the old ones in sorted order
+        :param added: dict doc_id:{category_tag: [value1, ...]} of added documents
+        :param removed: same for removed documents
+        """
+        for doc_id, doc_categories in removed.items():
+            ids = np.array([doc_id], dtype=np.int64)
+            for facet in self._doc_facets(doc_categories):
+                if facet in self.bitmaps:
+                    self.bitmaps[facet].discard(ids)
+                    if len(self.bitmaps[facet].keys) == 0:
+                        del self.bitmaps[facet]
+            if doc_id < len(self.doc_starts):
+                self.doc_ends[doc_id] = self.doc_starts[doc_id]
+        self.all_docs.discard(np.array(sorted(removed), dtype=np.int64))
+        lengths = self.doc_ends - self.doc_starts
+        if 2 * int(lengths.sum()) < len(self.doc_values):
+            # most values belong to removed documents, live ones are moved to the front
+            positions = np.repeat(self.doc_starts - (np.cumsum(lengths) - lengths), lengths) + \
+                np.arange(lengths.sum())
+            self.doc_values = self.doc_values[positions]
+            self.doc_ends = np.cumsum(lengths)
+            self.doc_starts = self.doc_ends - lengths
+        if not added:
+            return
+
+        doc_ids = sorted(added)
+        doc_value_lists = dict((doc_id, self._doc_facets(added[doc_id])) for doc_id in doc_ids)
+        new_values = set(facet for facets in doc_value_lists.values() for facet in facets) - set(self.values)
+        if new_values:
+            values = sorted(set(self.values) | new_values)
+            numbers = dict((facet, number) for number, facet in enumerate(values))
+            renumbered = np.array([numbers[facet] for facet in self.values], dtype=np.int32)
+            self.values = values
+            self.doc_values = renumbered[self.doc_values]
+        numbers = dict((facet, number) for number, facet in enumerate(self.values))
+
+        if doc_ids[-1] >= len(self.doc_starts):
+            grow = doc_ids[-1] + 1 - len(self.doc_starts)
+            self.doc_starts = np.concatenate((self.doc_starts, np.zeros(grow, dtype=np.int64)))
+            self.doc_ends = np.concatenate((self.doc_ends, np.zeros(grow, dtype=np.int64)))
+        appended = []
+        for doc_id in doc_ids:
+            self.doc_starts[doc_id] = len(self.doc_values) + len(appended)
+            appended.extend(numbers[facet] for facet in doc_value_lists[doc_id])
+            self.doc_ends[doc_id] = len(self.doc_values) + len(appended)
+            for facet in doc_value_lists[doc_id]:
+                if facet not in self.bitmaps:
+                    self.bitmaps[facet] = Bitmap()
+                self.bitmaps[facet].add(np.array([doc_id], dtype=np.int64))
+        self.doc_values = np.concatenate((self.doc_values, np.array(appended, dtype=np.int32)))
+        self.all_docs.add(np.array(doc_ids, dtype=np.int64))
+
+    def filter(self, text):
+        """
+        :param text: filter expression, see parse_filter
+        :return: Bitmap of documents matching the filter
+        """
+        result = Bitmap()
+        for alternative in parse_filter(text):
+            positive = [self.bitmaps.get((tag, value), Bitmap())
+                        for tag, value, negated in alternative if not negated]
+            matched = positive[0] if positive else self.all_docs
+            for bitmap in positive[1:]:
+                matched = matched & bitmap
+            for tag, value, negated in alternative:
+                if negated and (tag, value) in self.bitmaps:
+                    matched = matched - self.bitmaps[(tag, value)]
+            result = result | matched
+        return result
+
+    def counts(self, doc_ids, n=10):
+        """
+        Facet counts of a result set
+        :param doc_ids: numpy array of distinct doc ids
+        :param n: number of most frequent values to return for every tag
+        :return: dict tag:[(value, count), ...], most frequent values first
+        """
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        doc_ids = doc_ids[doc_ids < len(self.doc_starts)]
+        starts, ends = self.doc_starts[doc_ids], self.doc_ends[doc_ids]
+        lengths = ends - starts
+        positions = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths) + np.arange(lengths.sum())
+        counts = np.bincount(self.doc_values[positions], minlength=len(self.values))
+        result = dict((tag, []) for tag in reuters.category_tags)
+        for number in np.lexsort((np.arange(len(counts)), -counts)).tolist():
+            if counts[number] == 0:
+                break
+            tag, value = self.values[number]
+            if len(result[tag]) < n:
+                result[tag].append((value, int(counts[number])))
+        return result
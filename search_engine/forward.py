@@ -0,0 +1,169 @@
+from collections import namedtuple
+from collections.abc import Mapping
+from functools import cached_property
+
+import numpy as np
+
+from search_engine.doc_sum import clean_text, get_text_sentences
+from search_engine.storage import load_array, save_array
+from search_engine import utils
+
+# terms - preprocessed terms of the whole document, as indexed - the terms of its sentences in order
+# sentences - list of (start, end, terms, spans) of sentences of clean_text(document),
+#             start and end are character offsets, terms are preprocessed terms of the sentence,
+#             spans - (start, end) character offsets of the word of every term
+AnalyzedDocument = namedtuple('AnalyzedDocument', ['terms', 'sentences'])
+
+doc_dtype = np.dtype([('terms_start', '<i8'), ('terms_end', '<i8'),
+                      ('sent_start', '<i8'), ('sent_end', '<i8')])
+
+sentence_dtype = np.dtype([('char_start', '<i8'), ('char_end', '<i8'),
+                           ('terms_start', '<i8'), ('terms_end', '<i8')])
+
+span_dtype = np.dtype([('start', '<i4'), ('end', '<i4')])
+
+
+def analyze_document(text, analyzer=None):
+    """
+    Runs all text processing query time needs for a document: sentence splitting with
+    preprocessing of every sentence, the document terms are the sentence terms in order
+    :param text: document content
+    :param analyzer: utils.Analyzer, the module one if None
+    :return: AnalyzedDocument
+    """
+    if analyzer is None:
+        analyzer = utils.analyzer
+    cleaned = clean_text(text)
+    sentences = []
+    offset = 0
+    for sentence in get_text_sentences(text):
+        start = cleaned.find(sentence, offset)
+        offset = start + len(sentence)
+        terms = analyzer.spans(sentence)
+        sentences.append((start, offset, [term for term, _, _ in terms],
+                          [(start + term_start, start + term_end) for _, term_start, term_end in terms]))
+    return AnalyzedDocument([term for _, _, terms, _ in sentences for term in terms], sentences)
+
+
+class ForwardIndex(Mapping):
+    """
+    Read-only doc_id:AnalyzedDocument mapping - for every document its terms and sentences,
+    so documents are not tokenized again at query time. Terms are stored as ids into
+    the sorted vocabulary, all sentence id sequences are kept in one terms array.
+    docs[doc_id] holds ranges of the document in terms and sentences arrays - the terms
+    range covers all its sentences, terms_start is -1 for missing ids.
+    spans[i] is the character range of terms[i]
+    """
+
+    def __init__(self, vocab, docs, sentences, terms, spans):
+        self.vocab = vocab
+        self.docs = docs
+        self.sentences = sentences
+        self.terms = terms
+        self.spans = spans
+        self._size = None
+
+    @classmethod
+    def build(cls, analyzed):
+        """
+        :param analyzed: dictionary doc_id:AnalyzedDocument
+        :return: ForwardIndex
+        """
+        vocab = set()
+        for document in analyzed.values():
+            for _, _, sentence_terms, _ in document.sentences:
+                vocab.update(sentence_terms)
+        vocab = sorted(vocab)
+        term_ids = dict((term, term_id) for term_id, term in enumerate(vocab))
+        encoded = [term.encode('utf-8') for term in vocab]
+        width = max([len(term) for term in encoded] + [1])
+
+        size = max(analyzed.keys()) + 1 if analyzed else 0
+        docs = np.full(size, -1, dtype=doc_dtype)
+        sentences = []
+        terms = []
+        spans = []
+        for doc_id in sorted(analyzed):
+            document = analyzed[doc_id]
+            terms_start = len(terms)
+            sent_start = len(sentences)
+            for start, end, sentence_terms, sentence_spans in document.sentences:
+                sentences.append((start, end, len(terms), len(terms) + len(sentence_terms)))
+                terms.extend(term_ids[term] for term in sentence_terms)
+                spans.extend(sentence_spans)
+            docs[doc_id] = (terms_start, len(terms), sent_start, len(sentences))
+
+        return cls(np.array(encoded, dtype=f'S{width}'), docs,
+                   np.array(sentences, dtype=sentence_dtype), np.array(terms, dtype='<i4'),
+                   np.array(spans, dtype=span_dtype))
+
+    def save(self, vocab_path, docs_path, sentences_path, terms_path, spans_path):
+        save_array(self.vocab, vocab_path)
+        save_array(self.docs, docs_path)
+        save_array(self.sentences, sentences_path)
+        save_array(self.terms, terms_path)
+        save_array(self.spans, spans_path)
+
+    @classmethod
+    def load(cls, vocab_path, docs_path, sentences_path, terms_path, spans_path, use_mmap=True):
+        return cls(load_array(vocab_path, use_mmap), load_array(docs_path, use_mmap),
+                   load_array(sentences_path, use_mmap), load_array(terms_path, use_mmap),
+                   load_array(spans_path, use_mmap))
+
+    @cached_property
+    def _vocab_terms(self):
+        return [term.decode('utf-8') for term in np.asarray(self.vocab).tolist()]
+
+    def _decode(self, start, end):
+        vocab_terms = self._vocab_terms
+        return [vocab_terms[term_id] for term_id in self.terms[start: end].tolist()]
+
+    def term_ids(self, doc_id):
+        """
+        :return: numpy array of ids (in vocab) of document terms
+        """
+        terms_start, terms_end, _, _ = self.docs[doc_id].tolist()
+        return self.terms[terms_start: terms_end]
+
+    def term_vectors(self, doc_ids):
+        """
+        Sparse term frequency vectors of documents, read from the terms array at once
+        :param doc_ids: numpy array of doc ids, documents missing from the index have no terms
+        :return: tuple (terms, rows, cols, counts) - list of distinct terms of the documents and
+                 numpy arrays: index of a document in doc_ids, index of a term in terms, frequency
+        """
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        docs = np.asarray(self.docs[doc_ids])
+        starts = docs['terms_start']
+        lengths = docs['terms_end'] - starts
+        positions = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths) + np.arange(lengths.sum())
+        rows = np.repeat(np.arange(len(doc_ids)), lengths)
+        vocab_ids, cols = np.unique(np.asarray(self.terms[positions]), return_inverse=True)
+        # there are few documents, so a dense count of (document, term) pairs is small
+        counts = np.bincount(rows * len(vocab_ids) + cols, minlength=len(doc_ids) * len(vocab_ids))
+        pairs = np.flatnonzero(counts)
+        vocab_terms = self._vocab_terms
+        terms = [vocab_terms[term_id] for term_id in vocab_ids.tolist()]
+        return terms, pairs // max(len(vocab_ids), 1), pairs % max(len(vocab_ids), 1), counts[pairs]
+
+    def __getitem__(self, doc_id):
+        if 0 <= doc_id < len(self.docs):
+            terms_start, terms_end, sent_start, sent_end = self.docs[doc_id].tolist()
+            if terms_start >= 0:
+                sentences = [(char_start, char_end, self._decode(start, end),
+                              self.spans[start: end].tolist())
+                             for char_start, char_end, start, end
+                             in self.sentences[sent_start: sent_end].tolist()]
+                return AnalyzedDocument(self._decode(terms_start, terms_end), sentences)
+        raise KeyError(doc_id)
+
+    def __contains__(self, doc_id):
+        return 0 <= doc_id < len(self.docs) and self.docs[doc_id]['terms_start'] >= 0
+
+    def __iter__(self):
+        return iter(np.flatnonzero(np.asarray(self.docs['terms_start']) >= 0).tolist())
+
+    def __len__(self):
+        if self._size is None:
+            self._size = int(np.count_nonzero(np.asarray(self.docs['terms_start']) >= 0))
+        return self._size
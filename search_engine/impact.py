@@ -0,0 +1,246 @@
+import math
+import time
+
+import numpy as np
+
+from search_engine.postings import Lexicon, bm25_b, bm25_k1
+from search_engine.storage import load_array, map_file, save_array
+
+segment_dtype = np.dtype([('impact', '<u2'), ('offset', '<u8'), ('count', '<u4')])
+
+
+def quantize(scores, max_score, bits):
+    """
+    Maps scores uniformly to integer impacts 1..2^bits - 1, max_score and larger scores
+    get the largest one
+    """
+    levels = (1 << bits) - 1
+    if max_score <= 0:
+        return np.ones(len(scores), dtype=np.int64)
+    return np.clip(np.rint(scores / max_score * levels), 1, levels).astype(np.int64)
+
+
+class ImpactIndex(object):
+    """
+    Impact-ordered inverted index: the Okapi BM25 contribution of every posting is
+    precomputed and quantized to a small integer impact. Postings of a term are grouped
+    into segments of equal impact, segments go from the highest impact to the lowest one,
+    doc ids inside a segment are sorted. Queries are evaluated score-at-a-time - segments
+    of all query terms are processed in decreasing order of impact, so the postings which
+    matter most are read first and evaluation can be stopped at any moment.
+    The term table is a Lexicon, where offset is the first row of the term in segments
+    array and n_bytes is the number of its segments. One impact unit is worth scale of score
+    """
+
+    header_size = 16
+
+    def __init__(self, terms, segments, data, bits=8, scale=1.0):
+        self.terms = terms
+        self.segments = segments
+        self.data = data
+        self.bits = bits
+        self.scale = scale
+
+    @classmethod
+    def build(cls, index, stats, bits=8, k1=bm25_k1, b=bm25_b, scale=None):
+        """
+        :param index: PostingsIndex or SegmentedIndex
+        :param stats: CollectionStats of index
+        :param bits: impacts are quantized to 2^bits - 1 levels
+        :param scale: score of one impact unit, if None the largest score of index
+                      gets the largest impact
+        :return: ImpactIndex
+        """
+        term_scores = {}
+        max_score = 0.0
+        for term in index:
+            df = stats.df(term)
+            if df == 0:
+                continue
+            doc_ids, freqs = index.postings(term)
+            idf = math.log10(stats.n_docs / df)
+            scores = idf * (freqs * (k1 + 1)) / (freqs + stats.length_norms(doc_ids, k1, b))
+            term_scores[term] = (doc_ids, scores)
+            if len(scores):
+                max_score = max(max_score, float(scores.max()))
+        if scale is not None:
+            max_score = scale * ((1 << bits) - 1)
+
+        terms = {}
+        segments = []
+        data = []
+        n_postings = 0
+        for term, (doc_ids, scores) in term_scores.items():
+            impacts = quantize(scores, max_score, bits)
+            # by impact descending, then by doc id
+            order = np.lexsort((doc_ids, -impacts))
+            doc_ids, impacts = doc_ids[order], impacts[order]
+            starts = np.flatnonzero(np.diff(impacts, prepend=-1))
+            counts = np.diff(np.append(starts, len(impacts)))
+            terms[term] = (len(segments), len(starts), len(doc_ids), -1)
+            segments.extend(zip(impacts[starts].tolist(), (starts + n_postings).tolist(), counts.tolist()))
+            data.append(doc_ids.astype('<u4'))
+            n_postings += len(doc_ids)
+
+        data = np.concatenate(data).tobytes() if data else b''
+        return cls(terms, np.array(segments, dtype=segment_dtype), data, bits,
+                   max_score / ((1 << bits) - 1))
+
+    def save(self, terms_path, segments_path, docs_path):
+        """
+        Writes the term table, segments and doc ids. Number of bits and scale are kept
+        in the header of doc ids file
+        """
+        with open(docs_path, 'wb') as fd:
+            header = bytes([self.bits, 0, 0, 0, 0, 0, 0, 0]) + np.float64(self.scale).tobytes()
+            fd.write(header.ljust(self.header_size, b'\0'))
+            fd.write(self.data)
+        Lexicon.build(self.terms).save(terms_path)
+        save_array(self.segments, segments_path)
+
+    @classmethod
+    def load(cls, terms_path, segments_path, docs_path, use_mmap=True):
+        if use_mmap:
+            data = map_file(docs_path)
+        else:
+            with open(docs_path, 'rb') as fd:
+                data = fd.read()
+        bits = data[0]
+        scale = float(np.frombuffer(data, dtype='<f8', count=1, offset=8)[0])
+        return cls(Lexicon.load(terms_path, use_mmap), load_array(segments_path, use_mmap),
+                   memoryview(data)[cls.header_size:], bits, scale)
+
+    def __contains__(self, term):
+        return term in self.terms
+
+    def __len__(self):
+        return len(self.terms)
+
+    def term_segments(self, term):
+        """
+        :return: segments of term, see segment_dtype, highest impact first
+        """
+        first, n_segments, _, _ = self.terms[term]
+        return self.segments[first: first + n_segments]
+
+    def score_at_a_time(self, query, max_postings=None, deadline=None, chunk_size=1 << 14):
+        """
+        Approximate Okapi BM25 scores, see score_at_a_time
+        :return: tuple of numpy arrays (doc_ids, scores)
+        """
+        return score_at_a_time([(self, None)], query, max_postings, deadline, chunk_size)
+
+
+def score_at_a_time(parts, query, max_postings=None, deadline=None, chunk_size=1 << 14):
+    """
+    Approximate Okapi BM25 scores. Segments of query terms in all parts are processed from the
+    highest impact (times query term weight) to the lowest, until all are done,
+    max_postings postings are processed or the deadline passes. The deadline is
+    checked after every chunk_size postings
+    :param parts: list of (ImpactIndex, live), all indexes have the same scale. live is None
+                  or a function giving a boolean numpy array, which of doc ids are not deleted
+    :param query: dictionary term:weight, weights are rounded to ints
+    :param max_postings: budget of postings to process, None for no limit
+    :param deadline: time.monotonic() value to stop at, None for no limit
+    :return: tuple of numpy arrays (doc_ids, scores)
+    """
+    segments, weights = [np.zeros(0, dtype=segment_dtype)], [np.zeros(0, dtype=np.int64)]
+    owners = [np.zeros(0, dtype=np.int64)]
+    for number, (index, _) in enumerate(parts):
+        for term, weight in query.items():
+            if term in index.terms:
+                term_segments = index.term_segments(term)
+                segments.append(term_segments)
+                weights.append(term_segments['impact'].astype(np.int64) * max(1, int(round(weight))))
+                owners.append(np.full(len(term_segments), number))
+    segments, weights, owners = np.concatenate(segments), np.concatenate(weights), np.concatenate(owners)
+    order = np.argsort(-weights, kind='stable')
+    offsets = segments['offset'][order].astype(np.int64)
+    counts = segments['count'][order].astype(np.int64)
+    weights, owners = weights[order], owners[order]
+
+    ends = np.cumsum(counts)
+    if max_postings is not None and len(ends) and ends[-1] > max_postings:
+        last = int(np.searchsorted(ends, max_postings))
+        offsets, counts, weights = offsets[:last + 1], counts[:last + 1].copy(), weights[:last + 1]
+        owners = owners[:last + 1]
+        counts[last] -= ends[last] - max_postings
+        ends = np.cumsum(counts)
+
+    all_doc_ids = [np.frombuffer(index.data, dtype='<u4') for index, _ in parts]
+    doc_ids, doc_weights = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.float64)]
+    start = 0
+    while start < len(counts):
+        if deadline is not None and time.monotonic() >= deadline:
+            break
+        # runs up to the one which crosses the next chunk boundary
+        stop = int(np.searchsorted(ends, ends[start] - counts[start] + chunk_size)) + 1
+        run_counts = counts[start: stop]
+        # position of every posting: its run offset plus its index inside the run
+        run_starts = np.cumsum(run_counts) - run_counts
+        positions = (np.repeat(offsets[start: stop] - run_starts, run_counts) + 
+                     np.arange(int(run_counts.sum())))
+        posting_owners = np.repeat(owners[start: stop], run_counts)
+        posting_weights = np.repeat(weights[start: stop], run_counts).astype(np.float64)
+        for number in np.unique(posting_owners).tolist():
+            held = posting_owners == number if len(parts) > 1 else slice(None)
+            part_ids = all_doc_ids[number][positions[held]].astype(np.int64)
+            part_weights = posting_weights[held]
+            live = parts[number][1]
+            if live is not None:
+                kept = live(part_ids)
+                part_ids, part_weights = part_ids[kept], part_weights[kept]
+            doc_ids.append(part_ids)
+            doc_weights.append(part_weights)
+        start = stop
+
+    doc_ids = np.concatenate(doc_ids)
+    if len(doc_ids) == 0:
+        return doc_ids, np.zeros(0, dtype=np.float64)
+    # doc ids are dense numbers below the number of documents (see storage.DocIdMap),
+    # so summing them by counting takes memory proportional to the collection only
+    sums = np.bincount(doc_ids, weights=np.concatenate(doc_weights))
+    unique_ids = np.flatnonzero(np.bincount(doc_ids))
+    return unique_ids, sums[unique_ids] * parts[0][0].scale
+
+
+class SegmentedImpact(object):
+    """
+    Impact-ordered index over the segments of the index, one ImpactIndex per segment.
+    All of them are quantized with the scale of the first one, so impacts of different
+    segments are comparable and a new segment is indexed without touching the others.
+    Impacts of a segment are computed with collection statistics at the time it is indexed,
+    postings of deleted documents are dropped while scoring
+    """
+
+    def __init__(self, segments, indexes):
+        """
+        :param segments: list of segments.Segment
+        :param indexes: ImpactIndex of every segment
+        """
+        self.segments = list(segments)
+        self.indexes = list(indexes)
+
+    def update(self, segments, stats):
+        """
+        Follows changes of the segment list: indexes of merged segments are dropped,
+        new segments are indexed
+        :param segments: current list of segments.Segment, the first one is not changed
+        :param stats: CollectionStats
+        """
+        if segments == self.segments:
+            return
+        known = dict(zip(self.segments, self.indexes))
+        scale, bits = self.indexes[0].scale, self.indexes[0].bits
+        self.indexes = [known[seg] if seg in known
+                        else ImpactIndex.build(seg.inv_index, stats, bits, scale=scale) for seg in segments]
+        self.segments = list(segments)
+
+    def score_at_a_time(self, query, max_postings=None, deadline=None, chunk_size=1 << 14):
+        """
+        Approximate Okapi BM25 scores of live documents, see score_at_a_time
+        :return: tuple of numpy arrays (doc_ids, scores)
+        """
+        parts = [(index, seg.live_mask if seg.deleted else None)
+                 for seg, index in zip(self.segments, self.indexes)]
+        return score_at_a_time(parts, query, max_postings, deadline, chunk_size)
@@ -1,81 +1,229 @@
-import os
+import logging
+import multiprocessing
 import pickle
-from bs4 import BeautifulSoup
+from functools import partial
+from search_engine import reuters
+from search_engine.forward import ForwardIndex, analyze_document
+from search_engine.positions import PositionalIndex
+from search_engine.postings import PostingsIndex
+from search_engine.storage import DocIdMap, DocLengths, DocumentStore
+from search_engine import utils
 from search_engine.utils import preprocess
 
-def build_inverted_index(path, save_paths):
+logger = logging.getLogger(__name__)
+
+
+def add_to_index(index, doc_id, text, doc_terms=None):
+    """
+    Adds postings of one document to a partial index
+    :param index: term:([doc_id_1, doc_id_2, ...], [doc_freq_1, doc_freq_2, ...])
+    :param doc_id: id of the document
+    :param text: document content
+    :param doc_terms: preprocessed text, if it is already known
+    :return: document length
+    """
+    if doc_terms is None:
+        doc_terms = preprocess(text)
+
+    tf = {}
+    for term in doc_terms:
+        if term in tf:
+            tf[term] += 1
+        else:
+            tf[term] = 1
+    
+    for term in tf:
+        if term not in index:
+            index[term] = ([], [])
+        index[term][0].append(doc_id)
+        index[term][1].append(tf[term])
+
+    return len(doc_terms)
+
+
+def index_documents(documents, analyzed=None, analyzer=None):
+    """
+    Builds partial index for documents given as text
+    :param documents: dictionary doc_id:doc_content
+    :param analyzed: dictionary doc_id:AnalyzedDocument, documents are analyzed if it is None
+    :param analyzer: utils.Analyzer documents are analyzed with, the module one if None
+    :return: tuple (index, doc_lengths, analyzed)
+    """
+    index = {}
+    doc_lengths = {}
+    if analyzed is None:
+        analyzed = dict((doc_id, analyze_document(text, analyzer)) for doc_id, text in documents.items())
+    for doc_id, text in documents.items():
+        doc_lengths[doc_id] = add_to_index(index, doc_id, text, analyzed[doc_id].terms)
+    return index, doc_lengths, analyzed
+
+
+def index_file(filepath, analyzer=None):
+    """
+    Parses one reuters file and builds partial index for its documents
+    :param filepath: path to .sgm file
+    :param analyzer: utils.Analyzer, the module one if None
+    :return: tuple (index, doc_lengths, documents, categories, analyzed), where
+             index - term:([doc_id_1, doc_id_2, ...], [doc_freq_1, doc_freq_2, ...])
+             categories - doc_id:{category_tag: [value1, value2, ...]}
+             analyzed - doc_id:AnalyzedDocument
+    """
+    index = {}
+    doc_lengths = {}
+    documents = {}
+    categories = {}
+    analyzed = {}
+
+    for document in reuters.iter_documents(filepath):
+        doc_id = document.newid
+        doc_title = document.title
+        doc_body = document.body
+        categories[doc_id] = document.categories
+
+        ext_document = ''
+        if (doc_title == '') or (doc_body == ''):
+            ext_document = doc_title + doc_body
+        else:
+            ext_document = doc_title + '\n' + doc_body
+        documents[doc_id] = ext_document
+        analyzed[doc_id] = analyze_document(ext_document, analyzer)
+        doc_lengths[doc_id] = add_to_index(index, doc_id, ext_document, analyzed[doc_id].terms)
+
+    return index, doc_lengths, documents, categories, analyzed
+
+
+def build_inverted_index(path, save_paths, compression=None, workers=1, analyzer=None):
     """
     # principal function - builds an index of terms in all documents
-    # generates 3 dictionaries and saves on disk as separate files:
-    # index - term:[term_frequency, (doc_id_1, doc_freq_1), (doc_id_2, doc_freq_2), ...]
-    # doc_lengths - doc_id:doc_length
-    # documents - doc_id: doc_content_clean
+    # documents are numbered densely in order of their NEWIDs, all structures below
+    # are indexed by these numbers, the map of numbers to NEWIDs is saved as doc_ids
+    # generates 4 structures and saves on disk as separate files:
+    # index - compact PostingsIndex, term dictionary + postings buffer
+    #         (doc ids delta-encoded, see postings.py) + block maxima for top-k pruning
+    # doc_lengths - doc_id:doc_length, array indexed by doc_id
+    # documents - doc_id: doc_content_clean, block-compressed store apart from the index,
+    #             see storage.DocumentStore
+    # categories - doc_id:{category_tag: [value1, ...]}, pickled
+    # forward index - terms and sentences of every document, see forward.py
+    # positions - positional index, term -> doc -> positions, see positions.py
+    # Files are indexed separately (in a process pool if workers > 1) and partial
+    # indexes are merged in file order, so result does not depend on workers
     :param path: path to directory with original reuters files
-    :param limit: number of articles to process, for testing. If limit is not None,
-                  return index when done, without writing files to disk
+    :param save_paths: dictionary with 'doc_ids', 'inv_index', 'postings', 'blocks', 'doc_lengths',
+                       'documents', 'doc_offsets', 'doc_blocks', 'categories',
+                       'positions_terms', 'positions' and 'forward_*' paths
+    :param compression: None for raw uint32 postings or 'vbyte'
+    :param workers: number of processes to parse and tokenize files with
+    :param analyzer: utils.Analyzer, the module one if None
     """
-    print('Building index...')
+    logger.info('Building index...')
     index = {}
     doc_lengths = {}
     documents = {}
-    
-    for filename in sorted(os.listdir(path)):
-        if filename.endswith('.sgm'):
-            with open(path + filename, 'r', encoding='latin1') as file:
-                file_content = file.read()
-                parsed = BeautifulSoup(file_content, 'html.parser')
-                file_documents = parsed.find_all('reuters')
-
-                for document in file_documents:
-                    doc_id = int(document['newid'])
-                    doc_title = document.title.text if document.title else ''
-                    doc_body = document.body.text if document.body else ''
-
-                    ext_document = ''
-                    if (doc_title == '') or (doc_body == ''):
-                        ext_document = doc_title + doc_body
-                    else:
-                        ext_document = doc_title + '\n' + doc_body
-                    documents[doc_id] = ext_document
-
-                    doc_terms = preprocess(ext_document)
-                    doc_lengths[doc_id] = len(doc_terms)
-
-                    tf = {}
-                    for term in doc_terms:
-                        if term in tf:
-                            tf[term] += 1
-                        else:
-                            tf[term] = 1
-                    
-                    for term in tf:
-                        if term in index:
-                            index[term][0] += 1
-                        else:
-                            index[term] = [1]
-                        index[term].append((doc_id, tf[term]))
-                    
-    with open(save_paths['inv_index'], 'wb') as dump_file:
-        pickle.dump(index, dump_file)
-    
-    with open(save_paths['doc_lengths'], 'wb') as dump_file:
-        pickle.dump(doc_lengths, dump_file)
+    categories = {}
+    analyzed = {}
 
-    with open(save_paths['documents'], 'wb') as dump_file:
-        pickle.dump(documents, dump_file)
+    filepaths = reuters.list_files(path)
     
-    print('Index was built!')
+    if analyzer is None:
+        analyzer = utils.analyzer
+    if workers > 1:
+        # workers use the same analyzer settings, whatever the process start method is
+        pool = multiprocessing.Pool(workers, initializer=utils.set_analyzer, 
+                                    initargs=(analyzer.tokenizer,))
+        partials = pool.imap(index_file, filepaths)
+    else:
+        pool = None
+        partials = map(partial(index_file, analyzer=analyzer), filepaths)
+
+    try:
+        for file_index, file_doc_lengths, file_documents, file_categories, file_analyzed in partials:
+            for term, (doc_ids, freqs) in file_index.items():
+                if term not in index:
+                    index[term] = ([], [])
+                index[term][0].extend(doc_ids)
+                index[term][1].extend(freqs)
+            doc_lengths.update(file_doc_lengths)
+            documents.update(file_documents)
+            categories.update(file_categories)
+            analyzed.update(file_analyzed)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    id_map = DocIdMap.build(doc_lengths)
+    id_map.save(save_paths['doc_ids'])
+    save_index(*renumber(id_map, index, doc_lengths, documents, categories, analyzed), 
+               save_paths, compression)
+    logger.info('Index was built!')
+
+
+def renumber(id_map, index, doc_lengths, documents, categories, analyzed):
+    """
+    Replaces external doc ids of index structures with their numbers in id_map
+    :param id_map: storage.DocIdMap with all doc ids of the structures
+    :return: tuple (index, doc_lengths, documents, categories, analyzed)
+    """
+    def by_number(mapping):
+        return dict(zip(id_map.numbers(list(mapping)).tolist(), mapping.values()))
+
+    index = dict((term, (id_map.numbers(doc_ids).tolist(), freqs)) 
+                 for term, (doc_ids, freqs) in index.items())
+    return (index, by_number(doc_lengths), by_number(documents), by_number(categories), 
+            by_number(analyzed))
+
+
+def save_index(index, doc_lengths, documents, categories, analyzed, save_paths, compression=None):
+    """
+    Writes index files, see build_inverted_index for the description of structures
+    :param index: term:([doc_id_1, doc_id_2, ...], [doc_freq_1, doc_freq_2, ...])
+    :param analyzed: doc_id:AnalyzedDocument
+    """
+    index = PostingsIndex.build(index, compression, doc_lengths)
+    index.save(save_paths['inv_index'], save_paths['postings'], save_paths['blocks'])
     
+    DocLengths.build(doc_lengths).save(save_paths['doc_lengths'])
+    DocumentStore.write(documents, save_paths['doc_offsets'], save_paths['doc_blocks'], 
+                        save_paths['documents'])
+
+    with open(save_paths['categories'], 'wb') as dump_file:
+        pickle.dump(categories, dump_file)
 
-def load_index(save_paths):
-    print('Loading index...')
-    with open(save_paths['inv_index'], 'rb') as fp:
-        index = pickle.load(fp)
+    ForwardIndex.build(analyzed).save(save_paths['forward_vocab'], save_paths['forward_docs'],
+                                      save_paths['forward_sentences'], save_paths['forward_terms'],
+                                      save_paths['forward_spans'])
+    PositionalIndex.build(analyzed).save(save_paths['positions_terms'], save_paths['positions'])
     
-    with open(save_paths['doc_lengths'], 'rb') as fp:
-        doc_lengths = pickle.load(fp)
 
-    with open(save_paths['documents'], 'rb') as fp:
-        documents = pickle.load(fp)
-    print('Index was loaded!')
-    return index, doc_lengths, documents
\ No newline at end of file
+def load_index(save_paths, use_mmap=True):
+    """
+    Opens index files. With use_mmap nothing is read eagerly - postings, doc lengths
+    and documents are memory-mapped and paged in when queries touch them, the pages
+    are shared by all processes using the same index
+    :return: tuple (PostingsIndex, DocLengths, DocumentStore)
+    """
+    logger.info('Loading index...')
+    index = PostingsIndex.load(save_paths['inv_index'], save_paths['postings'], 
+                               save_paths['blocks'], use_mmap)
+    doc_lengths = DocLengths.load(save_paths['doc_lengths'], use_mmap)
+    documents = DocumentStore.load(save_paths['doc_offsets'], save_paths['doc_blocks'], 
+                                   save_paths['documents'], use_mmap)
+    logger.info('Index was loaded!')
+    return index, doc_lengths, documents
+
+
+def load_forward_index(save_paths, use_mmap=True):
+    """
+    :return: ForwardIndex saved with the index
+    """
+    return ForwardIndex.load(save_paths['forward_vocab'], save_paths['forward_docs'],
+                             save_paths['forward_sentences'], save_paths['forward_terms'],
+                             save_paths['forward_spans'], use_mmap)
+
+
+def load_positions(save_paths, use_mmap=True):
+    """
+    :return: PositionalIndex saved with the index
+    """
+    return PositionalIndex.load(save_paths['positions_terms'], save_paths['positions'], use_mmap)
\ No newline at end of file
@@ -1,155 +1,327 @@
 import math
+from collections.abc import Mapping
 
+import numpy as np
 
-def build_high_low_index(index, freq_thresh):
-    """
-    Build high-low index based on standard inverted index.
-    Based on the frequency threshold, for each term doc_ids are are either put into "high list" -
-    if term frequency in it is >= freq_thresh, or in "low list", otherwise.
-    high_low_index should return a python dictionary, with terms as keys.
-    The structure is different from that of standard index - for each term
-    there is a list - [high_dict, low_dict, len(high_dict) + len(low_dict)],
-    the latter is document frequency of a term. high_dict, as well as low_dict,
-    are python dictionaries, with entries of the form doc_id : term_frequency
-    :param index: inverted index
-    :param freq_thresh: threshold on term frequency
-    :return: dictionary
-    """
-    result = {}
-    
-    for term in index:
-        result[term] = [{}, {}, -1]
-        post_list = index[term]
-        for i in range(1, len(post_list)):
-            doc_id, freq = post_list[i]
-            if freq >= freq_thresh:
-                result[term][0][doc_id] = freq
-            else:
-                result[term][1][doc_id] = freq
-        result[term][2] = len(result[term][0]) + len(result[term][1])
-    
+
+class TieredIndex(Mapping):
+    """
+    Inverted index split into tiers by term frequency. thresholds are sorted in decreasing
+    order, tier i of a term holds documents with thresholds[i - 1] > tf >= thresholds[i],
+    the last tier holds the rest. With one threshold it is the classic high-low index.
+    term:[(doc_ids, freqs, max_freq), ...] for every tier, doc_ids are sorted numpy arrays
+    """
+
+    def __init__(self, thresholds=(5,)):
+        self.thresholds = tuple(sorted(thresholds, reverse=True))
+        self.terms = {}
+        self.dfs = {}
+
+    @classmethod
+    def build(cls, index, thresholds=(5,)):
+        """
+        :param index: inverted index, PostingsIndex or SegmentedIndex
+        :param thresholds: tier thresholds on term frequency
+        :return: TieredIndex
+        """
+        tiered_index = cls(thresholds)
+        for term in index:
+            doc_ids, freqs = index.postings(term)
+            # all documents of a term may be deleted, as update does such terms are dropped
+            if len(doc_ids) > 0:
+                tiered_index._set(term, doc_ids, freqs)
+        return tiered_index
+
+    @property
+    def n_tiers(self):
+        return len(self.thresholds) + 1
+
+    def _set(self, term, doc_ids, freqs):
+        """
+        Splits postings of a term into tiers
+        :param doc_ids: sorted numpy array of doc ids
+        :param freqs: numpy array of term frequencies
+        """
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        freqs = np.asarray(freqs, dtype=np.int64)
+        ascending = np.array(self.thresholds[::-1], dtype=np.int64)
+        tier_ids = len(ascending) - np.searchsorted(ascending, freqs, side='right')
+        tiers = []
+        for tier in range(self.n_tiers):
+            in_tier = tier_ids == tier
+            tier_freqs = freqs[in_tier]
+            tiers.append((doc_ids[in_tier], tier_freqs, int(tier_freqs.max()) if len(tier_freqs) else 0))
+        self.terms[term] = tiers
+        self.dfs[term] = len(doc_ids)
+
+    def update(self, added, removed):
+        """
+        Updates tiers in place when documents are added or removed
+        :param added: postings of added documents, term:([doc_id_1, ...], [doc_freq_1, ...])
+        :param removed: postings of removed documents, same format
+        """
+        for term, (doc_ids, _) in removed.items():
+            if term in self.terms:
+                term_doc_ids, term_freqs = self.postings(term)
+                live = ~np.isin(term_doc_ids, np.asarray(doc_ids, dtype=np.int64))
+                if live.any():
+                    self._set(term, term_doc_ids[live], term_freqs[live])
+                else:
+                    del self.terms[term]
+                    del self.dfs[term]
+
+        for term, (doc_ids, freqs) in added.items():
+            doc_ids = np.asarray(doc_ids, dtype=np.int64)
+            freqs = np.asarray(freqs, dtype=np.int64)
+            if term in self.terms:
+                term_doc_ids, term_freqs = self.postings(term)
+                doc_ids = np.concatenate((term_doc_ids, doc_ids))
+                freqs = np.concatenate((term_freqs, freqs))
+            order = np.argsort(doc_ids, kind='stable')
+            self._set(term, doc_ids[order], freqs[order])
+
+    def postings(self, term, depth=None):
+        """
+        :param depth: number of first tiers to take, all tiers if None
+        :return: tuple of numpy arrays (doc_ids, freqs) sorted by doc_id
+        """
+        tiers = self.terms[term][:depth]
+        doc_ids = np.concatenate([doc_ids for doc_ids, _, _ in tiers])
+        freqs = np.concatenate([freqs for _, freqs, _ in tiers])
+        order = np.argsort(doc_ids, kind='stable')
+        return doc_ids[order], freqs[order]
+
+    def df(self, term):
+        return self.dfs.get(term, 0)
+
+    def freqs(self, term, doc_ids):
+        """
+        :param doc_ids: sorted numpy array of doc ids
+        :return: numpy array of frequencies of term in doc_ids, 0 where term is missing
+        """
+        result = np.zeros(len(doc_ids), dtype=np.int64)
+        if term in self.terms:
+            for tier_doc_ids, tier_freqs, _ in self.terms[term]:
+                positions, found = lookup_sorted(tier_doc_ids, doc_ids)
+                result[found] = tier_freqs[positions[found]]
+        return result
+
+    def __getitem__(self, term):
+        return self.terms[term]
+
+    def __contains__(self, term):
+        return term in self.terms
+
+    def __iter__(self):
+        return iter(self.terms)
+
+    def __len__(self):
+        return len(self.terms)
+
+
+def lookup_sorted(haystack, needles):
+    """
+    Binary searches every needle in haystack, both are sorted numpy arrays. The smaller
+    array should be given as needles, then the cost is O(len(needles) * log(len(haystack)))
+    :return: tuple (positions, found) - positions of needles in haystack, boolean mask
+             of needles that are present
+    """
+    positions = np.searchsorted(haystack, needles)
+    found = positions < len(haystack)
+    found[found] = haystack[positions[found]] == needles[found]
+    return positions, found
+
+
+def intersect_sorted(arrays):
+    """
+    Intersection of sorted numpy arrays, starting from the shortest one. The result is
+    searched in every next array with binary search, it only gets shorter
+    """
+    arrays = sorted(arrays, key=len)
+    result = arrays[0]
+    for array in arrays[1:]:
+        if len(result) == 0:
+            break
+        _, found = lookup_sorted(array, result)
+        result = result[found]
     return result
-    
-
-def filter_docs(query, high_low_index, min_n_docs):
-    """
-    Return a set of documents in which query terms are found.
-    You are interested in getting the best documents for a query, therefore you
-    will sequentially check for the following conditions and stop whenever you meet one.
-    For each condition also check if number of documents is  >= min_n_docs.
-    1) We consider only high lists for the query terms and return a set of documents such that each document contains
-    ALL query terms.
-    2) We search in both high and low lists, but still require that each returned document should contain ALL query terms.
-    3) We consider only high lists for the query terms and return a set of documents such that each document contains
-    AT LEAST ONE query term. Actually, a union of high sets.
-    4) At this stage we are fine with both high and low lists, return a set of documents such that each of them contains
-    AT LEAST ONE query term.
 
+
+def union_sorted(arrays, disjoint=False):
+    """
+    :param disjoint: arrays have no common doc ids, as tiers of a term
+    :return: sorted numpy array of doc ids present in any of sorted numpy arrays
+    """
+    arrays = [array for array in arrays if len(array)]
+    if len(arrays) == 0:
+        return np.zeros(0, dtype=np.int64)
+    if len(arrays) == 1:
+        return arrays[0]
+    if disjoint:
+        return np.sort(np.concatenate(arrays))
+    return np.unique(np.concatenate(arrays))
+
+
+def filter_docs(query, tiered_index, min_n_docs, allowed=None):
+    """
+    Return documents in which query terms are found.
+    Candidates are searched in an increasing number of tiers, first requiring documents
+    to contain ALL query terms, then AT LEAST ONE of them. The first candidate set with
+    at least min_n_docs documents is returned. With a high-low index this is:
+    1) documents with all terms in high lists, 2) with all terms in high or low lists,
+    3) with any term in high lists, 4) with any term in high or low lists
     :param query: dictionary term:count
-    :param high_low_index: high-low index you built before
+    :param tiered_index: TieredIndex
     :param min_n_docs: minimum number of documents we want to receive
-    :return: set if doc_ids
-    """
-    result = set()
-    
-    started = False
-    for term in query.keys():
-        term_info = high_low_index[term]    
-        if not started:
-            result = set(term_info[0].keys())
-            started = True
-        else:
-            result = result & set(term_info[0].keys())
-    
-    if len(result) >= min_n_docs:
-        return result
+    :param allowed: if given only these documents are candidates, set of documents with
+                    contains(doc_ids) giving a boolean mask, facets.Bitmap
+    :return: sorted numpy array of doc_ids
+    """
+    if len(query) == 0:
+        return np.zeros(0, dtype=np.int64)
+    # doc ids of a term in its first tiers are extended one tier at a time
+    term_docs = dict((term, [np.zeros(0, dtype=np.int64)]) for term in query)
+    for depth in range(1, tiered_index.n_tiers + 1):
+        for term, levels in term_docs.items():
+            tier_doc_ids = tiered_index[term][depth - 1][0] if term in tiered_index else levels[0]
+            if allowed is not None:
+                tier_doc_ids = tier_doc_ids[allowed.contains(tier_doc_ids)]
+            levels.append(union_sorted([levels[-1], tier_doc_ids], disjoint=True))
+        result = intersect_sorted([levels[depth] for levels in term_docs.values()])
+        if len(result) >= min_n_docs:
+            return result
 
-    started = False
-    for term in query.keys():
-        term_info = high_low_index[term]    
-        if not started:
-            result = set(term_info[0].keys()) | set(term_info[1].keys()) 
-            started = True
-        else:
-            result = result & (set(term_info[0].keys()) | set(term_info[1].keys()))
-    
-    if len(result) >= min_n_docs:
-        return result
+    for depth in range(1, tiered_index.n_tiers + 1):
+        result = union_sorted([levels[depth] for levels in term_docs.values()])
+        if len(result) >= min_n_docs:
+            break
+    return result
 
-    started = False
-    for term in query.keys():
-        term_info = high_low_index[term]    
-        if not started:
-            result = set(term_info[0].keys())
-            started = True
-        else:
-            result = result | set(term_info[0].keys())
-    
-    if len(result) >= min_n_docs:
-        return result
 
-    started = False
-    for term in query.keys():
-        term_info = high_low_index[term]    
-        if not started:
-            result = set(term_info[0].keys()) | set(term_info[1].keys()) 
-            started = True
-        else:
-            result = result | (set(term_info[0].keys()) | set(term_info[1].keys()))
-    
-    if len(result) >= min_n_docs:
-        return result
+def _contributions(scoring, idf, query_count, freqs, norms, k1):
+    if scoring == 'cosine':
+        return freqs * query_count * (idf ** 2)
+    nominator = freqs * (k1 + 1)
+    denominator = (freqs + norms)
+    return idf * nominator / denominator
 
 
+def _finish(scoring, scores, lengths):
+    if scoring == 'cosine':
+        return scores / lengths
+    return scores
+
 
-def cosine_scoring_docs(query, doc_ids, doc_lengths, high_low_index):
+def score_docs(query, doc_ids, stats, tiered_index, scoring='okapi', k1=1.2, b=0.75):
     """
-    Change cosine_scoring function you built in the second lab
-    such that you only score set of doc_ids you get as a parameter,
-    and using high_low_index instead of standard inverted index
+    Scores doc_ids with all their postings, query terms are added in query order
     :param query: dictionary term:count
-    :param doc_ids: set of document ids to score
-    :param doc_lengths: dictionary doc_id:length
-    :param high_low_index: high-low index you built before
-    :return: dictionary of scores, doc_id:score
+    :param doc_ids: sorted numpy array of document ids to score
+    :param stats: CollectionStats, doc_id:length mapping with collection statistics
+    :param tiered_index: TieredIndex
+    :param scoring: 'okapi' or 'cosine'
+    :return: numpy array of scores
     """
-    scores = {}
+    norms = stats.length_norms(doc_ids, k1, b)
+    scores = np.zeros(len(doc_ids), dtype=np.float64)
     for term in query:
-        idf = math.log10(len(doc_lengths) / (high_low_index[term][2]))
-        for doc_id, freq in high_low_index[term][0].items():
-            if doc_id in scores:
-                scores[doc_id] += freq * query[term] * (idf ** 2)
-            else:
-                scores[doc_id] = freq * query[term] * (idf ** 2)
+        if tiered_index.df(term) > 0:
+            idf = math.log10(stats.n_docs / tiered_index.df(term))
+            freqs = tiered_index.freqs(term, doc_ids)
+            contributions = _contributions(scoring, idf, query[term], freqs, norms, k1)
+            scores += np.where(freqs > 0, contributions, 0.0)
+    return _finish(scoring, scores, stats.lookup(doc_ids))
 
-    for doc_id in scores:
-        scores[doc_id] /= doc_lengths[doc_id]
 
-    return scores
+def top_k_docs(query, doc_ids, stats, tiered_index, top_k, scoring='okapi', k1=1.2, b=0.75):
+    """
+    Finds top_k of doc_ids going through tiers in order: postings of the first tier are
+    scored for all query terms, then of the next one and so on. Scoring stops as soon as
+    the k-th best partial score can not be reached by any other document with what is
+    left in the remaining tiers. Only the top_k documents are then scored exactly
+    :param doc_ids: sorted numpy array of candidate doc ids, see filter_docs
+    :param scoring: 'okapi' or 'cosine'
+    :return: tuple of numpy arrays (doc_ids, scores) of at most top_k documents
+    """
+    doc_ids = np.asarray(doc_ids, dtype=np.int64)
+    if top_k <= 0 or len(doc_ids) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+    if len(doc_ids) <= top_k:
+        return doc_ids, score_docs(query, doc_ids, stats, tiered_index, scoring, k1, b)
+    terms = [term for term in query if tiered_index.df(term) > 0]
+    idfs = dict((term, math.log10(stats.n_docs / tiered_index.df(term))) for term in terms)
+    lengths = stats.lookup(doc_ids)
+    norms = stats.length_norms(doc_ids, k1, b)
+    # the largest possible contribution of a term frequency, for the shortest candidate
+    min_length = max(int(lengths.min()), 1)
+    min_norm = float(norms.min())
+
+    def bound(term, max_freq):
+        if scoring == 'cosine':
+            return query[term] * (idfs[term] ** 2) * min(1.0, max_freq / min_length)
+        return idfs[term] * max_freq * (k1 + 1) / (max_freq + min_norm)
 
+    scores = np.zeros(len(doc_ids), dtype=np.float64)
+    for tier in range(tiered_index.n_tiers):
+        for term in terms:
+            tier_doc_ids, tier_freqs, _ = tiered_index[term][tier]
+            if len(tier_doc_ids) == 0:
+                continue
+            positions, found = lookup_sorted(tier_doc_ids, doc_ids)
+            freqs = tier_freqs[positions[found]]
+            scores[found] += _contributions(scoring, idfs[term], query[term], freqs, norms[found], k1)
 
-def okapi_scoring_docs(query, doc_ids, doc_lengths, high_low_index, k1=1.2, b=0.75):
+        if tier + 1 == tiered_index.n_tiers:
+            continue
+        remaining = sum(bound(term, max(max_freq for _, _, max_freq in tiered_index[term][tier + 1:]))
+                        for term in terms)
+        partial = _finish(scoring, scores, lengths)
+        n = len(partial)
+        kth = np.partition(partial, [n - top_k - 1, n - top_k])
+        # top_k is settled if the k-th best score beats the best of the rest with all they miss
+        if kth[n - top_k] > (kth[n - top_k - 1] + remaining) * (1 + 1e-9):
+            break
+
+    if len(doc_ids) > top_k:
+        partial = _finish(scoring, scores, lengths)
+        candidates = np.flatnonzero(partial >= np.partition(partial, len(partial) - top_k)[-top_k])
+        best = candidates[np.lexsort((doc_ids[candidates], -partial[candidates]))[:top_k]]
+        doc_ids = doc_ids[np.sort(best)]
+    return doc_ids, score_docs(query, doc_ids, stats, tiered_index, scoring, k1, b)
+
+
+def cosine_scoring_docs(query, doc_ids, stats, tiered_index, top_k=None):
     """
-    Change okapi_scoring function you built in the second lab
-    such that you only score set of doc_ids you get as a parameter,
-    and using high_low_index instead of standard inverted index
+    Cosine scores of the set of doc_ids, using the tiered index instead of
+    the standard inverted index
     :param query: dictionary term:count
-    :param doc_ids: set of document ids to score
-    :param doc_lengths: dictionary doc_id:length
-    :param high_low_index: high-low index you built before
+    :param doc_ids: sorted numpy array of document ids to score
+    :param stats: CollectionStats, doc_id:length mapping with collection statistics
+    :param tiered_index: TieredIndex
+    :param top_k: if given, only scores of the best top_k documents are returned
     :return: dictionary of scores, doc_id:score
     """
-    scores = {}
-    avgdl = sum(doc_lengths.values()) / len(doc_lengths)
-    for term in query:
-        if term in high_low_index:
-            idf = math.log10(len(doc_lengths) / (high_low_index[term][2]))
-            for doc_id, freq in high_low_index[term][0].items():
-                nominator = freq * (k1 + 1)
-                denominator = (freq + k1 * (1 - b + b * doc_lengths[doc_id] / avgdl))
-                if doc_id in scores:
-                    scores[doc_id] += idf * nominator / denominator
-                else:
-                    scores[doc_id] = idf * nominator / denominator
-    
-    return scores
+    return _scoring_docs(query, doc_ids, stats, tiered_index, top_k, 'cosine')
+
+
+def okapi_scoring_docs(query, doc_ids, stats, tiered_index, top_k=None, k1=1.2, b=0.75):
+    """
+    Okapi BM25 scores of the set of doc_ids, using the tiered index instead of
+    the standard inverted index
+    :param query: dictionary term:count
+    :param doc_ids: sorted numpy array of document ids to score
+    :param stats: CollectionStats, doc_id:length mapping with collection statistics
+    :param tiered_index: TieredIndex
+    :param top_k: if given, only scores of the best top_k documents are returned
+    :return: dictionary of scores, doc_id:score
+    """
+    return _scoring_docs(query, doc_ids, stats, tiered_index, top_k, 'okapi', k1, b)
+
+
+def _scoring_docs(query, doc_ids, stats, tiered_index, top_k, scoring, k1=1.2, b=0.75):
+    doc_ids = np.asarray(doc_ids, dtype=np.int64)
+    if top_k is None:
+        scores = score_docs(query, doc_ids, stats, tiered_index, scoring, k1, b)
+    else:
+        doc_ids, scores = top_k_docs(query, doc_ids, stats, tiered_index, top_k, scoring, k1, b)
+    return dict(zip(doc_ids.tolist(), scores.tolist()))
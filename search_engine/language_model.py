@@ -1,10 +1,7 @@
-import glob
-import os
-import pickle
-import re
-from collections import Counter
+import numpy as np
 
-from bs4 import BeautifulSoup
+from search_engine import reuters
+from search_engine import vectorized
 
 
 def extract_categories(path):
@@ -16,142 +13,176 @@ def extract_categories(path):
     :param path: original data path
     :return: dict, category:[doc_id1, doc_id2, ...]
     """
+    doc_categories = dict((doc.newid, doc.categories) for doc in reuters.iter_corpus(path))
+    return group_categories(doc_categories)
+
+
+def group_categories(doc_categories):
+    """
+    Inverts per-document categories, as saved by the indexer, into category:[doc_id1, doc_id2, ...]
+    :param doc_categories: dict, doc_id:{category_tag: [value1, value2, ...]}
+    :return: dict, category:[doc_id1, doc_id2, ...]
+    """
     result = {}
 
-    for filename in sorted(os.listdir(path)):
-        if filename.endswith('.sgm'):
-            with open(path + filename, 'r', encoding='latin1') as file:
-                file_content = file.read()
-                parsed = BeautifulSoup(file_content, 'html.parser')
-                file_documents = parsed.find_all('reuters')
-                
-                for document in file_documents:
-                    doc_id = int(document['newid'])
-                    categories = [document.topics, document.places,
-                                  document.people, document.orgs,
-                                  document.exchanges, document.companies]
-                    for cat in categories:
-                        for doc_cat in cat.contents:
-                            cat = doc_cat.string
-                            if cat in result:
-                                result[cat].append(doc_id)
-                            else:
-                                result[cat] = [doc_id]
+    for doc_id, categories in doc_categories.items():
+        for tag in reuters.category_tags:
+            for cat in categories[tag]:
+                if cat in result:
+                    result[cat].append(doc_id)
+                else:
+                    result[cat] = [doc_id]
 
     return result
-    
 
-def lm_rank_documents(query, doc_ids, doc_lengths, high_low_index, smoothing, param):
+
+def lm_rank_documents(query, doc_ids, stats, tiered_index, smoothing, param):
     """
     Scores each document in doc_ids using this document's language model.
-    Applies smoothing. Looks up term frequencies in high_low_index
+    Applies smoothing. Scores are sums of log probabilities, computed term-at-a-time
+    over postings of query terms from tiered_index, see vectorized.lm_scores
     :param query: dict, term:count
-    :param doc_ids: set of document ids to score
-    :param doc_lengths: dictionary doc_id:length
-    :param high_low_index: high-low index you built last lab
-    :param smoothing: which smoothing to apply, either 'additive' or 'jelinek-mercer'
-    :param param: alpha for additive / lambda for jelinek-mercer
+    :param doc_ids: iterable of document ids to score
+    :param stats: CollectionStats, doc_id:length mapping with collection statistics
+    :param tiered_index: inexact.TieredIndex
+    :param smoothing: which smoothing to apply, 'additive', 'jelinek-mercer' or 'dirichlet'
+    :param param: alpha for additive / lambda for jelinek-mercer / mu for dirichlet
     :return: dictionary of scores, doc_id:score
     """
-    result = {}
+    doc_ids = np.unique(np.asarray(list(doc_ids), dtype=np.int64))
+    postings = [(term, tiered_index.df(term)) + tiered_index.postings(term)
+                for term in query if term in tiered_index]
+    doc_ids, scores = vectorized.lm_scores(query, doc_ids, postings, stats, stats.vocab_size, 
+                                           smoothing, param)
+    return dict(zip(doc_ids.tolist(), scores.tolist()))
 
-    if smoothing == 'additive':
-        for doc_id in doc_ids:
-            score = 1.0
-            for term in query:
-                cur_score = param
-                denom = doc_lengths[doc_id] + param * len(high_low_index)
-                if term in high_low_index:
-                    if doc_id in high_low_index[term][0]:
-                        cur_score += high_low_index[term][0][doc_id]
-                    elif doc_id in high_low_index[term][1]:
-                        cur_score += high_low_index[term][1][doc_id]
-                
-                score *= cur_score / denom
-
-            result[doc_id] = score
-    else:
-        col_len = sum(doc_lengths.values())
-        for doc_id in doc_ids:
-            score = 1.0
-            for term in query:
-                cur_score = 0.0
-                if term in high_low_index:
-                    if doc_id in high_low_index[term][0]:
-                        cur_score += high_low_index[term][0][doc_id]
-                    elif doc_id in high_low_index[term][1]:
-                        cur_score += high_low_index[term][1][doc_id]
-
-                    cur_score = param * cur_score / doc_lengths[doc_id]
-                    
-                    high_freq = sum(high_low_index[term][0].values())
-                    low_freq = sum(high_low_index[term][1].values())
-    
-                    cur_score += (1 - param) * (high_freq + low_freq) / col_len
-                
-                score *= cur_score
-                
-            result[doc_id] = score
-    
-    return result
 
+class CategoryModels(object):
+    """
+    Language models of categories, a category comprises all documents belonging to it.
+    For every term counts are kept only for categories where it occurs, as sorted arrays
+    term:(category numbers, counts); lengths[number] is the total length of documents
+    of a category and n_docs[number] their number. Categories are smoothed with the
+    collection model, as documents are, see lm_define_categories
+    """
 
-def lm_define_categories(query, cat2docs, doc_lengths, high_low_index, smoothing, param):
+    def __init__(self, categories, lengths, n_docs, terms):
+        self.categories = categories
+        self.lengths = lengths
+        self.n_docs = n_docs
+        self.terms = terms
+
+    @classmethod
+    def build(cls, cat2docs, index, doc_lengths):
+        """
+        :param cat2docs: dict, category:[doc_id1, doc_id2, ...]
+        :param index: PostingsIndex or SegmentedIndex
+        :param doc_lengths: doc_id:length mapping, CollectionStats
+        :return: CategoryModels
+        """
+        categories = sorted(cat2docs)
+        pair_docs = np.array([doc_id for cat in categories for doc_id in cat2docs[cat]], dtype=np.int64)
+        pair_cats = np.repeat(np.arange(len(categories)), [len(cat2docs[cat]) for cat in categories])
+        order = np.argsort(pair_docs, kind='stable')
+        pair_docs, pair_cats = pair_docs[order], pair_cats[order]
+        lengths = np.bincount(pair_cats, weights=doc_lengths.lookup(pair_docs), 
+                              minlength=len(categories)).astype(np.int64)
+        n_docs = np.bincount(pair_cats, minlength=len(categories))
+
+        terms = {}
+        for term in index:
+            doc_ids, freqs = index.postings(term)
+            # every posting goes to all categories of its document
+            starts = np.searchsorted(pair_docs, doc_ids, side='left')
+            n_cats = np.searchsorted(pair_docs, doc_ids, side='right') - starts
+            if n_cats.sum() == 0:
+                continue
+            pairs = np.repeat(starts - (np.cumsum(n_cats) - n_cats), n_cats) + np.arange(n_cats.sum())
+            counts = np.bincount(pair_cats[pairs], weights=np.repeat(freqs, n_cats), 
+                                 minlength=len(categories))
+            present = np.flatnonzero(counts)
+            terms[term] = (present, counts[present].astype(np.int64))
+        return cls(categories, lengths, n_docs, terms)
+
+    def update(self, added, added_categories, removed, removed_categories):
+        """
+        Updates counts in place when documents are added or removed. New categories get
+        next numbers, categories left without documents are kept, but are not scored
+        :param added: postings of added documents, term:([doc_id_1, ...], [doc_freq_1, ...])
+        :param added_categories: dict doc_id:{category_tag: [value1, ...]} of added documents
+        :param removed: postings of removed documents, same format as added
+        :param removed_categories: same as added_categories for removed documents
+        """
+        numbers = dict((cat, i) for i, cat in enumerate(self.categories))
+        changes = []
+        for postings, doc_categories, sign in ((removed, removed_categories, -1),
+                                               (added, added_categories, 1)):
+            doc_numbers = {}
+            for doc_id, categories in doc_categories.items():
+                doc_numbers[doc_id] = []
+                for tag in reuters.category_tags:
+                    for cat in categories[tag]:
+                        if cat not in numbers:
+                            numbers[cat] = len(self.categories)
+                            self.categories.append(cat)
+                        doc_numbers[doc_id].append(numbers[cat])
+            changes.append((postings, doc_numbers, sign))
+
+        grow = len(self.categories) - len(self.lengths)
+        if grow > 0:
+            self.lengths = np.concatenate((self.lengths, np.zeros(grow, dtype=np.int64)))
+            self.n_docs = np.concatenate((self.n_docs, np.zeros(grow, dtype=self.n_docs.dtype)))
+
+        for postings, doc_numbers, sign in changes:
+            # a document length is the sum of its term frequencies
+            doc_lengths = dict.fromkeys(doc_numbers, 0)
+            for term, (doc_ids, freqs) in postings.items():
+                counts = {}
+                if term in self.terms:
+                    counts = dict(zip(*(array.tolist() for array in self.terms[term])))
+                for doc_id, freq in zip(doc_ids, freqs):
+                    doc_lengths[doc_id] += freq
+                    for number in doc_numbers[doc_id]:
+                        counts[number] = counts.get(number, 0) + sign * freq
+                present = sorted(number for number, count in counts.items() if count > 0)
+                if present:
+                    self.terms[term] = (np.array(present, dtype=np.int64),
+                                        np.array([counts[number] for number in present], dtype=np.int64))
+                elif term in self.terms:
+                    del self.terms[term]
+            for doc_id, cat_numbers in doc_numbers.items():
+                np.add.at(self.n_docs, cat_numbers, sign)
+                np.add.at(self.lengths, cat_numbers, sign * doc_lengths[doc_id])
+
+    def lookup(self, numbers):
+        """
+        :return: numpy array of total lengths of categories
+        """
+        return self.lengths[numbers]
+
+    def __len__(self):
+        return len(self.categories)
+
+
+def lm_define_categories(query, category_models, stats, smoothing, param):
     """
     Same as lm_rank_documents, but here instead of documents we score all categories
     to find out which of them the user is probably interested in. So, instead of building
-    a language model for each document, we build a language model for each category -
-    (category comprises all documents belonging to it)
+    a language model for each document, we use a language model for each category,
+    precomputed in category_models. Scoring costs a lookup of counts per query term.
+    Categories are smoothed with the collection model - cf / total_length of stats, a document
+    in several categories is counted once and documents without categories are counted too
     :param query: dict, term:count
-    :param cat2docs: dict, category:[doc_id1, doc_id2, ...]
-    :param doc_lengths: dictionary doc_id:length
-    :param high_low_index: high-low index you built last lab
-    :param smoothing: which smoothing to apply, either 'additive' or 'jelinek-mercer'
-    :param param: alpha for additive / lambda for jelinek-mercer
+    :param category_models: CategoryModels
+    :param stats: CollectionStats
+    :param smoothing: which smoothing to apply, 'additive', 'jelinek-mercer' or 'dirichlet'
+    :param param: alpha for additive / lambda for jelinek-mercer / mu for dirichlet
     :return: dictionary of scores, category:score
     """
-    result = {}
-
-    if smoothing == 'additive':
-        for cat in cat2docs:
-            score = 1.0
-            for term in query:
-                tf, docs_len = 0, 0
-                for doc_id in cat2docs[cat]:
-                    docs_len += doc_lengths[doc_id]
-                    if term in high_low_index:
-                        if doc_id in high_low_index[term][0]:
-                            tf += high_low_index[term][0][doc_id]
-                        elif doc_id in high_low_index[term][1]:
-                            tf += high_low_index[term][1][doc_id]
-                
-                score *= (param + tf) / docs_len + param * len(high_low_index)
-
-            result[cat] = score
-    else:
-        col_len = sum(doc_lengths.values())
-        for cat in cat2docs:
-            score = 1.0
-            for term in query:
-                cur_score = 0.0
-                tf, docs_len = 0, 0
-                for doc_id in cat2docs[cat]:
-                    docs_len += doc_lengths[doc_id]
-                    if term in high_low_index:
-                        if doc_id in high_low_index[term][0]:
-                            tf += high_low_index[term][0][doc_id]
-                        elif doc_id in high_low_index[term][1]:
-                            tf += high_low_index[term][1][doc_id]
-
-                if docs_len > 0:
-                    cur_score = param * tf / docs_len
-
-                high_freq = sum(high_low_index[term][0].values())
-                low_freq = sum(high_low_index[term][1].values())
-                cur_score += (1 - param) * (high_freq + low_freq) / col_len
-
-                score *= cur_score
-                
-            result[cat] = score
-    
-    return result
+    postings = [(term, len(category_models.terms[term][0])) + category_models.terms[term]
+                for term in query if term in category_models.terms]
+    # categories whose documents were all deleted are not scored
+    numbers, scores = vectorized.lm_scores(query, np.flatnonzero(category_models.n_docs > 0), postings,
+                                           category_models, stats.vocab_size, smoothing, param,
+                                           background=stats)
+    return dict(zip([category_models.categories[i] for i in numbers.tolist()], scores.tolist()))
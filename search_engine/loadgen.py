@@ -0,0 +1,155 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections import Counter
+
+from search_engine.server import read_message
+
+sample_queries = ['oil prices', 'bank interest rate', 'quarterly profit dividend', 'company shares',
+                  'trade deficit', 'net loss year', 'stock market', 'coffee export quota',
+                  'gold mining', 'wheat harvest', 'Apple product', 'Democratic party',
+                  'crude oil output opec', 'federal reserve money supply', 'japan yen dollar',
+                  'sugar production', 'merger acquisition offer', 'grain exports soviet union']
+
+
+class Client(object):
+    """
+    HTTP/JSON client of QueryServer keeping idle keep-alive connections for reuse
+    """
+
+    def __init__(self, host='127.0.0.1', port=8080):
+        self.host = host
+        self.port = port
+        self.idle = []
+
+    async def request(self, method, path, payload=None):
+        """
+        :return: tuple (status, decoded JSON body)
+        """
+        if self.idle:
+            reader, writer = self.idle.pop()
+        else:
+            reader, writer = await asyncio.open_connection(self.host, self.port)
+        body = json.dumps(payload).encode('utf-8') if payload is not None else b''
+        head = f'{method} {path} HTTP/1.1\r\nHost: {self.host}\r\nContent-Type: application/json\r\n' \
+               f'Content-Length: {len(body)}\r\n\r\n'
+        try:
+            writer.write(head.encode('latin-1') + body)
+            await writer.drain()
+            message = await read_message(reader)
+            if message is None:
+                # counted as a connection error, the next request opens a new connection
+                raise ConnectionResetError('Connection closed by the server')
+            start_line, headers, response = message
+        except BaseException:
+            writer.close()
+            raise
+        if headers.get('connection', '').lower() == 'close':
+            writer.close()
+        else:
+            self.idle.append((reader, writer))
+        return int(start_line.split()[1]), json.loads(response)
+
+    def close(self):
+        for _, writer in self.idle:
+            writer.close()
+        self.idle = []
+
+
+async def run_load(client, queries, n_requests, concurrency=16, rate=None, **params):
+    """
+    Sends search requests with random queries. Without rate it is a closed loop,
+    concurrency clients send a new request as soon as the previous one is answered.
+    With rate requests are scheduled at that many per second whatever the response times are,
+    over at most concurrency connections, so the server can be overloaded. Latencies are
+    counted from the scheduled time, waiting for a free connection included
+    :param params: other search parameters - top_k, scoring, inexact, filters, expansion, timeout
+    :return: tuple (Counter of statuses, sorted latencies of answered requests, elapsed seconds)
+    """
+    statuses = Counter()
+    latencies = []
+
+    slots = asyncio.Semaphore(concurrency)
+
+    async def send(query, scheduled):
+        try:
+            async with slots:
+                status, _ = await client.request('POST', '/search', dict(params, query=query))
+        except (OSError, asyncio.IncompleteReadError):
+            status = 'connection error'
+        statuses[status] += 1
+        if status == 200:
+            latencies.append(time.perf_counter() - scheduled)
+
+    start_time = time.perf_counter()
+    if rate is None:
+        counter = iter(range(n_requests))
+
+        async def worker():
+            for _ in counter:
+                await send(random.choice(queries), time.perf_counter())
+
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+    else:
+        tasks = []
+        for i in range(n_requests):
+            scheduled = start_time + i / rate
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.ensure_future(send(random.choice(queries), scheduled)))
+        await asyncio.gather(*tasks)
+    return statuses, sorted(latencies), time.perf_counter() - start_time
+
+
+def _percentile(latencies, p):
+    return latencies[min(int(p * len(latencies)), len(latencies) - 1)] * 1000 if latencies else float('nan')
+
+
+async def _main(args):
+    queries = sample_queries
+    if args.queries is not None:
+        with open(args.queries) as fd:
+            queries = [line.strip() for line in fd if line.strip()]
+    params = dict(top_k=args.top_k, scoring=args.scoring, inexact=args.inexact,
+                  expansion=args.expansion, timeout=args.timeout)
+    if args.filters is not None:
+        params['filters'] = args.filters
+
+    client = Client(args.host, args.port)
+    try:
+        statuses, latencies, elapsed = await run_load(client, queries, args.requests, args.concurrency,
+                                                      args.rate, **params)
+        _, server_stats = await client.request('GET', '/stats')
+    finally:
+        client.close()
+
+    print(f'{args.requests} requests in {elapsed:.3f} seconds, '
+          f'{statuses[200] / elapsed:.1f} answered per second')
+    print('statuses:', dict(statuses))
+    print('latency ms: p50 %.2f, p90 %.2f, p99 %.2f, max %.2f' %
+          tuple(_percentile(latencies, p) for p in (0.5, 0.9, 0.99, 1.0)))
+    print('server:', server_stats)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load generator for the search service')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=16, help='number of connections')
+    parser.add_argument('--rate', type=float, default=None, help='requests per second, open loop')
+    parser.add_argument('--queries', default=None, help='file with a query per line')
+    parser.add_argument('--top-k', type=int, default=10)
+    parser.add_argument('--scoring', default='okapi_np')
+    parser.add_argument('--inexact', action='store_true')
+    parser.add_argument('--expansion', action='store_true')
+    parser.add_argument('--filters', default=None)
+    parser.add_argument('--timeout', type=float, default=1.0, help='deadline of a request, seconds')
+    asyncio.run(_main(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
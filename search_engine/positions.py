@@ -0,0 +1,200 @@
+import math
+from functools import lru_cache
+from itertools import chain, combinations
+
+import numpy as np
+
+from search_engine.inexact import intersect_sorted, lookup_sorted
+from search_engine.postings import Lexicon, bm25_b, bm25_k1, vbyte_decode, vbyte_encode
+from search_engine.storage import map_file
+
+# positions of different documents never get this close in occurrence keys, see occurrence_keys
+doc_shift = 32
+
+
+class PositionalIndex(object):
+    """
+    Inverted index with positions: term -> doc -> positions of the term in preprocessed
+    document terms. Postings of a term are one variable byte encoded stream of doc id gaps,
+    then number of positions in every document, then position gaps, which start from zero
+    in every document. The term table is a Lexicon of term:(offset, n_bytes, df, -1)
+    """
+
+    def __init__(self, terms, data):
+        self.terms = terms
+        self.data = data
+
+    @classmethod
+    def build(cls, analyzed):
+        """
+        :param analyzed: dictionary doc_id:AnalyzedDocument
+        :return: PositionalIndex
+        """
+        postings = {}
+        for doc_id in sorted(analyzed):
+            doc_positions = {}
+            for position, term in enumerate(analyzed[doc_id].terms):
+                if term in doc_positions:
+                    doc_positions[term].append(position)
+                else:
+                    doc_positions[term] = [position]
+            for term, term_positions in doc_positions.items():
+                if term not in postings:
+                    postings[term] = ([], [])
+                postings[term][0].append(doc_id)
+                postings[term][1].append(term_positions)
+
+        terms = {}
+        data = bytearray()
+        for term, (doc_ids, term_positions) in postings.items():
+            counts = np.array([len(positions) for positions in term_positions], dtype=np.int64)
+            positions = np.fromiter(chain.from_iterable(term_positions), dtype=np.int64,
+                                    count=int(counts.sum()))
+            gaps = np.diff(positions, prepend=0)
+            starts = np.cumsum(counts) - counts
+            gaps[starts] = positions[starts]
+            encoded = vbyte_encode(np.concatenate((np.diff(doc_ids, prepend=0), counts, gaps)))
+            terms[term] = (len(data), len(encoded), len(doc_ids), -1)
+            data.extend(encoded)
+        return cls(terms, bytes(data))
+
+    def save(self, terms_path, data_path):
+        with open(data_path, 'wb') as fd:
+            fd.write(self.data)
+        Lexicon.build(self.terms).save(terms_path)
+
+    @classmethod
+    def load(cls, terms_path, data_path, use_mmap=True):
+        if use_mmap:
+            data = map_file(data_path)
+        else:
+            with open(data_path, 'rb') as fd:
+                data = fd.read()
+        return cls(Lexicon.load(terms_path, use_mmap), data)
+
+    def __contains__(self, term):
+        return term in self.terms
+
+    def __len__(self):
+        return len(self.terms)
+
+    def positions(self, term):
+        """
+        :return: tuple of numpy arrays (doc_ids, counts, positions) - sorted doc ids,
+                 number of positions in every document and positions of all documents
+                 concatenated, sorted inside every document
+        """
+        offset, n_bytes, df, _ = self.terms[term]
+        values = vbyte_decode(self.data[offset: offset + n_bytes]).astype(np.int64)
+        doc_ids = np.cumsum(values[:df])
+        counts = values[df: 2 * df]
+        gaps = values[2 * df:]
+        positions = np.cumsum(gaps)
+        # the running sum starts again in every document
+        starts = np.cumsum(counts) - counts
+        positions -= np.repeat(positions[starts] - gaps[starts], counts)
+        return doc_ids, counts, positions
+
+
+def occurrence_keys(doc_ids, counts, positions, shift=0):
+    """
+    Packs every occurrence into one sorted int64 key doc_id << doc_shift | (position - shift),
+    occurrences with position < shift are dropped
+    """
+    docs = np.repeat(doc_ids, counts)
+    kept = positions >= shift
+    return (docs[kept] << doc_shift) | (positions[kept] - shift)
+
+
+def phrase_postings(term_positions):
+    """
+    Finds documents where terms occur one after another, by intersecting position lists
+    :param term_positions: list of (doc_ids, counts, positions) of phrase terms in phrase order,
+                           see PositionalIndex.positions
+    :return: tuple of numpy arrays (doc_ids, freqs) - documents with the phrase and number
+             of its occurrences in them
+    """
+    doc_ids = intersect_sorted([doc_ids for doc_ids, _, _ in term_positions])
+    keys = None
+    for shift, (term_doc_ids, counts, positions) in enumerate(term_positions):
+        # occurrences in documents with all the terms, moved to the start of the phrase
+        _, found = lookup_sorted(doc_ids, term_doc_ids)
+        kept = np.repeat(found, counts)
+        term_keys = occurrence_keys(term_doc_ids[found], counts[found], positions[kept], shift)
+        if keys is None:
+            keys = term_keys
+        else:
+            _, found = lookup_sorted(term_keys, keys)
+            keys = keys[found]
+    return np.unique(keys >> doc_shift, return_counts=True)
+
+
+class PhraseIndex(object):
+    """
+    PostingsIndex interface for phrases - tuples of terms. Postings of a phrase are found
+    in the positional index when it is looked up, the last cache_size phrases are kept
+    """
+
+    def __init__(self, positions, cache_size=256):
+        self.positions = positions
+        self._postings = lru_cache(maxsize=cache_size)(self._phrase_postings)
+
+    def _phrase_postings(self, phrase):
+        if not all(term in self.positions for term in phrase):
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return phrase_postings([self.positions.positions(term) for term in phrase])
+
+    def __contains__(self, phrase):
+        return self.df(phrase) > 0
+
+    def df(self, phrase):
+        return len(self._postings(tuple(phrase))[0])
+
+    def postings(self, phrase):
+        """
+        :return: tuple of numpy arrays (doc_ids, phrase_freqs), sorted by doc_id
+        """
+        return self._postings(tuple(phrase))
+
+
+def proximity_scores(terms, positions, stats, window=5, k1=bm25_k1, b=bm25_b):
+    """
+    Term proximity part of BM25TP (Rasolofo and Savoy): every occurrence of a query term
+    with an occurrence of another query term at most window positions away adds
+    1 / distance^2 to the weight of the pair in the document (the nearest occurrence is taken).
+    Weights are saturated as term frequencies in Okapi BM25 and multiplied by
+    the smaller idf of the two terms
+    :param terms: distinct query terms
+    :param positions: PositionalIndex or SegmentedPositions
+    :param stats: CollectionStats
+    :return: tuple of numpy arrays (doc_ids, scores), doc ids can repeat
+    """
+    keys = {}
+    idfs = {}
+    for term in terms:
+        df = stats.df(term)
+        if df > 0 and term in positions:
+            keys[term] = occurrence_keys(*positions.positions(term))
+            idfs[term] = math.log10(stats.n_docs / df)
+
+    all_ids, all_weights = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.float64)]
+    for first, second in combinations(keys, 2):
+        first_keys, second_keys = keys[first], keys[second]
+        if len(first_keys) > len(second_keys):
+            first_keys, second_keys = second_keys, first_keys
+        # nearest occurrence of the second term on both sides, other documents are far away
+        i = np.searchsorted(second_keys, first_keys)
+        before = second_keys[np.maximum(i - 1, 0)]
+        after = second_keys[np.minimum(i, len(second_keys) - 1)]
+        distance = np.minimum(np.abs(first_keys - before), np.abs(after - first_keys))
+        near = distance <= window
+        doc_ids = first_keys[near] >> doc_shift
+        if len(doc_ids) == 0:
+            continue
+        sums = np.bincount(doc_ids, weights=1.0 / distance[near] ** 2)
+        doc_ids = np.unique(doc_ids)
+        weights = sums[doc_ids]
+        all_ids.append(doc_ids)
+        all_weights.append(min(idfs[first], idfs[second]) * weights * (k1 + 1) /
+                           (weights + stats.length_norms(doc_ids, k1, b)))
+    return np.concatenate(all_ids), np.concatenate(all_weights)
@@ -0,0 +1,326 @@
+from collections.abc import Mapping
+
+import numpy as np
+
+from search_engine.storage import load_array, map_file, save_array
+
+block_dtype = np.dtype([('last_doc', '<u4'), ('max_tf', '<u4'), ('min_len', '<u4'),
+                        ('max_bm25', '<f8')])
+
+bm25_k1 = 1.2
+bm25_b = 0.75
+
+
+def vbyte_encode(numbers):
+    """
+    Variable byte encoding of non-negative integers, refer to book chapter 5.3.1.
+    Every number is split into 7-bit chunks, the last byte of a number has its high bit set
+    :param numbers: iterable of non-negative ints or numpy array
+    :return: bytes
+    """
+    if not isinstance(numbers, np.ndarray):
+        numbers = list(numbers)
+    values = np.asarray(numbers, dtype=np.uint64)
+    if len(values) == 0:
+        return b''
+    n_bytes = np.ones(len(values), dtype=np.int64)
+    rest = values >> np.uint64(7)
+    while rest.any():
+        n_bytes += rest > 0
+        rest >>= np.uint64(7)
+    ends = np.cumsum(n_bytes)
+    group = np.repeat(np.arange(len(values)), n_bytes)
+    # every byte is shifted by 7 bits for each byte that follows it inside the same number
+    shift = (7 * (ends[group] - 1 - np.arange(ends[-1]))).astype(np.uint64)
+    result = ((values[group] >> shift) & np.uint64(0x7f)).astype(np.uint8)
+    result[ends - 1] |= 0x80
+    return result.tobytes()
+
+
+def vbyte_decode(data):
+    """
+    Decodes a variable byte encoded stream produced by vbyte_encode
+    :param data: bytes-like object
+    :return: numpy array of uint32 numbers
+    """
+    buf = np.frombuffer(data, dtype=np.uint8)
+    if len(buf) == 0:
+        return np.zeros(0, dtype=np.uint32)
+    ends = np.flatnonzero(buf & 0x80)
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    # every byte is shifted by 7 bits for each byte that follows it inside the same number
+    group = np.repeat(np.arange(len(ends)), ends - starts + 1)
+    shift = 7 * (ends[group] - np.arange(len(buf)))
+    payload = (buf & 0x7f).astype(np.uint64) << shift.astype(np.uint64)
+    return np.add.reduceat(payload, starts).astype(np.uint32)
+
+
+def bm25_tf_part(freqs, lengths, avgdl, k1=bm25_k1, b=bm25_b):
+    """
+    Term frequency component of Okapi BM25, the score of a posting is idf times this
+    """
+    return freqs * (k1 + 1) / (freqs + k1 * (1 - b + b * lengths / avgdl))
+
+
+def block_maxima(doc_ids, freqs, lengths, block_size, avgdl):
+    """
+    Splits posting list into blocks of block_size postings and finds for each block its
+    last doc id, maximum term frequency, minimum document length and maximum of bm25_tf_part
+    with default parameters for given avgdl. Term frequency and length bound any
+    score that grows with term frequency and falls with document length
+    :param doc_ids: numpy array of doc ids, sorted
+    :param freqs: numpy array of term frequencies
+    :param lengths: numpy array of lengths of documents in doc_ids
+    :param block_size: number of postings in one block
+    :param avgdl: average document length
+    :return: numpy structured array with fields last_doc, max_tf, min_len, max_bm25
+    """
+    result = np.zeros((len(doc_ids) + block_size - 1) // block_size, dtype=block_dtype)
+    if len(doc_ids) > 0:
+        starts = np.arange(0, len(doc_ids), block_size)
+        result['last_doc'] = doc_ids[np.minimum(starts + block_size, len(doc_ids)) - 1]
+        result['max_tf'] = np.maximum.reduceat(freqs, starts)
+        result['min_len'] = np.minimum.reduceat(lengths, starts)
+        result['max_bm25'] = np.maximum.reduceat(bm25_tf_part(freqs, lengths, avgdl), starts)
+    return result
+
+
+class Lexicon(Mapping):
+    """
+    Term dictionary stored as a table sorted by term, looked up with binary search.
+    When loaded with mmap only the rows touched by the search are read from disk,
+    so opening it does not depend on the vocabulary size
+    """
+
+    def __init__(self, table):
+        self.table = table
+        self.width = table.dtype['term'].itemsize
+
+    @classmethod
+    def build(cls, terms):
+        """
+        :param terms: dictionary - term:(offset, n_bytes, df, blocks_offset)
+        :return: Lexicon
+        """
+        encoded = sorted((term.encode('utf-8'), info) for term, info in terms.items())
+        width = max([len(term) for term, _ in encoded] + [1])
+        dtype = [('term', f'S{width}'), ('offset', '<u8'), ('n_bytes', '<u4'), ('df', '<u4'),
+                 ('blocks', '<i8')]
+        table = np.array([(term,) + tuple(info) for term, info in encoded], dtype=dtype)
+        return cls(table)
+
+    def save(self, path):
+        save_array(self.table, path)
+
+    @classmethod
+    def load(cls, path, use_mmap=True):
+        return cls(load_array(path, use_mmap))
+
+    def _find(self, term):
+        key = term.encode('utf-8')
+        if len(key) > self.width or len(self.table) == 0:
+            return -1
+        i = int(np.searchsorted(self.table['term'], key))
+        if i < len(self.table) and self.table['term'][i] == key:
+            return i
+        return -1
+
+    def __getitem__(self, term):
+        i = self._find(term)
+        if i < 0:
+            raise KeyError(term)
+        row = self.table[i]
+        return int(row['offset']), int(row['n_bytes']), int(row['df']), int(row['blocks'])
+
+    def __contains__(self, term):
+        return self._find(term) >= 0
+
+    def __iter__(self):
+        return (term.decode('utf-8') for term in self.table['term'])
+
+    def __len__(self):
+        return len(self.table)
+
+
+class PostingsIndex(object):
+    """
+    Inverted index with postings stored as typed arrays in one contiguous buffer.
+    For each term the buffer keeps doc id gaps followed by term frequencies,
+    either as raw little-endian uint32 or variable byte compressed.
+    The term dictionary maps term:(offset, n_bytes, df, blocks_offset), it is a dict for
+    freshly built indexes and a Lexicon for the ones loaded from disk.
+    If document lengths are known at build time, block maxima (see block_maxima)
+    are kept for every term, blocks_offset is the first row of the term in blocks array,
+    avgdl is the average document length they were computed for
+    """
+
+    compressions = (None, 'vbyte')
+    header_size = 16
+
+    def __init__(self, terms, data, compression=None, blocks=None, block_size=64, avgdl=1.0):
+        if compression not in self.compressions:
+            raise ValueError(f'Unknown postings compression: {compression}')
+        self.terms = terms
+        self.data = data
+        self.compression = compression
+        self.blocks = blocks
+        self.block_size = block_size
+        self.avgdl = avgdl
+
+    @classmethod
+    def build(cls, postings, compression=None, doc_lengths=None, block_size=64):
+        """
+        Builds compact index from in-memory postings
+        :param postings: dictionary - term:(doc_ids, term_freqs), both sequences of ints
+        :param compression: None for raw uint32 arrays or 'vbyte'
+        :param doc_lengths: dictionary doc_id:doc_length, needed for block maxima
+        :param block_size: number of postings in one block of block maxima
+        :return: PostingsIndex
+        """
+        terms = {}
+        data = bytearray()
+        blocks = []
+        n_blocks = 0
+        avgdl = sum(doc_lengths.values()) / len(doc_lengths) if doc_lengths else 1.0
+        for term, (doc_ids, freqs) in postings.items():
+            doc_ids = np.asarray(doc_ids, dtype=np.int64)
+            freqs = np.asarray(freqs, dtype=np.int64)
+            order = np.argsort(doc_ids, kind='stable')
+            doc_ids, freqs = doc_ids[order], freqs[order]
+            gaps = np.diff(doc_ids, prepend=0)
+            values = np.concatenate((gaps, freqs))
+            if compression == 'vbyte':
+                encoded = vbyte_encode(values.tolist())
+            else:
+                encoded = values.astype('<u4').tobytes()
+            blocks_offset = -1
+            if doc_lengths is not None:
+                lengths = np.array([doc_lengths[doc_id] for doc_id in doc_ids.tolist()], dtype=np.int64)
+                blocks.append(block_maxima(doc_ids, freqs, lengths, block_size, avgdl))
+                blocks_offset = n_blocks
+                n_blocks += len(blocks[-1])
+            terms[term] = (len(data), len(encoded), len(doc_ids), blocks_offset)
+            data.extend(encoded)
+        if doc_lengths is not None:
+            blocks = np.concatenate(blocks) if blocks else np.zeros(0, dtype=block_dtype)
+        else:
+            blocks = None
+        return cls(terms, bytes(data), compression, blocks, block_size, avgdl)
+
+    @classmethod
+    def from_dict(cls, index, compression=None):
+        """
+        Converts index of the form term:[freq, (doc_id_1, doc_freq_1), ...] to compact one.
+        Document frequency is taken as the number of postings
+        """
+        postings = {}
+        for term, post_list in index.items():
+            doc_ids = [doc_id for doc_id, _ in post_list[1:]]
+            freqs = [freq for _, freq in post_list[1:]]
+            postings[term] = (doc_ids, freqs)
+        return cls.build(postings, compression)
+
+    def __contains__(self, term):
+        return term in self.terms
+
+    def __len__(self):
+        return len(self.terms)
+
+    def __iter__(self):
+        return iter(self.terms)
+
+    def keys(self):
+        return self.terms.keys()
+
+    def df(self, term):
+        """
+        :return: document frequency of term, 0 if term is not in index
+        """
+        if term not in self.terms:
+            return 0
+        return self.terms[term][2]
+
+    def postings(self, term):
+        """
+        Decodes posting list of a term
+        :param term: term to look up
+        :return: tuple of numpy arrays (doc_ids, term_freqs), sorted by doc_id
+        """
+        offset, n_bytes, df, _ = self.terms[term]
+        if self.compression == 'vbyte':
+            block = vbyte_decode(self.data[offset: offset + n_bytes])
+        else:
+            block = np.frombuffer(self.data, dtype='<u4', count=2 * df, offset=offset)
+        doc_ids = np.cumsum(block[:df], dtype=np.int64)
+        return doc_ids, block[df:].astype(np.int64)
+
+    def block_reader(self, term):
+        """
+        Reader of single blocks of the posting list of a term, see term_blocks. Raw postings
+        of a block are read directly, its first gap is counted from the last doc id
+        of the previous block
+        :return: function block -> tuple of numpy arrays (doc_ids, term_freqs), None if
+                 the index can not read blocks separately (it has no block maxima or is compressed)
+        """
+        offset, _, df, blocks_offset = self.terms[term]
+        if self.blocks is None or blocks_offset < 0 or self.compression is not None:
+            return None
+        n_blocks = (df + self.block_size - 1) // self.block_size
+        last_docs = np.asarray(self.blocks[blocks_offset: blocks_offset + n_blocks]['last_doc'])
+
+        def read(block):
+            start = block * self.block_size
+            count = min(df - start, self.block_size)
+            first_doc = int(last_docs[block - 1]) if block > 0 else 0
+            gaps = np.frombuffer(self.data, dtype='<u4', count=count, offset=offset + 4 * start)
+            freqs = np.frombuffer(self.data, dtype='<u4', count=count, offset=offset + 4 * (df + start))
+            return first_doc + np.cumsum(gaps, dtype=np.int64), freqs.astype(np.int64)
+        return read
+
+    def term_blocks(self, term):
+        """
+        :return: tuple (block maxima of term posting list, see block_maxima, avgdl they
+                 were computed for), None if index has none
+        """
+        _, _, df, blocks_offset = self.terms[term]
+        if self.blocks is None or blocks_offset < 0:
+            return None
+        n_blocks = (df + self.block_size - 1) // self.block_size
+        return self.blocks[blocks_offset: blocks_offset + n_blocks], self.avgdl
+
+    def save(self, terms_path, postings_path, blocks_path):
+        """
+        Writes postings buffer, the sorted term table and block maxima. Compression flag,
+        block size and avgdl are kept in the header of postings file, it is padded to keep
+        uint32 arrays aligned
+        """
+        with open(postings_path, 'wb') as fd:
+            header = bytes([self.compressions.index(self.compression), 0, 0, 0])
+            header += np.uint32(self.block_size).tobytes()
+            header += np.float64(self.avgdl).tobytes()
+            fd.write(header.ljust(self.header_size, b'\0'))
+            fd.write(self.data)
+        terms = dict((term, (offset + self.header_size, n_bytes, df, blocks_offset))
+                     for term, (offset, n_bytes, df, blocks_offset) in self.terms.items())
+        Lexicon.build(terms).save(terms_path)
+        blocks = self.blocks if self.blocks is not None else np.zeros(0, dtype=block_dtype)
+        save_array(blocks, blocks_path)
+
+    @classmethod
+    def load(cls, terms_path, postings_path, blocks_path, use_mmap=True):
+        """
+        Opens index saved with save. With use_mmap postings, term table and block maxima
+        stay on disk and are paged in only for the terms queries touch
+        """
+        if use_mmap:
+            data = map_file(postings_path)
+        else:
+            with open(postings_path, 'rb') as fd:
+                data = fd.read()
+        compression = cls.compressions[data[0]]
+        block_size = int(np.frombuffer(data, dtype='<u4', count=1, offset=4)[0])
+        avgdl = float(np.frombuffer(data, dtype='<f8', count=1, offset=8)[0])
+        return cls(Lexicon.load(terms_path, use_mmap), data, compression,
+                   load_array(blocks_path, use_mmap), block_size, avgdl)
@@ -1,136 +1,110 @@
 import numpy as np
-from collections import Counter
-from search_engine.utils import preprocess
 
-def docs2vecs(docs, engine):
-    '''Converts documents to vector representation
-    
+from search_engine import vectorized
+
+
+def docs2vecs(doc_ids, forward_index, stats):
+    '''Converts documents to sparse tf-idf vectors
+
+    Terms and their frequencies are read from the forward index,
+    for all documents at once
+
     Args:
-        docs: documents to be converted
+        doc_ids: numpy array of ids of indexed documents
+        forward_index: ForwardIndex or SegmentedForward
+        stats: CollectionStats
     Returns:
-        resulting vectors
+        tuple (terms, rows, cols, weights) - distinct terms of the documents
+        and numpy arrays, weights[i] is the weight of terms[cols[i]]
+        in document doc_ids[rows[i]]
     '''
-    vectors = {}
-    for doc_id, doc in docs.items():
-        terms = preprocess(str(doc))
-        vectors[doc_id] = Counter()
-        for term in terms:
-            vectors[doc_id][term] += 1
-            
-    for doc_id in vectors:
-        for term in vectors[doc_id]:
-            if term in engine.inv_index:
-                idf = np.log10(len(engine.documents) / engine.inv_index[term][0])
-            else:
-                idf = 0
-            vectors[doc_id][term] *= idf
-    
-    return vectors
-
-
-def rocchio(query, relevance, top_docs, engine, alph=1.0, beta=0.75, gamma=0.15):
+    terms, rows, cols, counts = forward_index.term_vectors(doc_ids)
+    dfs = stats.doc_freqs(terms).astype(np.float64)
+    # terms which are not in the collection any more get zero weight
+    idfs = np.where(dfs > 0, np.log10(stats.n_docs / np.maximum(dfs, 1)), 0.0)
+    return terms, rows, cols, counts * idfs[cols]
+
+
+def rocchio(query, relevant_n, doc_ids, forward_index, stats, alph=1.0, beta=0.75, gamma=0.15,
+            n_terms=2):
     '''Implementation of Rocchio algorithm
 
+    Centroids of relevant and irrelevant docs are sums of sparse
+    vectors computed with np.bincount. The n_terms best terms of the
+    relevant centroid replace or join the query terms, then the irrelevant
+    centroid is subtracted from all terms of the new query
+
     Args:
-        query: input query
-        relevance: list of relevant docs for query
-        top_docs: top k docs for query
+        query: input query, dict term:weight
+        relevant_n: number of first docs of doc_ids which are relevant
+        doc_ids: top k docs for query, numpy array
         alph: weight of original query
         beta: weight of relevant docs
         gamma: weight of irrelevant docs
+        n_terms: number of best terms of the relevant centroid to take
     Return:
         modified query as Dict (term: score)
     '''
-    top_docs_vectors = docs2vecs(top_docs, engine)
-    query_vector = Counter(preprocess(query))
-    new_query = dict((k, v * alph) for k, v in query_vector.items())
-    
-    # center for relevant docs
-    center = dict((k, 0) for k in query_vector.keys()) 
-    relevant_docs = set()
-    for doc_id, _ in relevance:
-        if doc_id in top_docs_vectors:
-            relevant_docs.add(doc_id)
-            for term in top_docs_vectors[doc_id]:
-                if term in center:
-                    center[term] += top_docs_vectors[doc_id][term]
-                else:
-                    center[term] = top_docs_vectors[doc_id][term]
-
-    # center for irrelevant docs
-    neg_center = dict((k, 0) for k in query_vector.keys())
-    for doc_id in top_docs_vectors:
-        if doc_id not in relevant_docs:
-            for term in top_docs_vectors[doc_id]:
-                if term in neg_center:
-                    neg_center[term] += top_docs_vectors[doc_id][term]
-                else:
-                    neg_center[term] = top_docs_vectors[doc_id][term]
-    
+    new_query = dict((term, weight * alph) for term, weight in query.items())
     # if no relevant docs, return same query
-    if len(relevant_docs) == 0:
+    if relevant_n == 0:
         return new_query
 
-    term_candidates = {}
-    # recalculate weights for terms and add new
-    for term in center:
-        if term in term_candidates:
-        # if term in new_query:
-            # new_query[term] += beta * 1 / len(relevant_docs) * center[term]
-            term_candidates[term] += beta * 1 / len(relevant_docs) * center[term]
-        else:
-            # new_query[term] = beta * 1 / len(relevant_docs) * center[term]
-            term_candidates[term] = beta * 1 / len(relevant_docs) * center[term]
-    
-    term_candidates = sorted(term_candidates.items(), key=lambda item: item[1], reverse=True)
-    for term_score in term_candidates[:2]:
-        new_query[term_score[0]] = term_score[1]
-
-    non_rel_cnt = len(top_docs_vectors) - len(relevant_docs)
+    non_rel_cnt = len(doc_ids) - relevant_n
+    if gamma == 0 or non_rel_cnt == 0:
+        # irrelevant docs are not needed
+        doc_ids = doc_ids[:relevant_n]
+    terms, rows, cols, weights = docs2vecs(doc_ids, forward_index, stats)
+    # query terms which are not in the docs go last, they have zero weight in both centroids
+    position = {}
+    for term in query:
+        try:
+            position[term] = terms.index(term)
+        except ValueError:
+            position[term] = len(terms)
+            terms.append(term)
+    relevant = rows < relevant_n
+    center = np.bincount(cols[relevant], weights=weights[relevant], minlength=len(terms))
+    center *= beta / relevant_n
+
+    # best terms of the relevant centroid, query terms among them, get its weight.
+    # Ties go to query terms, then to terms of better relevant docs
+    order = np.full(len(terms), np.iinfo(np.int64).max)
+    np.minimum.at(order, cols[relevant], rows[relevant] * len(terms) + cols[relevant])
+    order[list(position.values())] = np.arange(-len(query), 0)
+    candidates = np.flatnonzero(order < np.iinfo(np.int64).max)
+    by_order = dict(zip(order[candidates].tolist(), candidates.tolist()))
+    for neg_score, key in vectorized.top_k(order[candidates], center[candidates], n_terms):
+        position.setdefault(terms[by_order[key]], by_order[key])
+        new_query[terms[by_order[key]]] = -neg_score
+
     if gamma > 0 and non_rel_cnt > 0:
-        for term in neg_center:
-            if term in new_query:
-                new_query[term] -= gamma * 1 / non_rel_cnt * neg_center[term]
-                new_query[term] = max(0, new_query[term])
-    
-    return new_query
+        neg_center = np.bincount(cols[~relevant], weights=weights[~relevant], minlength=len(terms))
+        neg_center *= gamma / non_rel_cnt
+        for term in new_query:
+            new_query[term] = max(0.0, new_query[term] - float(neg_center[position[term]]))
 
+    return new_query
 
-def get_k_relevant_docs(docs, k):
-    ''' Returns relevance for top k relevant docs
 
-    Args:
-        docs: considered docs
-        k: amount of docs to return
-    Returns:
-        list of k tuples: (doc_id, 1)
-    '''
-    relevance = []
-    relevant_cnt = min(int(len(docs) / 2), k)
-    for doc_id in docs:
-        if relevant_cnt == 0:
-            break
-        else:
-            relevance.append((doc_id, 1))
-            relevant_cnt -= 1
-    
-    return relevance
-
-
-def pseudo_relevance_feedback(query, top_docs, engine, relevant_n=5, alph=1.0, beta=0.75, gamma=0):
+def pseudo_relevance_feedback(query, doc_ids, forward_index, stats, relevant_n=5, alph=1.0,
+                              beta=0.75, gamma=0, n_terms=2):
     '''Implementation of pseudo relevance feedback
-    
-    Based on implementation of roccio algorithm
+
+    Based on implementation of roccio algorithm, at most
+    half of top docs are considered relevant
 
     Args:
-        query: input query
-        top_docs: top k docs for query
+        query: input query, dict term:weight
+        doc_ids: top k docs for query, best first
         relevant_n: number of first docs to consider relevant
         alph: weight of original query
         beta: weight of relevant docs
         gamma: weight of irrelevant docs
+        n_terms: number of new terms to add
     Return:
         modified query as Dict (term: score)
     '''
-    relevance = get_k_relevant_docs(top_docs, relevant_n)
-    return rocchio(query, relevance, top_docs, engine, alph, beta, gamma)
\ No newline at end of file
+    doc_ids = np.asarray(doc_ids, dtype=np.int64)
+    relevant_n = min(len(doc_ids) // 2, relevant_n)
+    return rocchio(query, relevant_n, doc_ids, forward_index, stats, alph, beta, gamma, n_terms)
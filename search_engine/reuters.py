@@ -0,0 +1,90 @@
+import html
+import os
+import re
+from collections import namedtuple
+
+ReutersDocument = namedtuple('ReutersDocument', ['newid', 'title', 'body', 'categories'])
+
+category_tags = ('topics', 'places', 'people', 'orgs', 'exchanges', 'companies')
+
+_doc_end = re.compile(r'</REUTERS>', re.I)
+_newid = re.compile(r'<REUTERS\b[^>]*?\bNEWID="(\d+)"', re.I)
+_title = re.compile(r'<TITLE>(.*?)</TITLE>', re.I | re.S)
+_body = re.compile(r'<BODY>(.*?)</BODY>', re.I | re.S)
+_categories = dict((tag, re.compile(rf'<{tag}>(.*?)</{tag}>', re.I | re.S)) for tag in category_tags)
+_category_value = re.compile(r'<D>(.*?)</D>', re.I | re.S)
+_charref = re.compile(r'&(#[0-9]+|#[xX][0-9a-fA-F]+|[a-zA-Z][a-zA-Z0-9]*);')
+
+
+def _replace_charref(match):
+    ref = match.group(1)
+    if ref[0] != '#':
+        return html.unescape(match.group(0))
+    code = int(ref[2:], 16) if ref[1] in 'xX' else int(ref[1:])
+    # same as html.parser tree builder of BeautifulSoup: control characters are kept,
+    # 128-159 are treated as windows-1252
+    if 128 <= code < 160:
+        try:
+            return bytes([code]).decode('cp1252')
+        except UnicodeDecodeError:
+            pass
+    return chr(code)
+
+
+def unescape(text):
+    return _charref.sub(_replace_charref, text)
+
+
+def _tag_text(pattern, text):
+    match = pattern.search(text)
+    return unescape(match.group(1)) if match else ''
+
+
+def parse_document(text):
+    """
+    Extracts fields of one <REUTERS>...</REUTERS> element
+    :param text: raw sgml of the element
+    :return: ReutersDocument, categories is a dict tag:[value1, value2, ...] for category_tags
+    """
+    doc_id = int(_newid.search(text).group(1))
+    categories = {}
+    for tag, pattern in _categories.items():
+        match = pattern.search(text)
+        values = _category_value.findall(match.group(1)) if match else []
+        categories[tag] = [unescape(value) for value in values]
+    return ReutersDocument(doc_id, _tag_text(_title, text), _tag_text(_body, text), categories)
+
+
+def iter_documents(filepath, chunk_size=1 << 16):
+    """
+    Streams documents of one .sgm file without building a parse tree,
+    only the currently read document is kept in memory
+    :param filepath: path to .sgm file
+    :return: generator of ReutersDocument
+    """
+    with open(filepath, 'r', encoding='latin1') as file:
+        buffer = ''
+        for chunk in iter(lambda: file.read(chunk_size), ''):
+            buffer += chunk
+            match = _doc_end.search(buffer)
+            while match:
+                yield parse_document(buffer[:match.start()])
+                buffer = buffer[match.end():]
+                match = _doc_end.search(buffer)
+
+
+def list_files(path):
+    """
+    :param path: directory with original reuters files
+    :return: sorted list of .sgm file paths
+    """
+    return [os.path.join(path, filename) for filename in sorted(os.listdir(path))
+            if filename.endswith('.sgm')]
+
+
+def iter_corpus(path):
+    """
+    Streams documents of all .sgm files in path, in file order
+    """
+    for filepath in list_files(path):
+        yield from iter_documents(filepath)
@@ -0,0 +1,497 @@
+import os
+import pickle
+import threading
+from collections.abc import Mapping
+from functools import cached_property
+
+import numpy as np
+
+from search_engine import indexing
+from search_engine import reuters
+from search_engine.positions import PhraseIndex
+from search_engine.storage import DocIdMap
+
+
+class Segment(object):
+    """
+    Immutable part of the index - postings, doc lengths, documents, categories, forward
+    and positional indexes of a batch of documents, stored in files given by paths.
+    Deleted documents are only marked as tombstones until segments are merged
+    """
+
+    def __init__(self, paths, deleted=(), use_mmap=True):
+        self.paths = paths
+        self.use_mmap = use_mmap
+        self.inv_index, self.doc_lengths, self.documents = indexing.load_index(paths, use_mmap)
+        self.deleted = set()
+        self._deleted_ids = np.zeros(0, dtype=np.int64)
+        self.delete(deleted)
+
+    @cached_property
+    def categories(self):
+        with open(self.paths['categories'], 'rb') as fd:
+            return pickle.load(fd)
+
+    @cached_property
+    def forward(self):
+        return indexing.load_forward_index(self.paths, self.use_mmap)
+
+    @cached_property
+    def positions(self):
+        return indexing.load_positions(self.paths, self.use_mmap)
+
+    def delete(self, doc_ids):
+        """
+        Marks documents of this segment as deleted
+        :param doc_ids: iterable of doc ids, ids from other segments are ignored
+        :return: set of doc ids that were deleted
+        """
+        deleted = set(doc_id for doc_id in doc_ids
+                      if doc_id in self.doc_lengths and doc_id not in self.deleted)
+        if deleted:
+            self.deleted |= deleted
+            self._deleted_ids = np.array(sorted(self.deleted), dtype=np.int64)
+        return deleted
+
+    def is_live(self, doc_id):
+        return doc_id in self.doc_lengths and doc_id not in self.deleted
+
+    def live_mask(self, doc_ids):
+        """
+        :param doc_ids: numpy array of doc ids of this segment
+        :return: boolean numpy array, which of them are not deleted
+        """
+        return ~np.isin(doc_ids, self._deleted_ids)
+
+    def postings(self, term):
+        """
+        :return: tuple of numpy arrays (doc_ids, term_freqs) without deleted documents
+        """
+        doc_ids, freqs = self.inv_index.postings(term)
+        if len(self._deleted_ids):
+            live = self.live_mask(doc_ids)
+            doc_ids, freqs = doc_ids[live], freqs[live]
+        return doc_ids, freqs
+
+    def term_positions(self, term):
+        """
+        :return: tuple of numpy arrays (doc_ids, counts, positions) without deleted documents,
+                 see PositionalIndex.positions
+        """
+        doc_ids, counts, positions = self.positions.positions(term)
+        if len(self._deleted_ids):
+            live = self.live_mask(doc_ids)
+            doc_ids, counts, positions = doc_ids[live], counts[live], positions[np.repeat(live, counts)]
+        return doc_ids, counts, positions
+
+
+class SegmentedIndex(object):
+    """
+    PostingsIndex interface over several segments, deleted documents are skipped
+    """
+
+    def __init__(self, segments):
+        self.segments = segments
+        self.has_deletes = any(seg.deleted for seg in segments)
+        self._terms = None
+
+    def __contains__(self, term):
+        if self.has_deletes:
+            return self.df(term) > 0
+        return any(term in seg.inv_index for seg in self.segments)
+
+    def _all_terms(self):
+        if self._terms is None:
+            terms = {}
+            for seg in self.segments:
+                terms.update(dict.fromkeys(seg.inv_index))
+            self._terms = terms
+        return self._terms
+
+    def __iter__(self):
+        return iter(self._all_terms())
+
+    def __len__(self):
+        return len(self._all_terms())
+
+    def keys(self):
+        return self._all_terms().keys()
+
+    def df(self, term):
+        if self.has_deletes:
+            parts = [seg.postings(term)[0] for seg in self.segments if term in seg.inv_index]
+            return sum(len(doc_ids) for doc_ids in parts)
+        return sum(seg.inv_index.df(term) for seg in self.segments)
+
+    def postings(self, term):
+        """
+        :return: tuple of numpy arrays (doc_ids, term_freqs) merged from all segments,
+                 sorted by doc_id
+        """
+        parts = [seg.postings(term) for seg in self.segments if term in seg.inv_index]
+        if not parts:
+            raise KeyError(term)
+        if len(parts) == 1:
+            return parts[0]
+        doc_ids = np.concatenate([doc_ids for doc_ids, _ in parts])
+        freqs = np.concatenate([freqs for _, freqs in parts])
+        order = np.argsort(doc_ids, kind='stable')
+        return doc_ids[order], freqs[order]
+
+    def term_blocks(self, term):
+        """
+        :return: block maxima of the term and their avgdl if only one segment holds it
+                 and has no deletes, else None
+        """
+        holders = [seg for seg in self.segments if term in seg.inv_index]
+        if len(holders) == 1 and not holders[0].deleted:
+            return holders[0].inv_index.term_blocks(term)
+        return None
+
+    def block_reader(self, term):
+        """
+        :return: reader of blocks of the term postings, see PostingsIndex.block_reader,
+                 if term_blocks gives block maxima for it, else None
+        """
+        holders = [seg for seg in self.segments if term in seg.inv_index]
+        if len(holders) == 1 and not holders[0].deleted:
+            return holders[0].inv_index.block_reader(term)
+        return None
+
+
+class SegmentedPositions(object):
+    """
+    PositionalIndex interface over several segments, deleted documents are skipped
+    """
+
+    def __init__(self, segments):
+        self.segments = segments
+
+    def __contains__(self, term):
+        return any(term in seg.positions for seg in self.segments)
+
+    def positions(self, term):
+        """
+        :return: tuple of numpy arrays (doc_ids, counts, positions) merged from all segments,
+                 sorted by doc_id
+        """
+        parts = [seg.term_positions(term) for seg in self.segments if term in seg.positions]
+        if not parts:
+            raise KeyError(term)
+        if len(parts) == 1:
+            return parts[0]
+        doc_ids, counts, positions = [np.concatenate(arrays) for arrays in zip(*parts)]
+        order = np.argsort(doc_ids, kind='stable')
+        # positions of every document move with it
+        starts = (np.cumsum(counts) - counts)[order]
+        counts = counts[order]
+        moved = np.repeat(starts - (np.cumsum(counts) - counts), counts) + np.arange(len(positions))
+        return doc_ids[order], counts, positions[moved]
+
+
+class SegmentMap(Mapping):
+    """
+    Read-only doc_id:value mapping chaining the same attribute of several segments
+    (doc_lengths, documents, categories or forward), deleted documents are skipped
+    """
+
+    def __init__(self, segments, attr):
+        self.segments = segments
+        self.attr = attr
+        self._size = None
+
+    def __getitem__(self, doc_id):
+        for seg in reversed(self.segments):
+            if seg.is_live(doc_id):
+                return getattr(seg, self.attr)[doc_id]
+        raise KeyError(doc_id)
+
+    def __contains__(self, doc_id):
+        return any(seg.is_live(doc_id) for seg in self.segments)
+
+    def __iter__(self):
+        for seg in self.segments:
+            for doc_id in seg.doc_lengths:
+                if doc_id not in seg.deleted:
+                    yield doc_id
+
+    def __len__(self):
+        if self._size is None:
+            self._size = sum(len(seg.doc_lengths) - len(seg.deleted) for seg in self.segments)
+        return self._size
+
+    def lookup(self, doc_ids):
+        """
+        :param doc_ids: numpy array of doc ids present in the mapping
+        :return: numpy array of their values
+        """
+        return np.array([self[doc_id] for doc_id in doc_ids.tolist()], dtype=np.int64)
+
+    def values(self):
+        result = []
+        for seg in self.segments:
+            mapping = getattr(seg, self.attr)
+            if seg.deleted:
+                result.extend(mapping[doc_id] for doc_id in seg.doc_lengths
+                              if doc_id not in seg.deleted)
+            else:
+                result.extend(mapping.values())
+        return result
+
+
+class SegmentedForward(SegmentMap):
+    """
+    SegmentMap of forward indexes, term vectors are read from the segment holding each document
+    """
+
+    def __init__(self, segments):
+        super().__init__(segments, 'forward')
+
+    def term_vectors(self, doc_ids):
+        """
+        :return: tuple (terms, rows, cols, counts), see ForwardIndex.term_vectors
+        """
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        owners = np.full(len(doc_ids), -1)
+        for i, doc_id in enumerate(doc_ids.tolist()):
+            for number in reversed(range(len(self.segments))):
+                if self.segments[number].is_live(doc_id):
+                    owners[i] = number
+                    break
+
+        # term numbers of segments are mapped to numbers of their terms in the result
+        numbers = {}
+        parts = [(np.zeros(0, dtype=np.int64),) * 3]
+        for number in np.unique(owners[owners >= 0]).tolist():
+            held = np.flatnonzero(owners == number)
+            terms, rows, cols, counts = self.segments[number].forward.term_vectors(doc_ids[held])
+            term_numbers = np.array([numbers.setdefault(term, len(numbers)) for term in terms], 
+                                    dtype=np.int64)
+            parts.append((held[rows], term_numbers[cols], counts))
+        rows, cols, counts = [np.concatenate(arrays) for arrays in zip(*parts)]
+        return list(numbers), rows, cols, counts
+
+
+def empty_categories():
+    return dict((tag, []) for tag in reuters.category_tags)
+
+
+def merge_segments(segments, save_paths, compression=None, deleted=None):
+    """
+    Writes live documents of several segments as one segment. Files are written
+    next to the target paths and then renamed, so the segments being merged
+    (possibly mapped from the same paths) stay readable
+    :param segments: list of Segment
+    :param save_paths: paths of the resulting segment
+    :param deleted: list of sets of deleted doc ids of every segment, taken when the merge
+                    started, current tombstones if None. Documents deleted while a merge runs
+                    stay in the result, so its postings and documents agree
+    """
+    if deleted is None:
+        deleted = [set(seg.deleted) for seg in segments]
+    index = {}
+    doc_lengths = {}
+    documents = {}
+    categories = {}
+    analyzed = {}
+
+    for seg, seg_deleted in zip(segments, deleted):
+        deleted_ids = np.array(sorted(seg_deleted), dtype=np.int64)
+        for term in seg.inv_index:
+            doc_ids, freqs = seg.inv_index.postings(term)
+            if len(deleted_ids):
+                live = ~np.isin(doc_ids, deleted_ids)
+                doc_ids, freqs = doc_ids[live], freqs[live]
+            if len(doc_ids) > 0:
+                if term not in index:
+                    index[term] = ([], [])
+                index[term][0].extend(doc_ids.tolist())
+                index[term][1].extend(freqs.tolist())
+        for doc_id in seg.doc_lengths:
+            if doc_id not in seg_deleted:
+                doc_lengths[doc_id] = seg.doc_lengths[doc_id]
+                documents[doc_id] = seg.documents[doc_id]
+                categories[doc_id] = seg.categories.get(doc_id, empty_categories())
+                analyzed[doc_id] = seg.forward[doc_id]
+
+    tmp_paths = dict((key, f'{path}.tmp') for key, path in save_paths.items())
+    indexing.save_index(index, doc_lengths, documents, categories, analyzed, tmp_paths, compression)
+    for key, path in save_paths.items():
+        os.replace(tmp_paths[key], path)
+
+
+class SegmentManager(object):
+    """
+    Keeps the list of segments of the index. The base segment is the one built by
+    indexing.build_inverted_index, added documents go to new small segments.
+    The manifest file records segments, their tombstones, index version,
+    which is increased on every change of the index contents, and ids of added documents.
+    Segments are indexed by dense doc numbers of id_map, ids of the base index are numbered
+    when it is built, ids of added documents get the next numbers, see storage.DocIdMap.
+    When there are more than max_segments added segments they are merged in a background thread
+    """
+
+    def __init__(self, base_paths, segments_dir, manifest_path, compression=None,
+                 use_mmap=True, max_segments=8):
+        # the doc id map is kept apart from segment files, see id_map
+        self.base_paths = dict((key, path) for key, path in base_paths.items() if key != 'doc_ids')
+        self.segments_dir = segments_dir
+        self.manifest_path = manifest_path
+        self.compression = compression
+        self.use_mmap = use_mmap
+        self.max_segments = max_segments
+        self.lock = threading.RLock()
+        self.merge_thread = None
+
+        if os.path.isfile(manifest_path):
+            with open(manifest_path, 'rb') as fd:
+                manifest = pickle.load(fd)
+            self.version = manifest['version']
+            self.next_segment = manifest['next_segment']
+            self.segments = [Segment(paths, deleted, use_mmap)
+                             for paths, deleted in manifest['segments']]
+            added_ids = manifest['added_ids']
+        else:
+            self.version = 0
+            self.next_segment = 1
+            self.segments = [Segment(self.base_paths, (), use_mmap)]
+            added_ids = ()
+        self.id_map = DocIdMap.load(base_paths['doc_ids'], added_ids, use_mmap)
+        self._refresh()
+
+    def _refresh(self):
+        segments = list(self.segments)
+        if len(segments) == 1 and not segments[0].deleted:
+            self.inv_index = segments[0].inv_index
+            self.doc_lengths = segments[0].doc_lengths
+            self.documents = segments[0].documents
+            self.forward = segments[0].forward
+            self.positions = segments[0].positions
+        else:
+            self.inv_index = SegmentedIndex(segments)
+            self.doc_lengths = SegmentMap(segments, 'doc_lengths')
+            self.documents = SegmentMap(segments, 'documents')
+            self.forward = SegmentedForward(segments)
+            self.positions = SegmentedPositions(segments)
+        self.phrases = PhraseIndex(self.positions)
+        self.categories = SegmentMap(segments, 'categories')
+
+    def _save_manifest(self):
+        manifest = {
+            'version': self.version,
+            'next_segment': self.next_segment,
+            'segments': [(seg.paths, seg.deleted) for seg in self.segments],
+            'added_ids': self.id_map.added
+        }
+        tmp_path = f'{self.manifest_path}.tmp'
+        with open(tmp_path, 'wb') as fd:
+            pickle.dump(manifest, fd)
+        os.replace(tmp_path, self.manifest_path)
+
+    def _new_segment_paths(self):
+        name = f'seg_{self.next_segment}'
+        self.next_segment += 1
+        os.makedirs(self.segments_dir, exist_ok=True)
+        return dict((key, os.path.join(self.segments_dir, f'{name}_{os.path.basename(path)}'))
+                    for key, path in self.base_paths.items())
+
+    def number_documents(self, doc_ids):
+        """
+        Gives dense numbers to external ids of documents to be added, they are recorded
+        in the manifest with the next segment
+        :param doc_ids: iterable of external doc ids
+        :return: list of their numbers
+        """
+        with self.lock:
+            return self.id_map.add(doc_ids)
+
+    def add_segment(self, index, doc_lengths, documents, categories, analyzed):
+        """
+        Writes documents as a new segment and makes them searchable. All structures are
+        indexed by doc numbers, see number_documents
+        :param index: term:([doc_id_1, ...], [doc_freq_1, ...])
+        :param doc_lengths: doc_id:doc_length
+        :param documents: doc_id:doc_content
+        :param categories: doc_id:{category_tag: [value1, ...]}
+        :param analyzed: doc_id:AnalyzedDocument
+        """
+        with self.lock:
+            paths = self._new_segment_paths()
+        indexing.save_index(index, doc_lengths, documents, categories, analyzed, paths, 
+                            self.compression)
+        segment = Segment(paths, (), self.use_mmap)
+        with self.lock:
+            self.segments.append(segment)
+            self.version += 1
+            self._save_manifest()
+            self._refresh()
+        if len(self.segments) - 1 > self.max_segments:
+            self.merge(background=True)
+
+    def delete(self, doc_ids):
+        """
+        Marks documents as deleted in all segments
+        :return: set of doc ids that were deleted
+        """
+        with self.lock:
+            deleted = set()
+            for seg in self.segments:
+                deleted |= seg.delete(doc_ids)
+            if deleted:
+                self.version += 1
+                self._save_manifest()
+                self._refresh()
+        return deleted
+
+    def merge(self, include_base=False, background=False):
+        """
+        Merges added segments (and the base one, if include_base) into one, dropping deleted documents
+        :param background: run merge in a separate thread, only one merge runs at a time
+        """
+        if self.merge_thread is not None and self.merge_thread.is_alive():
+            if not background:
+                self.merge_thread.join()
+            else:
+                return
+        if background:
+            self.merge_thread = threading.Thread(target=self._merge, args=(include_base,), daemon=True)
+            self.merge_thread.start()
+        else:
+            self._merge(include_base)
+
+    def wait(self):
+        """
+        Blocks until background merge finishes
+        """
+        if self.merge_thread is not None:
+            self.merge_thread.join()
+
+    def _merge(self, include_base):
+        with self.lock:
+            merged = list(self.segments if include_base else self.segments[1:])
+            if len(merged) < 2 and not any(seg.deleted for seg in merged):
+                return
+            paths = self.base_paths if include_base else self._new_segment_paths()
+            # tombstones at this point are dropped by the merge, old copies of replaced
+            # documents must not hide their new copies merged into the same segment
+            snapshot = [set(seg.deleted) for seg in merged]
+
+        merge_segments(merged, paths, self.compression, snapshot)
+
+        with self.lock:
+            # only documents deleted while merging are deleted in the new segment again
+            deleted = set()
+            for seg, seg_deleted in zip(merged, snapshot):
+                deleted |= seg.deleted - seg_deleted
+            segment = Segment(paths, deleted, self.use_mmap)
+            position = self.segments.index(merged[0])
+            self.segments = [seg for seg in self.segments if seg not in merged]
+            self.segments.insert(position, segment)
+            self._save_manifest()
+            self._refresh()
+
+        for seg in merged:
+            if seg.paths != self.base_paths and seg.paths != paths:
+                for path in seg.paths.values():
+                    if os.path.isfile(path):
+                        os.remove(path)
@@ -0,0 +1,414 @@
+import argparse
+import asyncio
+import json
+import os
+import signal
+import time
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from search_engine import facets
+from search_engine.engine import SearchEngine
+
+# scorings answer_queries supports
+scorings = ('okapi', 'cosine', 'lm', 'okapi_np', 'cosine_np', 'lm_np', 'impact', 'proximity')
+
+max_top_k = 1000
+max_body_size = 1 << 16
+# connections waiting to be accepted, bursts of new connections are not refused
+backlog = 1024
+
+reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+           413: 'Payload Too Large', 500: 'Internal Server Error', 503: 'Service Unavailable',
+           504: 'Gateway Timeout'}
+
+# request - validated search parameters, deadline - time.time() after which the answer is useless,
+# future - resolved with the result of the worker
+Pending = namedtuple('Pending', ['request', 'deadline', 'future'])
+
+# engine of a worker process, see _init_worker
+_engine = None
+
+
+class MessageError(ValueError):
+    """
+    Message which can not be read, status is the response code for it
+    """
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+async def _read_line(reader):
+    try:
+        return await reader.readline()
+    except ValueError:
+        # readline turns LimitOverrunError into ValueError after dropping the buffered data
+        raise MessageError(400, 'Line too long')
+
+
+async def read_message(reader):
+    """
+    Reads an HTTP/1.1 request or response with a Content-Length body
+    :return: tuple (start line, dict of lower case header names to values, body bytes),
+             None if the connection is closed before a message starts
+    :raises MessageError: for a malformed or too large Content-Length or a too long line
+    """
+    start_line = await _read_line(reader)
+    if not start_line:
+        return None
+    headers = {}
+    while True:
+        line = await _read_line(reader)
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    try:
+        length = int(headers.get('content-length', 0))
+    except ValueError:
+        length = -1
+    if length < 0:
+        raise MessageError(400, 'Bad Content-Length')
+    if length > max_body_size:
+        raise MessageError(413, 'Body too large')
+    body = await reader.readexactly(length)
+    return start_line.decode('latin-1').strip(), headers, body
+
+
+def _init_worker(data_path, engine_kwargs):
+    """
+    Loads the index in a worker process. Index files are memory mapped, so all workers
+    share them in the page cache, only the pickled derived structures are loaded per worker
+    """
+    global _engine
+    _engine = SearchEngine(**engine_kwargs)
+    _engine.do_indexing(data_path)
+    # derived structures are loaded before the first request, not while answering it
+    for attr in ('stats', 'tiered_index', 'facet_index'):
+        getattr(_engine, attr)
+
+
+def _ping():
+    return os.getpid()
+
+
+def _answer_batch(requests):
+    """
+    Answers a micro-batch in a worker process. Requests with the same parameters are answered
+    by one answer_queries call, so postings of their common terms are read once.
+    Requests whose deadline has passed are skipped, a failure of one group is answered
+    with an error for that group only
+    :param requests: list of dicts with query, top_k, scoring, inexact, filters, expansion
+                     and deadline
+    :return: list of dicts, doc_ids and scores or status and error, in order of requests
+    """
+    results = [None] * len(requests)
+    groups = {}
+    for i, request in enumerate(requests):
+        key = (request['top_k'], request['scoring'], request['inexact'], request['filters'],
+               request['expansion'])
+        groups.setdefault(key, []).append(i)
+
+    for (top_k, scoring, inexact, filters, expansion), numbers in groups.items():
+        now = time.time()
+        live = []
+        for i in numbers:
+            if requests[i]['deadline'] <= now:
+                results[i] = {'status': 504, 'error': 'Deadline exceeded'}
+            else:
+                live.append(i)
+        if not live:
+            continue
+        try:
+            batch = _engine.answer_queries([requests[i]['query'] for i in live], top_k, scoring,
+                                           inexact, filters=filters, use_expansion=expansion)
+        except ValueError as e:
+            for i in live:
+                results[i] = {'status': 400, 'error': str(e)}
+            continue
+        except Exception as e:
+            for i in live:
+                results[i] = {'status': 500, 'error': str(e)}
+            continue
+        for i, result in zip(live, batch.results):
+            results[i] = {'doc_ids': result.doc_ids, 'scores': result.scores}
+    return results
+
+
+class QueryServer(object):
+    """
+    HTTP/JSON search service. The index is loaded once by every worker of a process pool,
+    the event loop only parses requests and hands them to the workers.
+    Admission control: at most max_pending requests are queued or being answered,
+    others are rejected with 503 at once. Micro-batching: a batch is sent to a worker as soon
+    as one is free, with everything queued meanwhile (at most max_batch requests), so under
+    light load requests go one by one without waiting and under load batches grow.
+    Every request has a deadline, requests which are not answered in time get 504.
+
+    POST /search {"query": "oil prices", "top_k": 10, "scoring": "okapi_np", "inexact": false,
+                  "filters": "places=usa", "expansion": false, "timeout": 1.0}
+    GET /stats, GET /health
+    """
+
+    def __init__(self, data_path, workers=4, max_batch=32, max_pending=256, default_timeout=1.0,
+                 max_timeout=10.0, **engine_kwargs):
+        """
+        :param data_path: original data path, the index is built there if it is not built yet
+        :param workers: number of worker processes
+        :param max_batch: maximum number of requests sent to a worker at once
+        :param max_pending: maximum number of requests queued or being answered
+        :param default_timeout: seconds a request may take if it does not set timeout
+        :param max_timeout: largest timeout a request may set
+        :param engine_kwargs: SearchEngine parameters
+        """
+        self.data_path = data_path
+        self.workers = workers
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        self.default_timeout = default_timeout
+        self.max_timeout = max_timeout
+        self.engine_kwargs = engine_kwargs
+        self.pool = None
+        self.queue = None
+        self.slots = None
+        self.in_flight = 0
+        self.counts = dict.fromkeys(('served', 'rejected', 'expired', 'failed', 'batches', 'batched'), 0)
+        self.latencies = deque(maxlen=10000)
+
+    def start_pool(self):
+        """
+        Builds the index and structures which are otherwise built on first use, so workers
+        only load them, then starts the workers and waits until they answer
+        """
+        engine = SearchEngine(**self.engine_kwargs)
+        engine.do_indexing(self.data_path)
+        for attr in ('impact_index', 'facet_index'):
+            getattr(engine, attr)
+        self.pool = self._new_pool()
+        for future in [self.pool.submit(_ping) for _ in range(self.workers)]:
+            future.result()
+
+    def _new_pool(self):
+        return ProcessPoolExecutor(self.workers, initializer=_init_worker,
+                                   initargs=(self.data_path, self.engine_kwargs))
+
+    def _replace_pool(self, pool):
+        """
+        Replaces a pool which is broken because a worker died, once for all batches it fails
+        """
+        if pool is self.pool:
+            pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = self._new_pool()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
+
+    async def serve(self, host='127.0.0.1', port=8080):
+        self.queue = asyncio.Queue()
+        self.slots = asyncio.Semaphore(self.workers)
+        dispatcher = asyncio.ensure_future(self._dispatch())
+        server = await asyncio.start_server(self._handle_connection, host, port, backlog=backlog)
+        serving = asyncio.ensure_future(server.serve_forever())
+        # the service stops on SIGTERM as on Ctrl+C, so workers are shut down
+        for signal_number in (signal.SIGINT, signal.SIGTERM):
+            asyncio.get_running_loop().add_signal_handler(signal_number, serving.cancel)
+        print(f'Serving on {host}:{port} with {self.workers} workers')
+        try:
+            async with server:
+                await serving
+        except asyncio.CancelledError:
+            pass
+        finally:
+            dispatcher.cancel()
+
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            await self.slots.acquire()
+            while len(batch) < self.max_batch and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            # requests whose client gave up are dropped
+            batch = [pending for pending in batch if not pending.future.done()]
+            if not batch:
+                self.slots.release()
+                continue
+            self.counts['batches'] += 1
+            self.counts['batched'] += len(batch)
+            requests = [dict(pending.request, deadline=pending.deadline) for pending in batch]
+            pool = self.pool
+            try:
+                future = loop.run_in_executor(pool, _answer_batch, requests)
+            except BrokenProcessPool:
+                # nothing of the batch has run, so it is sent to the new pool
+                self._replace_pool(pool)
+                pool = self.pool
+                future = loop.run_in_executor(pool, _answer_batch, requests)
+            future.add_done_callback(lambda done, batch=batch, pool=pool:
+                                     self._finish_batch(batch, done, pool))
+
+    def _finish_batch(self, batch, done, pool):
+        self.slots.release()
+        # futures are cancelled when the pool is shut down
+        if done.cancelled():
+            results = [{'status': 503, 'error': 'Service is shutting down'}] * len(batch)
+        elif isinstance(done.exception(), BrokenProcessPool):
+            # the batch may have killed the worker, so it is not sent again
+            self._replace_pool(pool)
+            results = [{'status': 503, 'error': 'Worker failed, pool restarted'}] * len(batch)
+        elif done.exception() is not None:
+            results = [{'status': 500, 'error': str(done.exception())}] * len(batch)
+        else:
+            results = done.result()
+        for pending, result in zip(batch, results):
+            if not pending.future.done():
+                pending.future.set_result(result)
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    message = await read_message(reader)
+                except MessageError as e:
+                    await self._respond(writer, e.status, {'error': str(e)}, False)
+                    break
+                if message is None:
+                    break
+                start_line, headers, body = message
+                parts = start_line.split()
+                if len(parts) != 3:
+                    await self._respond(writer, 400, {'error': 'Bad request line'}, False)
+                    break
+                method, target, version = parts
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                status, payload = await self._route(method, target, body)
+                await self._respond(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _respond(self, writer, status, payload, keep_alive):
+        body = json.dumps(payload).encode('utf-8')
+        head = [f'HTTP/1.1 {status} {reasons[status]}', 'Content-Type: application/json',
+                f'Content-Length: {len(body)}', 'Connection: ' + ('keep-alive' if keep_alive else 'close')]
+        if status == 503:
+            head.append('Retry-After: 1')
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + body)
+        await writer.drain()
+
+    async def _route(self, method, target, body):
+        path = target.split('?', 1)[0]
+        if path == '/search':
+            if method != 'POST':
+                return 405, {'error': 'Use POST'}
+            return await self._search(body)
+        if path in ('/stats', '/health'):
+            if method != 'GET':
+                return 405, {'error': 'Use GET'}
+            return 200, self.stats if path == '/stats' else {'status': 'ok'}
+        return 404, {'error': f'Unknown path: {path}'}
+
+    def _parse_search(self, body):
+        """
+        :return: tuple (request dict, timeout)
+        """
+        params = json.loads(body)
+        if not isinstance(params, dict) or not isinstance(params.get('query'), str):
+            raise ValueError('query string is required')
+        request = {
+            'query': params['query'],
+            'top_k': params.get('top_k', 10),
+            'scoring': params.get('scoring', 'okapi_np'),
+            'inexact': bool(params.get('inexact', False)),
+            'filters': params.get('filters'),
+            'expansion': bool(params.get('expansion', False))
+        }
+        # bool is an int subclass, json true is not a top_k
+        if (isinstance(request['top_k'], bool) or not isinstance(request['top_k'], int)
+                or not 0 < request['top_k'] <= max_top_k):
+            raise ValueError(f'top_k must be an integer from 1 to {max_top_k}')
+        if request['scoring'] not in scorings:
+            raise ValueError(f'Unknown scoring: {request["scoring"]}')
+        if request['filters'] is not None:
+            if not isinstance(request['filters'], str):
+                raise ValueError('filters must be a string')
+            facets.parse_filter(request['filters'])
+        timeout = float(params.get('timeout', self.default_timeout))
+        if not timeout > 0:
+            raise ValueError('timeout must be positive')
+        return request, min(timeout, self.max_timeout)
+
+    async def _search(self, body):
+        start_time = time.time()
+        try:
+            request, timeout = self._parse_search(body)
+        except (ValueError, TypeError) as e:
+            return 400, {'error': str(e)}
+        if self.in_flight >= self.max_pending:
+            self.counts['rejected'] += 1
+            return 503, {'error': 'Too many pending requests'}
+
+        self.in_flight += 1
+        pending = Pending(request, start_time + timeout, asyncio.get_running_loop().create_future())
+        try:
+            self.queue.put_nowait(pending)
+            result = await asyncio.wait_for(pending.future, timeout)
+        except asyncio.TimeoutError:
+            result = {'status': 504, 'error': 'Deadline exceeded'}
+        finally:
+            self.in_flight -= 1
+
+        status = result.get('status', 200)
+        if status != 200:
+            self.counts['expired' if status == 504 else 'failed'] += 1
+            return status, {'error': result['error']}
+        elapsed = time.time() - start_time
+        self.counts['served'] += 1
+        self.latencies.append(elapsed)
+        return 200, dict(result, query=request['query'], elapsed=elapsed)
+
+    @property
+    def stats(self):
+        """
+        :return: dictionary of request counts, mean batch size and latency percentiles
+                 of recent answered requests
+        """
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            return latencies[min(int(p * len(latencies)), len(latencies) - 1)] if latencies else None
+
+        return dict(self.counts, in_flight=self.in_flight, queued=self.queue.qsize(),
+                    mean_batch=self.counts['batched'] / max(self.counts['batches'], 1),
+                    p50=percentile(0.5), p99=percentile(0.99))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='HTTP/JSON search service')
+    parser.add_argument('--data', default='data.nosync/reuters21578/', help='original data path')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--max-batch', type=int, default=32)
+    parser.add_argument('--max-pending', type=int, default=256)
+    parser.add_argument('--timeout', type=float, default=1.0, help='default deadline, seconds')
+    args = parser.parse_args()
+
+    server = QueryServer(args.data, args.workers, args.max_batch, args.max_pending, args.timeout)
+    server.start_pool()
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    finally:
+        server.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+from collections import Counter, namedtuple
+
+from search_engine.doc_sum import clean_text
+
+# text - summary of the document
+# highlights - sorted (start, end) character offsets in text of words matching the query
+Snippet = namedtuple('Snippet', ['text', 'highlights'])
+
+highlight_start = '\033[1m\033[91m'
+highlight_end = '\033[0m'
+
+
+def make_snippet(doc, analyzed, query, sentence_cnt, max_sentences=256, max_chars=2000):
+    """
+    Summarizes a document for a query and finds query words in the summary. Every sentence
+    is scored by the tf of its query terms in the document, normalized on the maximum tf,
+    times their query weights, best sentences go first.
+    Sentences, their terms and term offsets are read from the forward index,
+    so the document is not tokenized again. Work per document is bounded: only the first
+    max_sentences sentences are scored and the snippet is cut to max_chars characters
+    :param doc: text of the document
+    :param analyzed: AnalyzedDocument of doc from the forward index
+    :param query: dictionary term:weight of preprocessed query terms
+    :param sentence_cnt: max number of sentences in the snippet
+    :return: Snippet
+    """
+    tf = Counter(analyzed.terms)
+    if len(tf) == 0:
+        return Snippet('', [])
+    max_freq = max(tf.values())
+    for term in tf:
+        tf[term] /= max_freq
+
+    # equal sentences are taken once
+    score_results = {}
+    sentence_spans = {}
+    text = clean_text(doc)
+    for start, end, terms, spans in analyzed.sentences[:max_sentences]:
+        sentence = text[start: end]
+        matches = []
+        for term, (term_start, term_end) in zip(terms, spans):
+            if term in query:
+                matches.append((term_start - start, term_end - start))
+                if term in tf:
+                    score_results[sentence] = score_results.get(sentence, 0) + tf[term] * query[term]
+        if sentence not in sentence_spans:
+            sentence_spans[sentence] = matches
+
+    score_results = sorted(score_results.items(), key=lambda kv: kv[1], reverse=True)
+    parts = []
+    highlights = []
+    length = 0
+    for sentence, _ in score_results[:sentence_cnt]:
+        matches = sentence_spans[sentence]
+        if length + len(sentence) > max_chars:
+            if length > 0:
+                break
+            sentence = sentence[:max_chars]
+        highlights.extend((length + term_start, length + term_end)
+                          for term_start, term_end in matches
+                          if term_start < term_end <= len(sentence))
+        parts.append(sentence + ' ')
+        length += len(sentence) + 1
+    return Snippet(''.join(parts), highlights)
+
+
+def to_ansi(snippet):
+    """
+    :return: snippet text with query words colored for the terminal
+    """
+    text = snippet.text
+    parts = []
+    offset = 0
+    for start, end in snippet.highlights:
+        parts.append(text[offset: start])
+        parts.append(highlight_start + text[start: end] + highlight_end)
+        offset = end
+    parts.append(text[offset:])
+    return ''.join(parts)
@@ -1,27 +1,59 @@
 import re
+from bisect import bisect_left
 from collections import Counter
 
+import numpy as np
+
+from search_engine.inexact import intersect_sorted
 from search_engine.utils import *
 
 
-def build_dictionary(documents):
+def build_dictionary(documents, analyzer=None):
     """
     Build dictionary of original word forms (without stemming, but tokenized, lowercased, and only apt words considered)
     :param documents: dict of documents (contents)
+    :param analyzer: utils.Analyzer documents are tokenized with, the module one if None
     :return: {'word1': freq_word1, 'word2': freq_word2, ...}
 
     """
     result = Counter()
+    words = preprocess if analyzer is None else analyzer.preprocess
 
     for doc in documents:
-        tokenized = tokenize(documents[doc].lower())
-        for w in tokenized:
-            if is_apt_word(w):
-                result[w] += 1
+        result.update(words(documents[doc], use_stem=False))
     
     return dict(result)
 
 
+def update_dictionary(dictionary, added, removed, analyzer=None):
+    """
+    Updates word frequencies of dictionary in place when documents are added or removed
+    :param dictionary: dictionary of original words
+    :param added: dict of added documents (contents)
+    :param removed: dict of removed documents (contents)
+    :param analyzer: utils.Analyzer, see build_dictionary
+    :return: tuple (new_words, dropped_words) - lists of words which appeared in
+             and disappeared from the dictionary
+    """
+    new_words = []
+    for w, freq in build_dictionary(added, analyzer).items():
+        if w in dictionary:
+            dictionary[w] += freq
+        else:
+            dictionary[w] = freq
+            new_words.append(w)
+
+    dropped_words = []
+    for w, freq in build_dictionary(removed, analyzer).items():
+        if w in dictionary:
+            dictionary[w] -= freq
+            if dictionary[w] <= 0:
+                del dictionary[w]
+                dropped_words.append(w)
+
+    return new_words, dropped_words
+
+
 def build_k_gram_index(dictionary, k):
     """
     Build index of k-grams for dictionary words. Padd with '$' ($word$) before splitting to k-grams
@@ -46,40 +78,239 @@ def build_k_gram_index(dictionary, k):
     return result
                 
 
-def generate_wildcard_options(wildcard, k_gram_index):
+class WildcardIndex(object):
+    """
+    Wildcard lookup over dictionary words. words[word_id] is the word with that id, None
+    if it was dropped. A prefix is a range of the sorted lexicon found with binary search,
+    a suffix is a range of the lexicon of reversed words, both keep ids of their words.
+    Other parts of a wildcard are looked up in the k-gram index, its posting lists are
+    sorted numpy arrays of word ids. Candidates are intersected as integer arrays and only
+    the survivors are checked with a regex. New words get the next ids, so the index is
+    updated in place: their ids are appended to posting lists
+    """
+
+    def __init__(self, words, k=2):
+        self.k = k
+        self.words = sorted(words)
+        self.word_ids = dict((word, word_id) for word_id, word in enumerate(self.words))
+        self.lexicon = list(self.words)
+        self.lexicon_ids = list(range(len(self.words)))
+        by_reversed = sorted((word[::-1], word_id) for word_id, word in enumerate(self.words))
+        self.reversed_words = [word for word, _ in by_reversed]
+        self.reversed_ids = [word_id for _, word_id in by_reversed]
+        self.k_grams = dict((gram, np.unique(np.array([self.word_ids[w] for w in gram_words], dtype=np.int64)))
+                            for gram, gram_words in build_k_gram_index(self.word_ids, k).items())
+        self.n_dropped = 0
+
+    def update(self, new_words, dropped_words):
+        """
+        Adds new words and removes dropped words in place. Ids are assigned again
+        when there are more ids of dropped words than of present ones
+        """
+        added = {}
+        for word in new_words:
+            if word not in self.word_ids:
+                word_id = len(self.words)
+                self.words.append(word)
+                self.word_ids[word] = word_id
+                _insert(self.lexicon, self.lexicon_ids, word, word_id)
+                _insert(self.reversed_words, self.reversed_ids, word[::-1], word_id)
+                for gram in self._grams(word):
+                    added.setdefault(gram, []).append(word_id)
+        for gram, word_ids in added.items():
+            word_ids = np.array(word_ids, dtype=np.int64)
+            if gram in self.k_grams:
+                word_ids = np.concatenate((self.k_grams[gram], word_ids))
+            self.k_grams[gram] = word_ids
+
+        removed = {}
+        for word in dropped_words:
+            if word in self.word_ids:
+                word_id = self.word_ids.pop(word)
+                self.words[word_id] = None
+                self.n_dropped += 1
+                _remove(self.lexicon, self.lexicon_ids, word)
+                _remove(self.reversed_words, self.reversed_ids, word[::-1])
+                for gram in self._grams(word):
+                    removed.setdefault(gram, []).append(word_id)
+        for gram, word_ids in removed.items():
+            word_ids = self.k_grams[gram][~np.isin(self.k_grams[gram], word_ids)]
+            if len(word_ids):
+                self.k_grams[gram] = word_ids
+            else:
+                del self.k_grams[gram]
+
+        if self.n_dropped > len(self.word_ids):
+            self.__init__(list(self.word_ids), self.k)
+
+    def _grams(self, word):
+        w = '$' + word + '$'
+        return set(w[i: i + self.k] for i in range(len(w) - self.k + 1))
+
+    @staticmethod
+    def _range(lexicon, prefix):
+        """
+        :return: (start, end) - positions of words with prefix in sorted lexicon
+        """
+        start = bisect_left(lexicon, prefix)
+        end = bisect_left(lexicon, prefix[:-1] + chr(ord(prefix[-1]) + 1))
+        return start, end
+
+    def expand(self, wildcard):
+        """
+        :param wildcard: lowercase word with any number of '*'
+        :return: sorted list of matching words
+        """
+        parts = wildcard.split('*')
+        if len(parts) == 1:
+            return [wildcard] if wildcard in self.word_ids else []
+
+        candidates = []
+        prefix, suffix = parts[0], parts[-1]
+        if prefix:
+            start, end = self._range(self.lexicon, prefix)
+            candidates.append(np.sort(np.array(self.lexicon_ids[start: end], dtype=np.int64)))
+        if suffix:
+            start, end = self._range(self.reversed_words, suffix[::-1])
+            candidates.append(np.sort(np.array(self.reversed_ids[start: end], dtype=np.int64)))
+        for part in parts[1:-1]:
+            for i in range(len(part) - self.k + 1):
+                candidates.append(self.k_grams.get(part[i: i + self.k], np.zeros(0, dtype=np.int64)))
+        if candidates:
+            word_ids = intersect_sorted(candidates).tolist()
+        else:
+            word_ids = self.word_ids.values()
+
+        pattern = re.compile('.*'.join(re.escape(part) for part in parts))
+        return sorted(self.words[word_id] for word_id in word_ids if pattern.fullmatch(self.words[word_id]))
+
+
+def _insert(lexicon, ids, word, word_id):
+    position = bisect_left(lexicon, word)
+    lexicon.insert(position, word)
+    ids.insert(position, word_id)
+
+
+def _remove(lexicon, ids, word):
+    position = bisect_left(lexicon, word)
+    del lexicon[position]
+    del ids[position]
+
+
+def generate_wildcard_options(wildcard, wildcard_index):
     """
-    For a given wildcard return all words matching it using k-grams
+    For a given wildcard return all words matching it, see WildcardIndex
     Refer to book chapter 3.2.2
-    Don't forget to pad wildcard with '$', when appropriate
     :param wildcard: query word in a form of a wildcard
-    :param k_gram_index:
+    :param wildcard_index: WildcardIndex of dictionary words
     :return: list of options (matching words)
     """
-    result = []
+    return wildcard_index.expand(wildcard)
 
-    k = len(list(k_gram_index.keys())[0])
-    k_grams = build_k_gram_index({wildcard: 0}, k)
 
-    wildcard = wildcard.replace('*', '.*')
-    setlist = []
-    
-    for gram in k_grams:
-        if gram in k_gram_index:
-            matched = set()
-            for word in k_gram_index[gram]:
-                mathing = re.match(wildcard, word)
-                if mathing and mathing.group(0) == word:
-                    matched.add(word)
-            
-            if len(matched) > 0:
-                setlist.append(matched)
-    
-    if len(setlist) > 0:
-        result = list(set.intersection(*setlist))
-    
+def edit_distance(a, b, max_distance):
+    """
+    Levenshtein distance between two words, where transposition of two adjacent letters
+    is one edit too (optimal string alignment). Computation stops as soon as the distance
+    exceeds max_distance
+    :return: distance, max_distance + 1 if it is larger than max_distance
+    """
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    before = None
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            distance = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b))
+            if before is not None and j > 1 and char_a == b[j - 2] and a[i - 2] == char_b:
+                distance = min(distance, before[j - 2] + 1)
+            current.append(distance)
+        if min(current) > max_distance:
+            return max_distance + 1
+        before, previous = previous, current
+    return min(previous[-1], max_distance + 1)
+
+
+def _deletes(word, max_distance):
+    """
+    :return: set of strings made from word by deleting at most max_distance characters
+    """
+    result = {word}
+    edits = {word}
+    for _ in range(max_distance):
+        edits = set(w[:i] + w[i + 1:] for w in edits for i in range(len(w)))
+        result |= edits
     return result
 
 
+class SpellingIndex(object):
+    """
+    Deletion neighbourhood index for spelling correction (SymSpell): every string made
+    from the prefix of a dictionary word by deleting up to max_distance characters points
+    to the word. Two words within edit distance max_distance share such a string, so
+    candidates of a misspelled word are found with a few dictionary lookups, and only
+    they are checked with bounded Levenshtein distance
+    """
+
+    def __init__(self, words, max_distance=2, prefix_length=7):
+        self.max_distance = max_distance
+        self.prefix_length = prefix_length
+        self.deletes = {}
+        self.update(words, ())
+
+    def update(self, new_words, dropped_words):
+        for word in dropped_words:
+            for key in _deletes(word[:self.prefix_length], self.max_distance):
+                if key in self.deletes:
+                    words = [w for w in self.deletes[key] if w != word]
+                    if words:
+                        self.deletes[key] = words
+                    else:
+                        del self.deletes[key]
+        for word in new_words:
+            for key in _deletes(word[:self.prefix_length], self.max_distance):
+                if key in self.deletes:
+                    self.deletes[key].append(word)
+                else:
+                    self.deletes[key] = [word]
+
+    def lookup(self, word, dictionary, max_distance=None, max_results=5):
+        """
+        Finds dictionary words close to word. They are ranked by edit distance, then by
+        frequency in dictionary, words with the same soundex code as word win ties
+        :param word: word in lowercase
+        :param dictionary: dictionary of original words with their frequencies
+        :param max_distance: maximum edit distance, at most the one index was built for
+        :param max_results: number of corrections to return
+        :return: list of corrections, best first
+        """
+        if max_distance is None or max_distance > self.max_distance:
+            max_distance = self.max_distance
+        candidates = set()
+        for key in _deletes(word[:self.prefix_length], max_distance):
+            candidates.update(self.deletes.get(key, ()))
+
+        code = _soundex(word)
+        ranked = []
+        for candidate in candidates:
+            distance = edit_distance(word, candidate, max_distance)
+            if distance <= max_distance:
+                ranked.append((distance, -dictionary.get(candidate, 0), _soundex(candidate) != code,
+                               candidate))
+        ranked.sort()
+        return [candidate for _, _, _, candidate in ranked[:max_results]]
+
+
+def _soundex(word):
+    """
+    :return: soundex code of word, None for words with letters outside a-z
+    """
+    if word and all('a' <= char <= 'z' for char in word):
+        return produce_soundex_code(word)
+    return None
+
+
 def produce_soundex_code(word):
     """
     Implement soundex algorithm, version from book chapter 3.4
@@ -106,21 +337,3 @@ def produce_soundex_code(word):
     result = ''.join(code[:4]) + '0' * (4 - len(code))
     return result
 
-
-def build_soundex_index(dictionary):
-    """
-    Build soundex index for dictionary words.
-    :param dictionary: dictionary of original words
-    :return: {'code1': ['word1_with_code1', 'word2_with_code1', ...],
-              'code2': ['word1_with_code2', 'word2_with_code2', ...], ...}
-    """
-    result = {}
-
-    for word in dictionary:
-        code = produce_soundex_code(word)
-        if code not in result:
-            result[code] = [word]
-        else:
-            result[code].append(word)
-
-    return result
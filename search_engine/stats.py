@@ -0,0 +1,149 @@
+from collections.abc import Mapping
+from itertools import repeat
+
+import numpy as np
+
+from search_engine.postings import bm25_b, bm25_k1
+from search_engine.storage import _dense_array
+
+
+class CollectionStats(Mapping):
+    """
+    Collection statistics used by scoring functions: number of documents, total and
+    average document length, per-term document and collection frequencies and
+    per-document BM25 length norms k1 * (1 - b + b * doc_length / avgdl) for default k1 and b.
+    Works as a read-only doc_id:doc_length mapping over live documents.
+    Built once at index time and updated when documents are added or deleted,
+    so scoring a query touches only postings of its terms
+    """
+
+    def __init__(self, lengths, dfs, cfs):
+        """
+        :param lengths: numpy array of document lengths indexed by doc_id, -1 for missing ids
+        :param dfs: dictionary term:document frequency
+        :param cfs: dictionary term:collection frequency
+        """
+        self.lengths = lengths
+        self.dfs = dfs
+        self.cfs = cfs
+        self._refresh()
+
+    @classmethod
+    def build(cls, index, doc_lengths):
+        """
+        :param index: PostingsIndex or SegmentedIndex
+        :param doc_lengths: dictionary doc_id:doc_length of the documents of index
+        :return: CollectionStats
+        """
+        dfs = {}
+        cfs = {}
+        for term in index:
+            doc_ids, freqs = index.postings(term)
+            if len(doc_ids) > 0:
+                dfs[term] = len(doc_ids)
+                cfs[term] = int(freqs.sum())
+        return cls(_dense_array(doc_lengths, np.int64, -1), dfs, cfs)
+
+    def _refresh(self):
+        live = self.lengths >= 0
+        self.n_docs = int(np.count_nonzero(live))
+        self.total_length = int(self.lengths[live].sum())
+        self.avgdl = self.total_length / self.n_docs if self.n_docs else 1.0
+        self.norms = bm25_k1 * (1 - bm25_b + bm25_b * self.lengths / self.avgdl)
+
+    def update(self, added, added_lengths, removed, removed_ids):
+        """
+        Updates statistics when documents are added or removed
+        :param added: postings of added documents, term:([doc_id_1, ...], [doc_freq_1, ...])
+        :param added_lengths: dictionary doc_id:doc_length of added documents
+        :param removed: postings of removed documents, same format as added
+        :param removed_ids: iterable of ids of removed documents
+        """
+        for term, (doc_ids, freqs) in removed.items():
+            if term in self.dfs:
+                self.dfs[term] -= len(doc_ids)
+                self.cfs[term] -= sum(freqs)
+                if self.dfs[term] <= 0:
+                    del self.dfs[term]
+                    del self.cfs[term]
+        for term, (doc_ids, freqs) in added.items():
+            self.dfs[term] = self.dfs.get(term, 0) + len(doc_ids)
+            self.cfs[term] = self.cfs.get(term, 0) + sum(freqs)
+
+        removed_ids = [doc_id for doc_id in removed_ids if doc_id in self]
+        self.lengths[removed_ids] = -1
+        if added_lengths:
+            size = max(added_lengths) + 1
+            if size > len(self.lengths):
+                self.lengths = np.concatenate((self.lengths,
+                                               np.full(size - len(self.lengths), -1, dtype=np.int64)))
+            for doc_id, length in added_lengths.items():
+                self.lengths[doc_id] = length
+        self._refresh()
+
+    @property
+    def vocab_size(self):
+        """
+        Number of distinct terms in live documents
+        """
+        return len(self.dfs)
+
+    def df(self, term):
+        return self.dfs.get(term, 0)
+
+    def doc_freqs(self, terms):
+        """
+        Same as df for a list of terms
+        :return: numpy array of document frequencies
+        """
+        return np.fromiter(map(self.dfs.get, terms, repeat(0)), dtype=np.int64, count=len(terms))
+
+    def cf(self, term):
+        return self.cfs.get(term, 0)
+
+    def collection_prob(self, term):
+        """
+        :return: probability of term in the collection language model, cf / total_length
+        """
+        if self.total_length == 0:
+            return 0.0
+        return self.cfs.get(term, 0) / self.total_length
+
+    def length_norm(self, doc_id, k1=bm25_k1, b=bm25_b):
+        """
+        :return: k1 * (1 - b + b * doc_length / avgdl), precomputed for default k1 and b
+        """
+        if k1 == bm25_k1 and b == bm25_b:
+            return float(self.norms[doc_id])
+        return k1 * (1 - b + b * self[doc_id] / self.avgdl)
+
+    def length_norms(self, doc_ids, k1=bm25_k1, b=bm25_b):
+        """
+        Same as length_norm for numpy array of doc ids
+        """
+        if k1 == bm25_k1 and b == bm25_b:
+            return self.norms[doc_ids]
+        return k1 * (1 - b + b * self.lengths[doc_ids] / self.avgdl)
+
+    def lookup(self, doc_ids):
+        """
+        :param doc_ids: numpy array of live doc ids
+        :return: numpy array of their lengths
+        """
+        return self.lengths[doc_ids]
+
+    def __getitem__(self, doc_id):
+        if 0 <= doc_id < len(self.lengths):
+            length = int(self.lengths[doc_id])
+            if length >= 0:
+                return length
+        raise KeyError(doc_id)
+
+    def __contains__(self, doc_id):
+        return 0 <= doc_id < len(self.lengths) and self.lengths[doc_id] >= 0
+
+    def __iter__(self):
+        return iter(np.flatnonzero(self.lengths >= 0).tolist())
+
+    def __len__(self):
+        return self.n_docs
@@ -0,0 +1,244 @@
+import mmap
+import os
+import zlib
+from collections.abc import Mapping
+from functools import lru_cache
+
+import numpy as np
+
+
+def map_file(path):
+    """
+    Maps a file into memory read-only. Pages are loaded only when touched
+    and are shared between all processes mapping the same file
+    :param path: path to file
+    :return: mmap object (or empty bytes for an empty file)
+    """
+    with open(path, 'rb') as fd:
+        if os.fstat(fd.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def save_array(array, path):
+    with open(path, 'wb') as fd:
+        np.save(fd, array)
+
+
+def load_array(path, use_mmap=True):
+    return np.load(path, mmap_mode='r' if use_mmap else None)
+
+
+def _dense_array(mapping, dtype, fill):
+    size = max(mapping.keys()) + 1 if mapping else 0
+    result = np.full(size, fill, dtype=dtype)
+    for doc_id, value in mapping.items():
+        result[doc_id] = value
+    return result
+
+
+class DocLengths(Mapping):
+    """
+    Read-only doc_id:doc_length mapping over an array indexed by doc_id,
+    -1 marks ids without a document
+    """
+
+    def __init__(self, lengths):
+        self.lengths = lengths
+        self._size = None
+
+    @classmethod
+    def build(cls, doc_lengths):
+        """
+        :param doc_lengths: dictionary doc_id:doc_length
+        """
+        return cls(_dense_array(doc_lengths, np.int32, -1))
+
+    def save(self, path):
+        save_array(self.lengths, path)
+
+    @classmethod
+    def load(cls, path, use_mmap=True):
+        return cls(load_array(path, use_mmap))
+
+    def __getitem__(self, doc_id):
+        if 0 <= doc_id < len(self.lengths):
+            length = int(self.lengths[doc_id])
+            if length >= 0:
+                return length
+        raise KeyError(doc_id)
+
+    def __contains__(self, doc_id):
+        return 0 <= doc_id < len(self.lengths) and self.lengths[doc_id] >= 0
+
+    def __iter__(self):
+        return iter(np.flatnonzero(np.asarray(self.lengths) >= 0).tolist())
+
+    def __len__(self):
+        if self._size is None:
+            self._size = int(np.count_nonzero(np.asarray(self.lengths) >= 0))
+        return self._size
+
+    def values(self):
+        lengths = np.asarray(self.lengths)
+        return lengths[lengths >= 0].tolist()
+
+    def lookup(self, doc_ids):
+        """
+        :param doc_ids: numpy array of doc ids present in the mapping
+        :return: numpy array of their lengths
+        """
+        return np.asarray(self.lengths)[doc_ids].astype(np.int64)
+
+
+class DocIdMap(object):
+    """
+    Compact map from external doc ids to dense internal doc numbers 0..n-1. ids is a sorted
+    array of external ids, their numbers follow the order of ids. Ids added later get
+    the next numbers in order of addition, they are kept in added list
+    """
+
+    def __init__(self, ids, added=()):
+        self.ids = ids
+        self.added = list(added)
+        self._added_numbers = dict((doc_id, len(ids) + i) for i, doc_id in enumerate(self.added))
+
+    @classmethod
+    def build(cls, doc_ids):
+        """
+        :param doc_ids: iterable of distinct external doc ids
+        """
+        return cls(np.array(sorted(doc_ids), dtype=np.int64))
+
+    def save(self, path):
+        save_array(self.ids, path)
+
+    @classmethod
+    def load(cls, path, added=(), use_mmap=True):
+        return cls(load_array(path, use_mmap), added)
+
+    def number(self, doc_id):
+        """
+        :return: internal number of doc_id, -1 if it is not in the map
+        """
+        i = int(np.searchsorted(self.ids, doc_id))
+        if i < len(self.ids) and self.ids[i] == doc_id:
+            return i
+        return self._added_numbers.get(doc_id, -1)
+
+    def numbers(self, doc_ids):
+        """
+        :param doc_ids: iterable of doc ids present in the map
+        :return: numpy array of their numbers
+        """
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        if not self.added:
+            return np.searchsorted(self.ids, doc_ids)
+        return np.array([self.number(doc_id) for doc_id in doc_ids.tolist()], dtype=np.int64)
+
+    def add(self, doc_ids):
+        """
+        Gives numbers to ids which are not in the map yet
+        :param doc_ids: iterable of external doc ids
+        :return: list of numbers of doc_ids
+        """
+        numbers = []
+        for doc_id in doc_ids:
+            number = self.number(doc_id)
+            if number < 0:
+                number = len(self)
+                self.added.append(doc_id)
+                self._added_numbers[doc_id] = number
+            numbers.append(number)
+        return numbers
+
+    def doc_ids(self, numbers):
+        """
+        :param numbers: iterable of internal numbers
+        :return: list of their external doc ids
+        """
+        numbers = np.asarray(numbers, dtype=np.int64)
+        in_ids = numbers < len(self.ids)
+        result = np.zeros(len(numbers), dtype=np.int64)
+        result[in_ids] = np.asarray(self.ids)[numbers[in_ids]]
+        if not in_ids.all():
+            result[~in_ids] = np.array(self.added, dtype=np.int64)[numbers[~in_ids] - len(self.ids)]
+        return result.tolist()
+
+    def __len__(self):
+        return len(self.ids) + len(self.added)
+
+
+class DocumentStore(Mapping):
+    """
+    Read-only doc_id:text mapping, stored apart from the index. Documents get dense numbers
+    in order of doc ids (see DocIdMap), their utf-8 texts are concatenated in this order
+    and cut into blocks of about block_size bytes, every block is compressed with zlib.
+    table[number] holds doc_id, block and (start, end) offsets of the document inside
+    the uncompressed block, block_offsets[i] is the offset of block i in the data file.
+    Reading a document decompresses only its block, the last cache_size blocks are kept
+    """
+
+    table_dtype = np.dtype([('doc_id', '<i8'), ('block', '<i4'), ('start', '<u4'), ('end', '<u4')])
+
+    def __init__(self, table, block_offsets, data, cache_size=32):
+        self.table = table
+        self.block_offsets = block_offsets
+        self.data = data
+        self.id_map = DocIdMap(table['doc_id'])
+        self._block = lru_cache(maxsize=cache_size)(self._decompress)
+
+    @classmethod
+    def write(cls, documents, table_path, blocks_path, data_path, block_size=1 << 14):
+        """
+        Saves documents in store format
+        :param documents: dictionary doc_id:text
+        :param table_path: path for documents table
+        :param blocks_path: path for block offsets
+        :param data_path: path for compressed texts
+        :param block_size: approximate size of uncompressed block in bytes
+        """
+        table = np.zeros(len(documents), dtype=cls.table_dtype)
+        block_offsets = [0]
+        block = bytearray()
+        with open(data_path, 'wb') as fd:
+            for number, doc_id in enumerate(sorted(documents)):
+                encoded = documents[doc_id].encode('utf-8')
+                table[number] = (doc_id, len(block_offsets) - 1, len(block), len(block) + len(encoded))
+                block.extend(encoded)
+                if len(block) >= block_size:
+                    block_offsets.append(block_offsets[-1] + fd.write(zlib.compress(bytes(block))))
+                    block = bytearray()
+            if len(block) > 0:
+                block_offsets.append(block_offsets[-1] + fd.write(zlib.compress(bytes(block))))
+        save_array(table, table_path)
+        save_array(np.array(block_offsets, dtype=np.int64), blocks_path)
+
+    @classmethod
+    def load(cls, table_path, blocks_path, data_path, use_mmap=True):
+        if use_mmap:
+            data = map_file(data_path)
+        else:
+            with open(data_path, 'rb') as fd:
+                data = fd.read()
+        return cls(load_array(table_path, use_mmap), load_array(blocks_path, use_mmap), data)
+
+    def _decompress(self, block):
+        start, end = self.block_offsets[block: block + 2].tolist()
+        return zlib.decompress(self.data[start: end])
+
+    def __getitem__(self, doc_id):
+        number = self.id_map.number(doc_id)
+        if number < 0:
+            raise KeyError(doc_id)
+        _, block, start, end = self.table[number].tolist()
+        return self._block(block)[start: end].decode('utf-8')
+
+    def __contains__(self, doc_id):
+        return self.id_map.number(doc_id) >= 0
+
+    def __iter__(self):
+        return iter(np.asarray(self.table['doc_id']).tolist())
+
+    def __len__(self):
+        return len(self.table)
@@ -1,3 +1,6 @@
+import re
+from functools import lru_cache
+
 import nltk
 # nltk.download('punkt')
 
@@ -5,12 +8,106 @@ stop_words = {'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'h
               'of', 'on', 'that', 'the', 'to', 'was', 'were', 'will', 'with'}
 ps = nltk.stem.PorterStemmer()
 
+# characters nltk word tokenizer always splits tokens on
+_separators = r'\s"(){}\[\]<>;@#$%&?!*`«“‘„»”’‒-―'
+# a word ends where the tokenizer puts a space: separator, comma or colon not followed by digit,
+# double dash, ellipsis or the period which ends the sentence
+_word_end = rf'(?:$|[{_separators}]|[,:](?!\d)|--|\.\.|\.[\]\)}}>"\'»”’ ]*\s*$)'
+_word_start = rf'(?:(?<![^{_separators},:])|(?<=--)|(?<=\.\.)|(?<=(?<!\w)\')(?!(?:re|ve|ll|m|t|s|d|n)\b))'
+_word_pattern = re.compile(
+    rf"{_word_start}(?:([^\W\d_]+?)(?=n't{_word_end})|([^\W\d_]+)(?=(?:'(?:[smd]|ll|re|ve)?)?{_word_end}))",
+    re.I)
+_contractions = {'cannot': ('can', 'not'), 'gimme': ('gim', 'me'), 'gonna': ('gon', 'na'),
+                 'gotta': ('got', 'ta'), 'lemme': ('lem', 'me'), 'wanna': ('wan', 'na')}
+
+
+def regex_words(text):
+    """
+    Alphabetic tokens of text, the same ones nltk.word_tokenize produces, found with one regex
+    per sentence instead of the whole chain of treebank substitutions. Other tokens are skipped
+    :return: list of words
+    """
+    words = []
+    for sentence in nltk.sent_tokenize(text):
+        for match in _word_pattern.finditer(sentence):
+            word = match.group(1) or match.group(2)
+            if word.lower() in _contractions:
+                words.extend(_contractions[word.lower()])
+            else:
+                words.append(word)
+    return words
+
+
+class Analyzer(object):
+    """
+    Text processing pipeline shared by indexing, query processing and summarization:
+    tokenization, stop word filtering and stemming. Stems are memoized by surface form
+    in a bounded cache, since the same words are stemmed over and over.
+    tokenizer is 'nltk' (nltk.word_tokenize) or 'regex' (regex_words, faster, same words
+    on the corpus). The index has to be queried with the tokenizer it was built with
+    """
+
+    tokenizers = ('nltk', 'regex')
+
+    def __init__(self, tokenizer='nltk', stem_cache_size=1 << 16, stemmer=ps):
+        if tokenizer not in self.tokenizers:
+            raise ValueError(f'Unknown tokenizer: {tokenizer}')
+        self.tokenizer = tokenizer
+        self.stemmer = stemmer
+        self.stem = lru_cache(maxsize=stem_cache_size)(stemmer.stem)
+
+    def words(self, text):
+        """
+        :return: alphabetic tokens of text
+        """
+        if self.tokenizer == 'regex':
+            return regex_words(text)
+        return [w for w in tokenize(text) if w.isalpha()]
+
+    def preprocess(self, text, use_stem=True):
+        words = [w for w in self.words(text.lower()) if w not in stop_words]
+        if use_stem:
+            return [self.stem(w) for w in words]
+        else:
+            return words
+
+    def spans(self, text):
+        """
+        The same terms as preprocess(text), with character ranges of the words they come from
+        :return: list of (term, start, end)
+        """
+        lowered = text.lower()
+        result = []
+        offset = 0
+        for word in self.words(lowered):
+            start = lowered.find(word, offset)
+            if start < 0:  # the tokenizer changed the word, it gets an empty range
+                start = offset
+            else:
+                offset = start + len(word)
+            if word not in stop_words:
+                result.append((self.stem(word), start, offset))
+        return result
+
+
+analyzer = Analyzer()
+
+
+def set_analyzer(tokenizer='nltk', stem_cache_size=1 << 16):
+    """
+    Replaces the analyzer used by preprocess in all modules
+    """
+    global analyzer
+    analyzer = Analyzer(tokenizer, stem_cache_size)
+
 
 def tokenize(text):
     return nltk.word_tokenize(text)
 
 
 def stem(word, stemmer):
+    if stemmer is analyzer.stemmer:
+        return analyzer.stem(word)
     return stemmer.stem(word)
 
 
@@ -19,8 +116,4 @@ def is_apt_word(word):
 
 
 def preprocess(text, use_stem=True):
-    tokenized = tokenize(text.lower())
-    if use_stem:
-        return [stem(w, ps) for w in tokenized if is_apt_word(w)]
-    else:
-        return [w for w in tokenized if is_apt_word(w)]
\ No newline at end of file
+    return analyzer.preprocess(text, use_stem)
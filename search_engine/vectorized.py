@@ -0,0 +1,237 @@
+import math
+
+import numpy as np
+
+from search_engine.inexact import lookup_sorted
+from search_engine.postings import bm25_b, bm25_k1
+
+lm_smoothings = ('additive', 'jelinek-mercer', 'dirichlet')
+
+
+def query_postings(query, index, term_stats, cache=None):
+    """
+    Collects postings of query terms found in index
+    :param query: dictionary - term:frequency
+    :param index: PostingsIndex or SegmentedIndex
+    :param term_stats: object with df(term) for index - CollectionStats or the index itself
+    :param cache: dictionary term:(term, df, doc_ids, term_freqs) shared by a batch of queries,
+                  None for terms not in index
+    :return: list of tuples (term, df, doc_ids, term_freqs), arrays are numpy int64
+    """
+    result = []
+    for term in query:
+        if cache is not None and term in cache:
+            term_postings = cache[term]
+        else:
+            term_postings = None
+            df = term_stats.df(term)
+            if df > 0:
+                doc_ids, freqs = index.postings(term)
+                term_postings = (term, df, doc_ids, freqs)
+            if cache is not None:
+                cache[term] = term_postings
+        if term_postings is not None:
+            result.append(term_postings)
+    return result
+
+
+def _accumulate(doc_ids, weights):
+    """
+    Sums weights per doc id, in the order they are given
+    :return: tuple of numpy arrays (unique doc_ids, sums)
+    """
+    if len(doc_ids) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+    sums = np.bincount(doc_ids, weights=weights)
+    # doc ids are dense numbers below the number of documents (see storage.DocIdMap),
+    # counting them is cheaper than sorting
+    unique_ids = np.flatnonzero(np.bincount(doc_ids))
+    return unique_ids, sums[unique_ids]
+
+
+def posting_docs(postings):
+    """
+    :param postings: list of (term, df, doc_ids, term_freqs), see query_postings
+    :return: sorted numpy array of documents with any of the terms
+    """
+    doc_ids = np.concatenate([np.zeros(0, dtype=np.int64)] + [doc_ids for _, _, doc_ids, _ in postings])
+    # doc ids are dense numbers below the number of documents (see storage.DocIdMap),
+    # counting them is cheaper than sorting
+    return np.flatnonzero(np.bincount(doc_ids))
+
+
+def add_scores(doc_ids, scores, other_ids, other_scores):
+    """
+    Sums two score arrays of sorted doc ids, a document missing from one of them has score 0
+    there. Documents of other_ids are searched in doc_ids, which may be much longer
+    :return: tuple of numpy arrays (doc_ids, scores), doc ids are not sorted
+    """
+    positions, found = lookup_sorted(doc_ids, other_ids)
+    scores = scores.copy()
+    scores[positions[found]] += other_scores[found]
+    return (np.concatenate([doc_ids, other_ids[~found]]),
+            np.concatenate([scores, other_scores[~found]]))
+
+
+def okapi_scores(postings, stats, k1=bm25_k1, b=bm25_b):
+    """
+    Okapi BM25 scores of all documents in postings, same as SearchEngine._okapi_scoring
+    :param postings: list of (term, df, doc_ids, term_freqs), see query_postings
+    :param stats: CollectionStats
+    :return: tuple of numpy arrays (doc_ids, scores)
+    """
+    all_ids, all_weights = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.float64)]
+    for _, df, doc_ids, freqs in postings:
+        idf = math.log10(stats.n_docs / df)
+        nominator = freqs * (k1 + 1)
+        denominator = freqs + stats.length_norms(doc_ids, k1, b)
+        all_ids.append(doc_ids)
+        all_weights.append(idf * nominator / denominator)
+    return _accumulate(np.concatenate(all_ids), np.concatenate(all_weights))
+
+
+def cosine_scores(query, postings, stats):
+    """
+    Cosine scores of all documents in postings, same as SearchEngine._cosine_scoring
+    :param query: dictionary - term:frequency
+    :param postings: list of (term, df, doc_ids, term_freqs), see query_postings
+    :param stats: CollectionStats
+    :return: tuple of numpy arrays (doc_ids, scores)
+    """
+    all_ids, all_weights = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.float64)]
+    for term, df, doc_ids, freqs in postings:
+        idf = math.log10(stats.n_docs / df)
+        all_ids.append(doc_ids)
+        all_weights.append(freqs * query[term] * idf * idf)
+    doc_ids, scores = _accumulate(np.concatenate(all_ids), np.concatenate(all_weights))
+    return doc_ids, scores / stats.lookup(doc_ids)
+
+
+def _matches(doc_ids, term_doc_ids):
+    """
+    Finds documents of sorted doc_ids in sorted postings of a term, binary searching
+    the shorter array in the longer one
+    :return: tuple of numpy arrays (indexes in doc_ids, indexes in term_doc_ids) of common documents
+    """
+    if len(doc_ids) <= len(term_doc_ids):
+        positions, found = lookup_sorted(term_doc_ids, doc_ids)
+        return np.flatnonzero(found), positions[found]
+    positions, found = lookup_sorted(doc_ids, term_doc_ids)
+    return positions[found], np.flatnonzero(found)
+
+
+def restrict_postings(postings, allowed):
+    """
+    Keeps only postings of allowed documents, e.g. of documents passing a filter. Document
+    frequencies are left as they are, so scores of the remaining documents do not change
+    :param postings: list of (term, df, doc_ids, term_freqs), see query_postings
+    :param allowed: set of documents with contains(doc_ids) giving a boolean mask, facets.Bitmap
+    :return: list of (term, df, doc_ids, term_freqs)
+    """
+    result = []
+    for term, df, doc_ids, freqs in postings:
+        kept = allowed.contains(doc_ids)
+        result.append((term, df, doc_ids[kept], freqs[kept]))
+    return result
+
+
+def check_lm_smoothing(smoothing, param):
+    """
+    Raises ValueError for an unknown smoothing or a parameter out of its range: alpha and mu
+    must be positive, lambda in [0, 1), with lambda = 1 unseen terms have zero probability
+    """
+    if smoothing not in lm_smoothings:
+        raise ValueError(f'Unknown smoothing: {smoothing}')
+    if smoothing == 'jelinek-mercer' and not 0 <= param < 1:
+        raise ValueError(f'Lambda of jelinek-mercer smoothing must be in [0, 1): {param}')
+    if smoothing != 'jelinek-mercer' and not param > 0:
+        raise ValueError(f'Parameter of {smoothing} smoothing must be positive: {param}')
+
+
+def lm_scores(query, doc_ids, postings, stats, vocab_size, smoothing, param, matches=None,
+              background=None):
+    """
+    Query likelihood scores of doc_ids - sums of log probabilities of query terms (times
+    their weights in query) in smoothed document language models. Smoothing gives every
+    term a probability p_unseen(term, doc) depending only on document length, so a score is
+    sum over terms of log p_unseen plus, term-at-a-time over postings, 
+    log(p_seen / p_unseen) for the documents containing the term. Collection probabilities
+    are cf / total_length from background. Terms which are not in the collection are skipped by
+    jelinek-mercer and dirichlet smoothing, they would zero scores of all documents
+    :param query: dictionary - term:weight
+    :param doc_ids: sorted numpy array of document ids to score
+    :param postings: list of (term, df, doc_ids, term_freqs) of query terms, see query_postings
+    :param stats: CollectionStats, or any object with lookup(doc_ids) giving lengths
+    :param vocab_size: number of distinct terms, used by additive smoothing
+    :param smoothing: 'additive' (alpha), 'jelinek-mercer' (lambda) or 'dirichlet' (mu)
+    :param param: alpha for additive / lambda for jelinek-mercer / mu for dirichlet
+    :param matches: dictionary term:(indexes in doc_ids, log(p_seen / p_unseen)) kept between
+                    calls scoring the same doc_ids with the same smoothing
+    :param background: CollectionStats giving collection probabilities, stats if None
+    :return: tuple of numpy arrays (doc_ids, scores)
+    """
+    check_lm_smoothing(smoothing, param)
+    if background is None:
+        background = stats
+    doc_ids = np.asarray(doc_ids, dtype=np.int64)
+    lengths = stats.lookup(doc_ids).astype(np.float64)
+    term_postings = dict((term, (term_doc_ids, term_freqs)) 
+                         for term, _, term_doc_ids, term_freqs in postings)
+
+    scores = np.zeros(len(doc_ids), dtype=np.float64)
+    unseen_weight = 0.0
+    for term, weight in query.items():
+        p_collection = background.collection_prob(term)
+        if smoothing == 'additive':
+            scores += weight * math.log(param)
+        elif p_collection > 0:
+            if smoothing == 'jelinek-mercer':
+                scores += weight * math.log((1 - param) * p_collection)
+            else:
+                scores += weight * math.log(param * p_collection)
+        else:
+            continue
+        unseen_weight += weight
+
+        if matches is not None and term in matches:
+            found, log_ratio = matches[term]
+            scores[found] += weight * log_ratio
+        elif term in term_postings:
+            term_doc_ids, term_freqs = term_postings[term]
+            found, positions = _matches(doc_ids, term_doc_ids)
+            tf = term_freqs[positions]
+            if smoothing == 'additive':
+                ratio = (tf + param) / param
+            elif smoothing == 'jelinek-mercer':
+                ratio = 1 + param * tf / (lengths[found] * (1 - param) * p_collection)
+            else:
+                ratio = 1 + tf / (param * p_collection)
+            log_ratio = np.log(ratio)
+            scores[found] += weight * log_ratio
+            if matches is not None:
+                matches[term] = (found, log_ratio)
+
+    # the part of p_unseen depending on document length
+    if smoothing == 'additive':
+        scores -= unseen_weight * np.log(lengths + param * vocab_size)
+    elif smoothing == 'dirichlet':
+        scores -= unseen_weight * np.log(lengths + param)
+    return doc_ids, scores
+
+
+def top_k(doc_ids, scores, k):
+    """
+    Selects k best documents with np.argpartition, without sorting all scores.
+    Ties are broken in favour of smaller doc ids, as a heap of (-score, doc_id) does
+    :param doc_ids: numpy array of doc ids
+    :param scores: numpy array of their scores
+    :return: list of (-score, doc_id), best first
+    """
+    if k <= 0 or len(scores) == 0:
+        return []
+    if k < len(scores):
+        kth = np.argpartition(-scores, k - 1)[k - 1]
+        candidates = np.flatnonzero(scores >= scores[kth])
+        doc_ids, scores = doc_ids[candidates], scores[candidates]
+    order = np.lexsort((doc_ids, -scores))[:k]
+    return list(zip((-scores[order]).tolist(), doc_ids[order].tolist()))
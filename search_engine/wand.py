@@ -0,0 +1,215 @@
+import heapq
+import math
+from bisect import bisect_left
+
+import numpy as np
+
+from search_engine.postings import block_maxima, bm25_b, bm25_k1, bm25_tf_part
+
+NO_MORE_DOCS = float('inf')
+
+# upper bounds are computed in a different order than exact scores,
+# the slack keeps them from falling below a score because of rounding
+_bound_slack = 1 + 1e-9
+
+
+class _TermCursor(object):
+    """
+    Iterator over posting list of one query term with its block-max score bounds.
+    Postings are decoded one block at a time by read_block(block), blocks which are
+    skipped by shallow_seek are never decoded
+    """
+
+    def __init__(self, position, idf, read_block, block_last, block_bounds):
+        self.position = position
+        self.idf = idf
+        self.read_block = read_block
+        self.block_last = block_last
+        self.block_bounds = block_bounds
+        self.max_bound = max(block_bounds) if block_bounds else 0.0
+        # block of the decoded postings and block found by shallow_seek
+        self.block = 0
+        self.shallow = 0
+        self._load(0)
+
+    def _load(self, block):
+        self.block = block
+        self.i = 0
+        if block < len(self.block_last):
+            doc_ids, freqs = self.read_block(block)
+            self.doc_ids, self.freqs = doc_ids.tolist(), freqs.tolist()
+            self.doc = self.doc_ids[0]
+        else:
+            self.doc = NO_MORE_DOCS
+
+    def next(self):
+        self.i += 1
+        if self.i < len(self.doc_ids):
+            self.doc = self.doc_ids[self.i]
+        else:
+            self._load(self.block + 1)
+
+    def seek(self, doc_id):
+        """
+        Moves cursor to the first posting with doc id >= doc_id
+        """
+        if doc_id <= self.doc:
+            return
+        if doc_id > self.block_last[self.block]:
+            self._load(bisect_left(self.block_last, doc_id, self.block + 1))
+            if self.doc == NO_MORE_DOCS:
+                return
+        self.i = bisect_left(self.doc_ids, doc_id, self.i)
+        self.doc = self.doc_ids[self.i]
+
+    def shallow_seek(self, doc_id):
+        """
+        Moves block pointer (but not the posting) to the block which may contain doc_id
+        :return: score bound of the block, 0 if no block does
+        """
+        self.shallow = bisect_left(self.block_last, doc_id, max(self.shallow, self.block))
+        if self.shallow < len(self.block_last):
+            return self.block_bounds[self.shallow]
+        return 0.0
+
+    def block_end(self):
+        if self.shallow < len(self.block_last):
+            return self.block_last[self.shallow]
+        return NO_MORE_DOCS
+
+
+def _block_reader(index, term, blocks):
+    """
+    :return: function block -> (doc_ids, term_freqs) of that block of the term postings.
+             Blocks are read from the index if it can, else postings are decoded at once
+             and cut at the last doc ids of blocks
+    """
+    read_block = index.block_reader(term)
+    if read_block is not None:
+        return read_block
+    doc_ids, freqs = index.postings(term)
+    ends = np.searchsorted(doc_ids, np.asarray(blocks['last_doc'], dtype=np.int64), side='right')
+    starts = np.concatenate(([0], ends[:-1]))
+    return lambda block: (doc_ids[starts[block]: ends[block]], freqs[starts[block]: ends[block]])
+
+
+def _reorder(cursors, moved):
+    """
+    Restores the order of cursors by doc id after the first moved ones were advanced,
+    the others are still sorted. Exhausted cursors are dropped
+    """
+    # cursors after the one being placed are sorted already
+    for placed in range(moved - 1, -1, -1):
+        cursor = cursors.pop(placed)
+        if cursor.doc != NO_MORE_DOCS:
+            i = placed
+            while i < len(cursors) and cursors[i].doc <= cursor.doc:
+                i += 1
+            cursors.insert(i, cursor)
+
+
+def _okapi_bounds(idf, blocks, blocks_avgdl, avgdl, k1, b):
+    """
+    Score upper bound of every block. Maximal tf and minimal length of a block bound the
+    score for any k1 and b, precomputed maximal tf part is tighter but holds only for the
+    default ones. Growing avgdl raises the tf part at most avgdl / blocks_avgdl times
+    """
+    max_tfs = np.asarray(blocks['max_tf'], dtype=np.float64)
+    min_lens = np.asarray(blocks['min_len'], dtype=np.float64)
+    bounds = bm25_tf_part(max_tfs, min_lens, avgdl, k1, b)
+    if k1 == bm25_k1 and b == bm25_b:
+        scale = max(1.0, avgdl / blocks_avgdl)
+        bounds = np.minimum(bounds, np.asarray(blocks['max_bm25']) * scale)
+    return (idf * bounds * _bound_slack).tolist()
+
+
+def okapi_top_k(query, index, stats, top_k, k1=bm25_k1, b=bm25_b, block_size=64):
+    """
+    Finds top_k documents by Okapi BM25 score (same as SearchEngine._okapi_scoring) with
+    Block-Max WAND dynamic pruning: documents are visited in doc id order, a document is
+    fully scored only if the sum of score upper bounds of its terms can beat the current
+    top_k threshold, whole blocks of postings are skipped using block maxima.
+    Ties are resolved in favour of smaller doc ids, like the heap in answer_query does
+    :param query: dictionary - term:frequency
+    :param index: PostingsIndex or SegmentedIndex
+    :param stats: CollectionStats of index
+    :param top_k: number of documents to find
+    :param block_size: block size to use when index has no precomputed block maxima
+    :return: dictionary of scores of top_k documents - doc_id:score
+    """
+    avgdl = stats.avgdl
+    cursors = []
+    for position, term in enumerate(query):
+        if stats.df(term) == 0:
+            continue
+        idf = math.log10(stats.n_docs / stats.df(term))
+        term_blocks = index.term_blocks(term)
+        if term_blocks is None:
+            doc_ids, freqs = index.postings(term)
+            blocks = block_maxima(doc_ids, freqs, stats.lookup(doc_ids), block_size, avgdl)
+            term_blocks = (blocks, avgdl)
+        blocks, blocks_avgdl = term_blocks
+        cursors.append(_TermCursor(position, idf, _block_reader(index, term, blocks),
+                                   np.asarray(blocks['last_doc']).tolist(),
+                                   _okapi_bounds(idf, blocks, blocks_avgdl, avgdl, k1, b)))
+    cursors = [cursor for cursor in cursors if cursor.doc != NO_MORE_DOCS]
+    cursors.sort(key=lambda c: c.doc)
+
+    # min-heap of (score, -doc_id), its top is the weakest of current top_k
+    heap = []
+    threshold = None
+    while top_k > 0 and cursors:
+        # pivot - first term at which the sum of maximal scores can reach the threshold
+        pivot = None
+        bound = 0.0
+        for i, cursor in enumerate(cursors):
+            if cursor.doc == NO_MORE_DOCS:
+                break
+            bound += cursor.max_bound
+            if threshold is None or bound >= threshold:
+                pivot = i
+                break
+        if pivot is None:
+            break
+        pivot_doc = cursors[pivot].doc
+        while pivot + 1 < len(cursors) and cursors[pivot + 1].doc == pivot_doc:
+            pivot += 1
+
+        if threshold is not None:
+            block_bound = 0.0
+            for cursor in cursors[:pivot + 1]:
+                block_bound += cursor.shallow_seek(pivot_doc)
+            if block_bound < threshold:
+                # no document up to the nearest block end can make it to the top
+                next_doc = min(c.block_end() for c in cursors[:pivot + 1]) + 1
+                if pivot + 1 < len(cursors):
+                    next_doc = min(next_doc, cursors[pivot + 1].doc)
+                for cursor in cursors[:pivot + 1]:
+                    cursor.seek(next_doc)
+                _reorder(cursors, pivot + 1)
+                continue
+
+        if cursors[0].doc == pivot_doc:
+            matched = sorted(cursors[:pivot + 1], key=lambda c: c.position)
+            norm = stats.length_norm(pivot_doc, k1, b)
+            score = 0
+            for cursor in matched:
+                doc_freq = cursor.freqs[cursor.i]
+                nominator = doc_freq * (k1 + 1)
+                denominator = (doc_freq + norm)
+                score += cursor.idf * nominator / denominator
+                cursor.next()
+            entry = (score, -pivot_doc)
+            if len(heap) < top_k:
+                heapq.heappush(heap, entry)
+            elif entry > heap[0]:
+                heapq.heapreplace(heap, entry)
+            if len(heap) == top_k:
+                threshold = heap[0][0]
+            _reorder(cursors, pivot + 1)
+        else:
+            for cursor in cursors[:pivot]:
+                cursor.seek(pivot_doc)
+            _reorder(cursors, pivot)
+
+    return dict((-neg_doc_id, score) for score, neg_doc_id in heap)
@@ -0,0 +1,42 @@
+import os
+
+import pytest
+
+from search_engine.engine import SearchEngine
+from search_engine.segments import empty_categories
+
+texts = ['Cocoa prices rose as exporters held back supplies',
+         'Oil company shares fell after the output report',
+         'Bank interest rate was cut by the central bank',
+         'Wheat harvest is expected to grow this year']
+
+
+def write_corpus(path):
+    with open(os.path.join(path, 'reut2-000.sgm'), 'w', encoding='latin1') as fd:
+        for doc_id, text in enumerate(texts, 1):
+            fd.write(f'<REUTERS NEWID="{doc_id}"><TEXT><TITLE>Report {doc_id}</TITLE>'
+                     f'<BODY>{text}.</BODY></TEXT></REUTERS>\n')
+
+
+@pytest.fixture
+def engine(tmp_path, monkeypatch):
+    corpus = tmp_path / 'corpus'
+    corpus.mkdir()
+    write_corpus(str(corpus))
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('search_engine/data.nosync')
+
+    def make(**kwargs):
+        search_engine = SearchEngine(**kwargs)
+        search_engine.do_indexing(str(corpus))
+        return search_engine
+    return make
+
+
+@pytest.fixture
+def categories():
+    def make(**tags):
+        result = empty_categories()
+        result.update(tags)
+        return result
+    return make
@@ -0,0 +1,53 @@
+import pytest
+
+from search_engine import utils
+
+
+@pytest.mark.parametrize('scoring', ['lm', 'okapi', 'cosine'])
+def test_answer_query_ranks_as_answer_queries(engine, scoring):
+    search_engine = engine()
+    for raw_query in ('cocoa prices', 'bank rate', 'oil shares report'):
+        ranked = search_engine.answer_query(raw_query, 3, scoring=scoring, print_res=False)
+        batch = search_engine.answer_queries([raw_query], 3, scoring=scoring).results[0]
+        assert [doc_id for _, doc_id in ranked] == batch.doc_ids
+        assert [-neg_score for neg_score, _ in ranked] == pytest.approx(batch.scores)
+
+
+def test_inexact_lm_ranks_as_answer_queries(engine):
+    search_engine = engine(tier_thresholds=(1,))
+    search_engine.add_documents({5: 'Cocoa growers expect a large crop'})
+    search_engine.delete_documents([2])
+    for raw_query in ('cocoa prices', 'cocoa crop', 'bank rate'):
+        ranked = search_engine.answer_query(raw_query, 3, scoring='lm', do_inexact=True, print_res=False)
+        batch = search_engine.answer_queries([raw_query], 3, scoring='lm', do_inexact=True).results[0]
+        assert [doc_id for _, doc_id in ranked] == batch.doc_ids
+        assert [-neg_score for neg_score, _ in ranked] == pytest.approx(batch.scores)
+
+
+def test_cached_answers_follow_spelling_correction(engine, capsys):
+    search_engine = engine(auto_correct=True)
+    corrected = search_engine.answer_query('cocoa pricess', 3, print_res=False)
+    assert 'Searching for prices instead of pricess' in capsys.readouterr().out
+    assert search_engine.answer_query('cocoa pricess', 3, print_res=False) == corrected
+    assert 'Searching for prices instead of pricess' in capsys.readouterr().out
+    assert search_engine.cache_stats['hits'] == 1
+
+    search_engine.auto_correct = False
+    assert search_engine.answer_query('cocoa pricess', 3, print_res=False) == []
+    assert 'Possible spelling fixes' in capsys.readouterr().out
+
+
+def test_tokenizer_is_recorded_with_the_index(engine):
+    search_engine = engine(tokenizer='regex')
+    assert search_engine.analyzer.tokenizer == 'regex'
+    assert utils.analyzer.tokenizer == 'nltk'
+
+    reopened = engine()
+    assert reopened.analyzer.tokenizer == 'regex'
+    assert reopened.answer_query('cocoa prices', 3, print_res=False) == \
+        search_engine.answer_query('cocoa prices', 3, print_res=False)
+
+    rebuilt = engine(tokenizer='nltk')
+    assert rebuilt.analyzer.tokenizer == 'nltk'
+    assert rebuilt.derived_versions['tokenizer'] == 'nltk'
+    assert engine().analyzer.tokenizer == 'nltk'
@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+from search_engine import facets
+from search_engine.facets import Bitmap
+
+
+def random_ids(seed, size):
+    # sparse ids and dense runs, so both array and bitset containers are used
+    rng = np.random.default_rng(seed)
+    sparse = rng.choice(1 << 20, size, replace=False)
+    dense = 3 * (1 << 16) + rng.choice(1 << 16, 6000 + size, replace=False)
+    return np.unique(np.concatenate((sparse, dense)))
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_bitmap_set_operations(seed):
+    a_ids, b_ids = random_ids(seed, 3000), random_ids(seed + 100, 500)
+    a, b = Bitmap.from_sorted(a_ids), Bitmap.from_sorted(b_ids)
+    a_set, b_set = set(a_ids.tolist()), set(b_ids.tolist())
+
+    assert (a & b).to_array().tolist() == sorted(a_set & b_set)
+    assert (a | b).to_array().tolist() == sorted(a_set | b_set)
+    assert (a - b).to_array().tolist() == sorted(a_set - b_set)
+    assert (b - a).to_array().tolist() == sorted(b_set - a_set)
+    assert len(a | b) == len(a_set | b_set)
+    probe = np.arange(0, 1 << 20, 7)
+    assert a.contains(probe).tolist() == [doc_id in a_set for doc_id in probe.tolist()]
+
+
+def test_bitmap_add_and_discard_in_place():
+    ids = random_ids(0, 1000)
+    bitmap = Bitmap.from_sorted(ids)
+    added, discarded = random_ids(1, 200), ids[::3]
+    bitmap.add(added)
+    bitmap.discard(discarded)
+
+    expected = (set(ids.tolist()) | set(added.tolist())) - set(discarded.tolist())
+    assert bitmap.to_array().tolist() == sorted(expected)
+    bitmap.discard(bitmap.to_array())
+    assert len(bitmap) == 0 and bitmap.keys == []
+
+
+def test_facet_index_updated_in_place_matches_rebuild(categories):
+    docs = {1: categories(places=['usa'], topics=['earn']),
+            2: categories(places=['uk', 'usa'], topics=['acq']),
+            3: categories(places=['japan'])}
+    facet_index = facets.FacetIndex.build(docs)
+    added = {4: categories(places=['brazil'], topics=['coffee']),
+             2: categories(places=['uk'], topics=['earn'])}
+    removed = {1: docs[1], 2: docs[2]}
+    facet_index.update({}, removed)
+    facet_index.update(added, {})
+    live = {2: added[2], 3: docs[3], 4: added[4]}
+    rebuilt = facets.FacetIndex.build(live)
+
+    for text in ('places=usa', 'topics=earn', 'places=uk OR places=brazil', 'NOT places=japan'):
+        assert facet_index.filter(text).to_array().tolist() == rebuilt.filter(text).to_array().tolist()
+    doc_ids = np.array([1, 2, 3, 4])
+    assert facet_index.counts(doc_ids) == rebuilt.counts(doc_ids)
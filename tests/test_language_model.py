@@ -0,0 +1,60 @@
+import math
+
+import pytest
+
+from search_engine import language_model
+
+
+def models_by_name(models):
+    """
+    :return: category:(length, number of docs, term:count) of categories which have documents
+    """
+    result = {}
+    for number, cat in enumerate(models.categories):
+        if models.n_docs[number] > 0:
+            counts = dict((term, int(counts[numbers == number].sum()))
+                          for term, (numbers, counts) in models.terms.items() if number in numbers)
+            result[cat] = (int(models.lengths[number]), int(models.n_docs[number]), counts)
+    return result
+
+
+def test_category_models_updated_in_place_match_rebuild(engine, categories):
+    search_engine = engine()
+    search_engine.add_documents({10: 'Cocoa exports rose', 11: 'Oil prices fell'},
+                                {10: categories(topics=['cocoa'], places=['ghana']),
+                                 11: categories(topics=['crude'], places=['usa', 'uk'])})
+    models = search_engine.category_models
+    search_engine.add_documents({12: 'Crude oil output rose in Ghana'},
+                                {12: categories(topics=['crude'], places=['ghana'])})
+    search_engine.delete_documents([10])
+    search_engine.add_documents({11: 'Wheat harvest was good'},
+                                {11: categories(topics=['grain'], places=['usa'])})
+
+    assert search_engine.category_models is models
+    rebuilt = language_model.CategoryModels.build(search_engine.cat2docs, search_engine.inv_index,
+                                                  search_engine.stats)
+    assert models_by_name(models) == models_by_name(rebuilt)
+    query = {'oil': 1, 'rose': 1}
+    stats = search_engine.stats
+    assert language_model.lm_define_categories(query, models, stats, 'dirichlet', 100) == \
+        pytest.approx(language_model.lm_define_categories(query, rebuilt, stats, 'dirichlet', 100))
+
+
+def test_categories_are_smoothed_with_the_collection_model(engine, categories):
+    search_engine = engine()
+    search_engine.add_documents({10: 'Cocoa exports rose', 11: 'Oil prices fell'},
+                                {10: categories(topics=['cocoa'], places=['ghana']),
+                                 11: categories(topics=['crude'])})
+    models, stats = search_engine.category_models, search_engine.stats
+    # wheat is only in a document without categories, cocoa is in one of two categories
+    query = {'cocoa': 1, 'wheat': 1}
+    expected = {}
+    for number, cat in enumerate(models.categories):
+        expected[cat] = 0.0
+        for term in query:
+            numbers, counts = models.terms.get(term, ([], []))
+            tf = dict(zip(numbers, counts)).get(number, 0)
+            p_collection = stats.cf(term) / stats.total_length
+            expected[cat] += math.log((tf + 10 * p_collection) / (models.lengths[number] + 10))
+    assert language_model.lm_define_categories(query, models, stats, 'dirichlet', 10) == \
+        pytest.approx(expected)
@@ -0,0 +1,62 @@
+from collections import Counter
+
+import numpy as np
+import pytest
+
+from search_engine import query_exp
+from search_engine.utils import preprocess
+
+
+def reference_rocchio(query, relevant_n, doc_ids, search_engine, alph, beta, gamma, n_terms):
+    """
+    Rocchio as it was written with dicts, one document at a time
+    """
+    vectors = {}
+    for doc_id in doc_ids:
+        vectors[doc_id] = Counter(sorted(search_engine.forward_index[doc_id].terms))
+        for term in vectors[doc_id]:
+            df = search_engine.stats.df(term)
+            vectors[doc_id][term] *= np.log10(search_engine.stats.n_docs / df) if df else 0
+    new_query = dict((term, weight * alph) for term, weight in query.items())
+    center = dict((term, 0) for term in query)
+    neg_center = dict((term, 0) for term in query)
+    for doc_id in doc_ids[:relevant_n]:
+        for term, weight in vectors[doc_id].items():
+            center[term] = center.get(term, 0) + weight
+    for doc_id in doc_ids[relevant_n:]:
+        for term, weight in vectors[doc_id].items():
+            neg_center[term] = neg_center.get(term, 0) + weight
+    candidates = sorted(((term, beta / relevant_n * weight) for term, weight in center.items()),
+                        key=lambda item: item[1], reverse=True)
+    for term, weight in candidates[:n_terms]:
+        new_query[term] = weight
+    non_rel_cnt = len(doc_ids) - relevant_n
+    if gamma > 0 and non_rel_cnt > 0:
+        for term in new_query:
+            new_query[term] = max(0, new_query[term] - gamma / non_rel_cnt * neg_center.get(term, 0))
+    return new_query
+
+
+@pytest.mark.parametrize('gamma', [0, 0.15])
+def test_rocchio_matches_dict_implementation(engine, gamma):
+    search_engine = engine()
+    doc_ids = search_engine.id_map.numbers([2, 3, 1, 4])
+    for query in ({'oil': 1.0, 'share': 1.0}, {'bank': 2.0, 'missingterm': 1.0}):
+        for relevant_n in (1, 2):
+            expected = reference_rocchio(query, relevant_n, doc_ids, search_engine, 1.0, 0.75, gamma, 2)
+            expanded = query_exp.rocchio(query, relevant_n, doc_ids, search_engine.forward_index,
+                                         search_engine.stats, 1.0, 0.75, gamma, 2)
+            assert expanded == pytest.approx(expected)
+
+
+@pytest.mark.parametrize('scoring', ['okapi_np', 'cosine_np', 'lm_np'])
+def test_rescored_expansion_matches_answering_expanded_query(engine, scoring):
+    search_engine = engine()
+    for raw_query in ('cocoa oil', 'bank wheat', 'oil shares bank'):
+        query = Counter(preprocess(raw_query))
+        expanded = search_engine._expand_query(query, search_engine._answer_vectorized(query, 10, scoring))
+        assert expanded != query
+        expected = search_engine._answer_vectorized(expanded, 10, scoring)
+        ranked = search_engine._answer_expanded(query, 10, scoring)
+        assert [doc_id for _, doc_id in ranked] == [doc_id for _, doc_id in expected]
+        assert [score for score, _ in ranked] == pytest.approx([score for score, _ in expected])
@@ -0,0 +1,154 @@
+import os
+
+from search_engine import segments
+
+
+def found(search_engine, query, doc_id):
+    return doc_id in [doc_id for _, doc_id in search_engine.answer_query(query, 10, print_res=False)]
+
+
+def found_inexact(search_engine, query, doc_id, scoring):
+    ranked = search_engine.answer_query(query, 10, scoring=scoring, do_inexact=True, print_res=False)
+    return doc_id in [doc_id for _, doc_id in ranked]
+
+
+def assert_consistent(search_engine):
+    assert search_engine.stats.n_docs == len(search_engine.documents)
+
+
+def test_replaced_document_survives_full_merge(engine):
+    search_engine = engine()
+    search_engine.add_documents({2: 'Gold mining output rose sharply'})
+    search_engine.merge_segments(include_base=True)
+
+    assert found(search_engine, 'gold mining', 2)
+    assert not found(search_engine, 'oil company', 2)
+    assert_consistent(search_engine)
+
+
+def test_replaced_document_survives_background_merge(engine):
+    search_engine = engine(max_segments=2)
+    search_engine.add_documents({50000: 'Coffee export quota talks stalled'})
+    search_engine.add_documents({50000: 'Sugar production fell in Cuba'})
+    search_engine.add_documents({50001: 'Trade deficit widened in March'})
+    search_engine.segments.wait()
+
+    assert len(search_engine.segments.segments) == 2
+    assert found(search_engine, 'sugar production', 50000)
+    assert not found(search_engine, 'coffee quota', 50000)
+    assert found(search_engine, 'trade deficit', 50001)
+    assert_consistent(search_engine)
+
+
+def test_unflushed_updates_are_rebuilt_on_restart(engine):
+    search_engine = engine()
+    search_engine.add_documents({5: 'Gold mining output rose sharply'})
+    search_engine.delete_documents([1])
+
+    restarted = engine()
+    assert restarted.stats.n_docs == len(restarted.documents) == 4
+    assert 'gold' in restarted.dictionary and 'cocoa' not in restarted.dictionary
+    assert restarted.wildcard_index.expand('gol*') == ['gold']
+    assert found(restarted, 'gold mining', 5)
+
+    search_engine.flush()
+    restarted = engine()
+    assert restarted.tiered_index.dfs == search_engine.tiered_index.dfs
+    assert restarted.dictionary == search_engine.dictionary
+
+
+def test_tiered_index_rebuilt_after_delete(engine):
+    search_engine = engine()
+    search_engine.delete_documents([4])
+    search_engine.flush()
+
+    restarted = engine(tier_thresholds=(3,))
+    assert 'wheat' not in restarted.tiered_index
+    for scoring in ('okapi', 'cosine', 'okapi_np'):
+        assert not found_inexact(restarted, 'wheat harvest bank', 4, scoring)
+        assert found_inexact(restarted, 'wheat harvest bank', 3, scoring)
+
+
+def test_delete_during_merge(engine, monkeypatch):
+    search_engine = engine()
+    search_engine.add_documents({101: 'Coffee export quota talks stalled',
+                                 102: 'Coffee prices fell on heavy supplies'})
+    search_engine.add_documents({103: 'Coffee growers expect a large crop'})
+
+    # documents are deleted after postings of the first segment are read
+    deleting = []
+
+    def delete_once():
+        if deleting:
+            search_engine.delete_documents([deleting.pop()])
+        return dict((tag, []) for tag in segments.reuters.category_tags)
+    monkeypatch.setattr(segments, 'empty_categories', delete_once)
+    deleting.append(102)
+    search_engine.merge_segments()
+
+    assert len(search_engine.segments.segments) == 2
+    assert not found(search_engine, 'coffee', 102)
+    assert found(search_engine, 'coffee', 101) and found(search_engine, 'coffee', 103)
+    assert_consistent(search_engine)
+
+
+def test_rebuild_drops_derived_structures(engine, tmp_path):
+    engine()
+    with open(tmp_path / 'corpus' / 'reut2-000.sgm', 'w', encoding='latin1') as fd:
+        fd.write('<REUTERS NEWID="1"><TEXT><BODY>Gold mining output rose.</BODY></TEXT></REUTERS>\n')
+    os.remove('search_engine/data.nosync/inv_terms.npy')
+
+    rebuilt = engine()
+    assert rebuilt.index_version == 0
+    assert 'gold' in rebuilt.dictionary and 'cocoa' not in rebuilt.dictionary
+    assert 'cocoa' not in rebuilt.tiered_index
+    assert rebuilt.wildcard_index.expand('coc*') == []
+    assert rebuilt.spelling_index.lookup('cocoe', rebuilt.dictionary) == []
+
+
+def test_update_before_derived_structures_are_loaded(engine):
+    engine()
+    search_engine = engine()
+    search_engine.add_documents({5: 'Cocoa and oil output rose'})
+    search_engine.delete_documents([3])
+
+    rebuilt = engine()
+    assert search_engine.stats.df('cocoa') == 2
+    assert search_engine.stats.dfs == rebuilt.stats.dfs
+    assert search_engine.tiered_index.dfs == rebuilt.tiered_index.dfs
+    assert search_engine.dictionary == rebuilt.dictionary
+    assert search_engine.wildcard_index.expand('ban*') == []
+
+
+def test_impact_index_follows_segments(engine):
+    search_engine = engine()
+    assert found_inexact(search_engine, 'oil output', 2, 'impact')
+    base_impacts = search_engine.impact_index.indexes[0]
+
+    search_engine.add_documents({5: 'Gold mining output rose sharply'})
+    search_engine.delete_documents([2])
+    assert search_engine.impact_index.indexes[0] is base_impacts
+    assert found_inexact(search_engine, 'gold output', 5, 'impact')
+    assert not found_inexact(search_engine, 'oil output', 2, 'impact')
+
+    search_engine.merge_segments(include_base=True)
+    assert found_inexact(search_engine, 'gold output', 5, 'impact')
+    assert not found_inexact(search_engine, 'oil output', 2, 'impact')
+
+
+def test_large_doc_id(engine):
+    search_engine = engine()
+    search_engine.add_documents({10 ** 12: 'Gold mining output rose sharply'})
+
+    assert search_engine.id_map.number(10 ** 12) == 4
+    assert len(search_engine.stats.lengths) == 5
+    for scoring in ('okapi', 'cosine', 'lm', 'impact', 'proximity'):
+        ranked = search_engine.answer_query('gold mining', 1, scoring=scoring, print_res=False)
+        assert [doc_id for _, doc_id in ranked] == [10 ** 12]
+    assert search_engine.answer_queries(['gold mining'], 1).results[0].doc_ids == [10 ** 12]
+    assert search_engine.get_snippets('gold', [10 ** 12])[0].text.startswith('Gold')
+    assert search_engine.facet_counts('gold mining')
+
+    assert search_engine.delete_documents([10 ** 12, 7]) == {10 ** 12}
+    assert not found(search_engine, 'gold mining', 10 ** 12)
+    assert_consistent(search_engine)
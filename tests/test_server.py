@@ -0,0 +1,170 @@
+import asyncio
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from search_engine import server as server_module
+from search_engine.engine import BatchResult, QueryResult
+from search_engine.server import QueryServer, _answer_batch
+
+
+def respond(server, raw):
+    """
+    Sends raw bytes to the connection handler and returns the response status line
+    """
+    return asyncio.run(respond_async(server, raw))
+
+
+async def respond_async(server, raw):
+    reader = asyncio.StreamReader(limit=1024)
+    reader.feed_data(raw)
+    reader.feed_eof()
+    sent = []
+
+    class Writer(object):
+        def write(self, data):
+            sent.append(data)
+
+        async def drain(self):
+            pass
+
+        def close(self):
+            pass
+
+    await server._handle_connection(reader, Writer())
+    return b''.join(sent).split(b'\r\n', 1)[0]
+
+
+def search(**params):
+    body = json.dumps(params).encode()
+    return b'POST /search HTTP/1.1\r\nContent-Length: %d\r\n\r\n' % len(body) + body
+
+
+class FakeEngine(object):
+    """
+    Answers every query with its length, the first call waits until release is set,
+    so requests sent meanwhile queue up
+    """
+
+    def __init__(self, fail_scoring=None):
+        self.release = threading.Event()
+        self.calls = []
+        self.fail_scoring = fail_scoring
+
+    def answer_queries(self, queries, top_k, scoring='okapi', do_inexact=False, filters=None,
+                       use_expansion=False):
+        if not self.calls:
+            self.release.wait(5)
+        self.calls.append(list(queries))
+        if scoring == self.fail_scoring:
+            raise RuntimeError('scoring failed')
+        return BatchResult([QueryResult(query, [len(query)], [1.0]) for query in queries], 0.0, 0.0)
+
+
+def run_served(server, clients):
+    """
+    Runs the dispatcher of server with a thread pool while clients coroutine runs
+    """
+    async def run():
+        server.queue = asyncio.Queue()
+        server.slots = asyncio.Semaphore(server.workers)
+        dispatcher = asyncio.ensure_future(server._dispatch())
+        try:
+            return await clients()
+        finally:
+            dispatcher.cancel()
+    server.pool = ThreadPoolExecutor(server.workers)
+    try:
+        return asyncio.run(run())
+    finally:
+        server.close()
+
+
+def test_non_string_filters_are_bad_request():
+    server = QueryServer('unused')
+    body = json.dumps({'query': 'oil', 'filters': 5}).encode()
+    raw = b'POST /search HTTP/1.1\r\nContent-Length: %d\r\n\r\n' % len(body) + body
+    assert respond(server, raw) == b'HTTP/1.1 400 Bad Request'
+
+
+def test_oversized_header_is_bad_request():
+    server = QueryServer('unused')
+    raw = b'POST /search HTTP/1.1\r\nX-Long: ' + b'a' * 4096 + b'\r\n\r\n'
+    assert respond(server, raw) == b'HTTP/1.1 400 Bad Request'
+
+
+def test_top_k_must_be_an_integer():
+    server = QueryServer('unused')
+    for top_k in (True, '5', 2.7, 0):
+        assert respond(server, search(query='oil', top_k=top_k)) == b'HTTP/1.1 400 Bad Request'
+
+
+def test_requests_over_max_pending_are_rejected():
+    server = QueryServer('unused', max_pending=2)
+    server.in_flight = 2
+    assert respond(server, search(query='oil')) == b'HTTP/1.1 503 Service Unavailable'
+    assert server.counts['rejected'] == 1
+
+
+def test_requests_queued_while_worker_is_busy_are_batched(monkeypatch):
+    engine = FakeEngine()
+    monkeypatch.setattr(server_module, '_engine', engine)
+    server = QueryServer('unused', workers=1)
+
+    async def clients():
+        first = asyncio.ensure_future(respond_async(server, search(query='oil')))
+        await asyncio.sleep(0.05)
+        others = [asyncio.ensure_future(respond_async(server, search(query='oil ' * n)))
+                  for n in range(1, 5)]
+        await asyncio.sleep(0.05)
+        engine.release.set()
+        return await asyncio.gather(first, *others)
+
+    assert run_served(server, clients) == [b'HTTP/1.1 200 OK'] * 5
+    assert [len(queries) for queries in engine.calls] == [1, 4]
+    assert server.counts['batches'] == 2 and server.counts['batched'] == 5
+
+
+def test_request_not_answered_in_time_gets_deadline_exceeded(monkeypatch):
+    engine = FakeEngine()
+    monkeypatch.setattr(server_module, '_engine', engine)
+    server = QueryServer('unused', workers=1)
+
+    async def clients():
+        status = await respond_async(server, search(query='oil', timeout=0.05))
+        engine.release.set()
+        return status
+
+    assert run_served(server, clients) == b'HTTP/1.1 504 Gateway Timeout'
+    assert server.counts['expired'] == 1
+
+
+def test_expired_requests_are_skipped_and_failures_stay_in_their_group(monkeypatch):
+    engine = FakeEngine(fail_scoring='lm_np')
+    engine.release.set()
+    monkeypatch.setattr(server_module, '_engine', engine)
+    request = dict(top_k=10, inexact=False, filters=None, expansion=False)
+    results = _answer_batch([dict(request, query='oil', scoring='okapi_np', deadline=time.time() + 5),
+                             dict(request, query='wheat', scoring='lm_np', deadline=time.time() + 5),
+                             dict(request, query='cocoa', scoring='okapi_np', deadline=0)])
+    assert results[0] == {'doc_ids': [3], 'scores': [1.0]}
+    assert results[1]['status'] == 500
+    assert results[2]['status'] == 504
+    assert engine.calls == [['oil'], ['wheat']]
+
+
+def test_broken_pool_is_replaced(monkeypatch):
+    def broken(requests):
+        raise BrokenProcessPool('worker died')
+    monkeypatch.setattr(server_module, '_answer_batch', broken)
+    server = QueryServer('unused', workers=1)
+    pools = []
+    monkeypatch.setattr(server, '_new_pool', lambda: pools.append(ThreadPoolExecutor(1)) or pools[-1])
+
+    async def clients():
+        return await respond_async(server, search(query='oil'))
+
+    assert run_served(server, clients) == b'HTTP/1.1 503 Service Unavailable'
+    assert len(pools) == 1
@@ -0,0 +1,25 @@
+import random
+
+from search_engine.spell_checking import WildcardIndex
+
+wildcards = ['a*', '*ing', 'ex*ed', '*ar*', 'c*o*a', 'oil', '*', 'z*z', 'pr*s']
+
+
+def random_words(rng, n):
+    return set(''.join(rng.choice('aeioucdgnprstx') for _ in range(rng.randint(2, 7))) for _ in range(n))
+
+
+def test_wildcard_index_updates_match_rebuild():
+    rng = random.Random(7)
+    words = random_words(rng, 300) | {'oil', 'cocoa', 'exported', 'pricing'}
+    index = WildcardIndex(words)
+    for _ in range(30):
+        new_words = random_words(rng, 20) - words
+        dropped_words = set(rng.sample(sorted(words), 25))
+        index.update(new_words, dropped_words)
+        words = (words | new_words) - dropped_words
+
+        rebuilt = WildcardIndex(words)
+        for wildcard in wildcards:
+            assert index.expand(wildcard) == rebuilt.expand(wildcard)
+    assert sorted(index.lexicon) == index.lexicon == sorted(words)
@@ -0,0 +1,61 @@
+import math
+
+import numpy as np
+import pytest
+
+from search_engine import wand
+from search_engine.postings import PostingsIndex
+from search_engine.stats import CollectionStats
+
+
+def reference_top_k(query, index, stats, top_k, k1=1.2, b=0.75):
+    """
+    Exhaustive Okapi BM25 as SearchEngine._okapi_scoring, best first, smaller doc ids win ties
+    """
+    scores = {}
+    for term in query:
+        if stats.df(term) == 0:
+            continue
+        idf = math.log10(stats.n_docs / stats.df(term))
+        doc_ids, freqs = index.postings(term)
+        for doc_id, doc_freq in zip(doc_ids.tolist(), freqs.tolist()):
+            nominator = doc_freq * (k1 + 1)
+            denominator = doc_freq + stats.length_norm(doc_id, k1, b)
+            scores[doc_id] = scores.get(doc_id, 0) + idf * nominator / denominator
+    return sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:top_k]
+
+
+def random_index(seed, compression, n_docs=20000):
+    rng = np.random.default_rng(seed)
+    # few distinct lengths and frequencies, so many documents tie
+    doc_lengths = dict((doc_id, int(length)) for doc_id, length 
+                       in enumerate(rng.choice([20, 50, 100, 200], n_docs)))
+    postings = {}
+    for term, df in (('said', 12000), ('mln', 4000), ('dlrs', 3000), ('oil', 600), ('cocoa', 40)):
+        doc_ids = np.sort(rng.choice(n_docs, df, replace=False))
+        postings[term] = (doc_ids.tolist(), rng.integers(1, 4, df).tolist())
+    index = PostingsIndex.build(postings, compression, doc_lengths)
+    return index, CollectionStats.build(index, doc_lengths)
+
+
+@pytest.mark.parametrize('compression', [None, 'vbyte'])
+@pytest.mark.parametrize('seed', range(3))
+def test_wand_matches_exhaustive_top_k(seed, compression):
+    index, stats = random_index(seed, compression)
+    for query in ({'said': 1}, {'mln': 1, 'dlrs': 1}, {'oil': 1, 'said': 1}, 
+                  {'cocoa': 1, 'oil': 1, 'mln': 1, 'missing': 1}):
+        for top_k in (1, 10, 100):
+            expected = reference_top_k(query, index, stats, top_k)
+            found = wand.okapi_top_k(query, index, stats, top_k)
+            assert sorted(found.items(), key=lambda item: (-item[1], item[0])) == expected
+
+
+def test_wand_matches_exhaustive_on_segments(engine):
+    search_engine = engine(use_wand=True)
+    search_engine.add_documents({5: 'Cocoa and oil output rose', 6: 'Bank rate on oil loans'})
+    search_engine.delete_documents([2])
+    for query in ({'oil': 1}, {'oil': 1, 'bank': 1}, {'cocoa': 1, 'rate': 1, 'rose': 1}):
+        for top_k in (1, 2, 5):
+            expected = reference_top_k(query, search_engine.inv_index, search_engine.stats, top_k)
+            found = wand.okapi_top_k(query, search_engine.inv_index, search_engine.stats, top_k)
+            assert sorted(found.items(), key=lambda item: (-item[1], item[0])) == expected